@@ -1,6 +1,8 @@
 ''' Interface for controlling one arm '''
 import moveit_commander
 from moveit_msgs.srv import GetPositionIK, GetPositionIKRequest
+from collections import OrderedDict
+import copy
 import threading
 import rospy
 import tf
@@ -22,6 +24,84 @@ from pr2_arm_control.msg import GripperState, ArmMode, Side
 # The minimum time to allow for moving between poses.
 DURATION_MIN_THRESHOLD = 0.5  # seconds
 
+IK_SERVICE_NAME = '/compute_ik'
+
+# IK results are cached for poses that are the same up to these
+# resolutions, and for seeds in the same bucket. A cached solution may
+# have been solved from a different seed in the same bucket (up to 0.1
+# rad away per joint); that approximation is intended, as IK from
+# nearby seeds gives nearby solutions.
+IK_CACHE_SIZE = 1000  # entries
+IK_POSITION_RESOLUTION = 0.0001  # meters
+IK_ORIENTATION_RESOLUTION = 0.0001  # quaternion components
+IK_SEED_RESOLUTION = 0.1  # radians
+
+
+class IKCache:
+    ''' Least-recently-used cache of IK results, with hit and miss
+    counters'''
+
+    def __init__(self, size=IK_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(arm_index, ee_pose, seed):
+        '''Returns the cache key for an IK request: the arm, the
+        quantized target pose and the seed bucket. Requests whose seeds
+        fall in the same bucket share a key, so they get the solution
+        found for whichever of them came first'''
+        position = ee_pose.position
+        orientation = ee_pose.orientation
+        pose_bucket = tuple(
+            [int(round(x / IK_POSITION_RESOLUTION))
+             for x in (position.x, position.y, position.z)] +
+            [int(round(x / IK_ORIENTATION_RESOLUTION))
+             for x in (orientation.x, orientation.y, orientation.z,
+                       orientation.w)])
+        if seed is None:
+            seed_bucket = None
+        else:
+            seed_bucket = tuple(
+                [int(round(x / IK_SEED_RESOLUTION)) for x in seed])
+        return (arm_index, pose_bucket, seed_bucket)
+
+    def get(self, key):
+        '''Returns (True, result) if key is cached, and (False, None)
+        otherwise'''
+        self._lock.acquire()
+        is_found = key in self._entries
+        result = None
+        if is_found:
+            self.hits += 1
+            # Move the entry to the most recently used end.
+            result = self._entries.pop(key)
+            self._entries[key] = result
+        else:
+            self.misses += 1
+        self._lock.release()
+        return is_found, result
+
+    def put(self, key, result):
+        '''Caches result (which may be None) for key, evicting the least
+        recently used entry if full'''
+        self._lock.acquire()
+        self._entries.pop(key, None)
+        self._entries[key] = result
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        self._lock.release()
+
+    def clear(self):
+        '''Removes all cached results (but keeps the counters)'''
+        self._lock.acquire()
+        self._entries.clear()
+        self._lock.release()
+
+
 class Arm:
     ''' Interfacing with one arm for controlling mode and action execution'''
 
@@ -76,6 +156,7 @@ class Arm:
         self.ik_request = None
         self.ik_joints = None
         self.ik_limits = None
+        self.ik_cache = IKCache()
         self._setup_ik()
 
         gripper_name = (self._side_prefix() +
@@ -89,12 +170,10 @@ class Arm:
 
     def _setup_ik(self):
         '''Sets up services for inverse kinematics'''
-        ik_srv_name = '/compute_ik'
         rospy.loginfo('IK info service has responded for '
                       + self.side() + ' arm.')
-        rospy.wait_for_service(ik_srv_name)
-        self.ik_srv = rospy.ServiceProxy(ik_srv_name,
-                                         GetPositionIK, persistent=True)
+        rospy.wait_for_service(IK_SERVICE_NAME)
+        self.ik_srv = self.create_ik_service()
         rospy.loginfo('IK service has responded for ' + self.side() + ' arm.')
 
         robot = moveit_commander.RobotCommander()
@@ -111,6 +190,12 @@ class Arm:
         request.robot_state.joint_state.name = self.ik_joints
         request.robot_state.joint_state.position = [0] * len(self.joint_names)
 
+    def create_ik_service(self):
+        '''Returns a new persistent proxy for the IK service. A proxy
+        should only be used by one thread at a time'''
+        return rospy.ServiceProxy(IK_SERVICE_NAME, GetPositionIK,
+                                  persistent=True)
+
     def side(self):
         '''Returns the word right or left depending on arm side'''
         if (self.arm_index == Side.RIGHT):
@@ -169,10 +254,14 @@ class Arm:
         self.lock.release()
         return positions
 
-    def _solve_ik(self, ee_pose, seed=None):
-        '''Gets the IK solution for end effector pose'''
+    def _solve_ik(self, ee_pose, seed=None, ik_srv=None):
+        '''Gets the IK solution for end effector pose, using ik_srv (or
+        this arm's own IK service proxy if None)'''
 
-        self.ik_request.ik_request.pose_stamped.pose = ee_pose
+        # Fill in a copy of the common request, so that requests from
+        # different threads don't interfere.
+        request = copy.deepcopy(self.ik_request)
+        request.ik_request.pose_stamped.pose = ee_pose
 
         if seed is None:
             # If no see is specified for IK search, start search at midpoint
@@ -180,20 +269,20 @@ class Arm:
             for i in range(0, len(self.ik_joints)):
                 seed.append((self.ik_limits[i][0] +
                              self.ik_limits[i][1]) / 2.0)
-        self.ik_request.ik_request.robot_state.joint_state.position = seed
-
-        try:
-            #rospy.loginfo('Sending IK request.')
-            response = self.ik_srv(self.ik_request)
-            if(response.error_code.val == response.error_code.SUCCESS):
-                # The solution contains all robot joints, we only need the joints of one arm.
-                response_names = response.solution.joint_state.name
-                response_positions = response.solution.joint_state.position
-                return [response_positions[i] for i, x in enumerate(response_names) if x in self.joint_names]
-            else:
-                return None
-        except rospy.ServiceException:
-            rospy.logerr('Exception while getting the IK solution.')
+        request.ik_request.robot_state.joint_state.position = seed
+
+        # A rospy.ServiceException is passed on, so that a failed
+        # request is not mistaken for (and cached as) no solution.
+        #rospy.loginfo('Sending IK request.')
+        if ik_srv is None:
+            ik_srv = self.ik_srv
+        response = ik_srv(request)
+        if(response.error_code.val == response.error_code.SUCCESS):
+            # The solution contains all robot joints, we only need the joints of one arm.
+            response_names = response.solution.joint_state.name
+            response_positions = response.solution.joint_state.position
+            return [response_positions[i] for i, x in enumerate(response_names) if x in self.joint_names]
+        else:
             return None
 
     def set_mode(self, mode):
@@ -359,24 +448,39 @@ class Arm:
         '''Whetehr the execution succeeded'''
         return (self.traj_action_client.get_state() == GoalStatus.SUCCEEDED)
 
-    def get_ik_for_ee(self, ee_pose, seed):
-        ''' Finds the IK solution for given end effector pose'''
-        joints = self._solve_ik(ee_pose, seed)
-        ## If our seed did not work, try once again with the default seed
-        if joints is None:
-            #rospy.logwarn('Could not find IK solution with preferred seed,' +
-            #              'will try default seed.')
-            joints = self._solve_ik(ee_pose)
+    def get_ik_for_ee(self, ee_pose, seed, ik_srv=None):
+        ''' Finds the IK solution for given end effector pose, using the
+        cached result if the same pose was solved with a similar seed.
+        Other threads than the main one should pass their own ik_srv
+        (see create_ik_service)'''
+        key = IKCache.get_key(self.arm_index, ee_pose, seed)
+        is_cached, joints = self.ik_cache.get(key)
+        if not is_cached:
+            try:
+                joints = self._solve_ik(ee_pose, seed, ik_srv)
+                ## If our seed did not work, try once again with the default seed
+                if joints is None:
+                    #rospy.logwarn('Could not find IK solution with preferred seed,' +
+                    #              'will try default seed.')
+                    joints = self._solve_ik(ee_pose, ik_srv=ik_srv)
+            except rospy.ServiceException:
+                rospy.logerr('Exception while getting the IK solution.')
+                return None
+            self.ik_cache.put(key, joints)
 
         if joints is None:
             pass
             #rospy.logwarn('IK out of bounds, will use the seed directly.')
         else:
             rollover = array((array(joints) - array(seed)) / pi, int)
-            joints -= ((rollover + (sign(rollover) + 1) / 2) / 2) * 2 * pi
+            joints = joints - ((rollover + (sign(rollover) + 1) / 2) / 2) * 2 * pi
 
         return joints
 
+    def get_ik_cache_stats(self):
+        ''' Returns the (hits, misses) counts of the IK cache'''
+        return self.ik_cache.hits, self.ik_cache.misses
+
     @staticmethod
     def get_distance_bw_poses(pose0, pose1):
         '''Returns the dissimilarity between two end-effector poses'''
@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+"""Tests the functionality of the IKCache in the arm module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import unittest
+from pr2_arm_control.arm import IKCache
+from geometry_msgs.msg import Point, Pose, Quaternion
+
+
+def make_pose(x, y=0.0, z=0.0):
+    return Pose(Point(x, y, z), Quaternion(0, 0, 0, 1))
+
+
+class TestIKCache(unittest.TestCase):
+    def testKeyQuantization(self):
+        seed = [0.0] * 7
+        key = IKCache.get_key(0, make_pose(0.5), seed)
+        # Poses closer than the resolution share a key.
+        self.assertEqual(IKCache.get_key(0, make_pose(0.50001), seed), key)
+        self.assertNotEqual(IKCache.get_key(0, make_pose(0.5002), seed), key)
+        # The same pose for another arm doesn't.
+        self.assertNotEqual(IKCache.get_key(1, make_pose(0.5), seed), key)
+
+    def testSeedBuckets(self):
+        pose = make_pose(0.5)
+        key = IKCache.get_key(0, pose, [0.0] * 7)
+        # Seeds in the same 0.1 rad bucket share a key, and so the
+        # solution cached for either.
+        self.assertEqual(IKCache.get_key(0, pose, [0.04] * 7), key)
+        self.assertNotEqual(IKCache.get_key(0, pose, [0.06] * 7), key)
+        self.assertNotEqual(IKCache.get_key(0, pose, None), key)
+        self.assertEqual(IKCache.get_key(0, pose, None),
+                         IKCache.get_key(0, pose, None))
+
+    def testEviction(self):
+        cache = IKCache(size=2)
+        cache.put('a', [1.0])
+        cache.put('b', [2.0])
+        # Using 'a' makes 'b' the least recently used.
+        self.assertEqual(cache.get('a'), (True, [1.0]))
+        cache.put('c', [3.0])
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('a'), (True, [1.0]))
+        self.assertEqual(cache.get('c'), (True, [3.0]))
+
+    def testCounters(self):
+        cache = IKCache()
+        self.assertEqual(cache.get('a'), (False, None))
+        cache.put('a', [1.0])
+        cache.get('a')
+        cache.get('a')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # Clearing keeps the counters.
+        cache.clear()
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def testCachesNone(self):
+        # Poses without a solution are cached too, so they aren't
+        # solved again.
+        cache = IKCache()
+        cache.put('a', None)
+        self.assertEqual(cache.get('a'), (True, None))
+        self.assertEqual(cache.hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
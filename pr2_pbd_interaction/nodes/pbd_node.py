@@ -20,6 +20,7 @@ def signal_handler(signal, frame):
     # The following makes sure the state of a user study is saved, so that it can be recovered
     global interaction
     interaction.session.save_current_action()
+    interaction.session.flush()
     rospy.loginfo("Saved experiment state. Terminating.")
     sys.exit(0)
 
@@ -10,6 +10,11 @@ import roslib
 roslib.load_manifest('pr2_pbd_interaction')
 import rospy
 
+# System builtins
+from contextlib import contextmanager
+import copy
+import threading
+
 # 3rd party
 import numpy
 
@@ -28,9 +33,10 @@ from visualization_msgs.msg import (Marker, InteractiveMarker,
                                     InteractiveMarkerFeedback)
 
 # Local
-from arms import Arms
 from pr2_arm_control.msg import Side, GripperState
 from pr2_pbd_interaction.msg import (ActionStep, ArmState, Landmark)
+from reachability import ReachabilityPool
+from step_table import get_pose_row
 import world
 from world import World
 
@@ -49,6 +55,7 @@ COLOR_OBJ_REF_ARROW = ColorRGBA(1.0, 0.8, 0.2, 0.5)
 COLOR_STEP_TEXT = ColorRGBA(0.0, 0.0, 0.0, 0.5)
 COLOR_MESH_REACHABLE = ColorRGBA(1.0, 0.5, 0.0, 0.6)
 COLOR_MESH_UNREACHABLE = ColorRGBA(0.5, 0.5, 0.5, 0.6)
+COLOR_MESH_UNKNOWN = ColorRGBA(0.8, 0.8, 0.8, 0.3)
 
 # Scales
 SCALE_TRAJ_STEP_SPHERES = Vector3(0.02, 0.02, 0.02)
@@ -103,17 +110,148 @@ ARM_NAMES = ['right', 'left']
 # ######################################################################
 
 
+class RefFrameRegistry(object):
+    """The reference frames that action steps can be relative to, and
+    the reference frame menu made from them, shared by all markers.
+
+    Everything is computed once per change of the reference frames
+    (rather than once per marker): lookups by name are dictionary
+    lookups, and the menu template lists the menu entries to make. The
+    version changes whenever the available frames (and so the menu)
+    change, so markers know when to rebuild their menus.
+    """
+
+    # Menu title of the entry for picking an object side.
+    SELECT_ONE_TITLE = 'Select an object side'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._ref_frame_list = None
+        self._world_revision = None
+        self._names = (BASE_LINK,)
+        # name -> Landmark
+        self._landmarks = {}
+        self._menu_template, self._menu_positions = (
+            RefFrameRegistry._make_menu(self._names))
+
+    @staticmethod
+    def _make_menu(names):
+        """Makes the reference frame menu for the frames in names.
+
+        Args:
+            names ((str)): The reference frame names.
+
+        Returns:
+            ((str, str|None)), {str: int}: The (title, reference frame
+                name) of each menu entry, in order; the last one is for
+                picking an object side, with no reference frame name.
+                And the position in the former of the entry for each
+                reference frame name.
+        """
+        template = []
+        positions = {}
+        for name in names:
+            if name != BASE_LINK and "Obj" not in str(name):
+                positions[name] = len(template)
+                template.append((name + ' center', name))
+            elif name == BASE_LINK:
+                positions[name] = len(template)
+                template.append((name, name))
+        # Objects and their sides are all picked by selecting a side.
+        for name in names:
+            if name not in positions:
+                positions[name] = len(template)
+        template.append((RefFrameRegistry.SELECT_ONE_TITLE, None))
+        return tuple(template), positions
+
+    def update(self, ref_frame_list):
+        """Updates the reference frames. Cheap when they are the same as
+        last time, as they are for all but the first marker updated
+        with a new list.
+
+        Args:
+            ref_frame_list ([Landmark]): List of Landmark.msg objects, the
+                reference frames of the system.
+        """
+        world_revision = world.landmark_transforms.get_revision()
+        with self._lock:
+            if (ref_frame_list is self._ref_frame_list and
+                    world_revision == self._world_revision):
+                return
+            self._ref_frame_list = ref_frame_list
+            self._world_revision = world_revision
+            self._landmarks = dict(
+                (obj.name, obj) for obj in ref_frame_list)
+            names = (BASE_LINK,) + tuple(obj.name for obj in ref_frame_list)
+            if names != self._names:
+                self._names = names
+                self._menu_template, self._menu_positions = (
+                    RefFrameRegistry._make_menu(names))
+                self._version += 1
+
+    def get_version(self):
+        """Returns the version of the reference frames (and menu).
+
+        Returns:
+            int
+        """
+        return self._version
+
+    def get_menu_template(self):
+        """Returns the reference frame menu entries to make.
+
+        Returns:
+            int, ((str, str|None)): The version and the (title,
+                reference frame name) of each menu entry, see
+                _make_menu(...).
+        """
+        with self._lock:
+            return self._version, self._menu_template
+
+    def get_menu_position(self, name):
+        """Returns the position of the menu entry for a reference frame.
+
+        Args:
+            name (str): The reference frame name.
+
+        Returns:
+            int|None: The position in the menu template, or None if
+                there's no such reference frame.
+        """
+        with self._lock:
+            return self._menu_positions.get(name)
+
+    def get_landmark(self, name):
+        """Returns the landmark of a reference frame.
+
+        Args:
+            name (str): The reference frame name.
+
+        Returns:
+            Landmark|None: None if there's no such reference frame.
+        """
+        with self._lock:
+            return self._landmarks.get(name)
+
+
 class ActionStepMarker:
     """Marker for visualizing the steps of an action."""
 
     _im_server = None
+    _reachability_pool = None
     _offset = DEFAULT_OFFSET
-    _ref_object_list = None
-    _ref_names = None
+    _ref_frames = RefFrameRegistry()
     _marker_click_cb = None
 
+    # Interactive marker changes are published together, see
+    # batch_update().
+    _im_lock = threading.RLock()
+    _update_depth = 0
+    _has_pending_changes = False
+
     def __init__(self, world, step_number, arm_index, action_step,
-                 marker_click_cb):
+                 marker_click_cb, step_changed_cb=None, viz_changed_cb=None):
         """
         Args:
             world (World): The world object.
@@ -124,10 +262,22 @@ class ActionStepMarker:
                 when a marker is clicked. Pass the uid of the marker
                 (as calculated by get_uid(...) as well as whether it's
                 selected.
+            step_changed_cb (function(int), optional): The function to
+                call after this marker changes action_step. Pass the
+                (0-based) index of the step. Defaults to None.
+            viz_changed_cb (function(ActionStepMarker), optional): The
+                function to call (from a background thread) when
+                something the marker shows changed in the background,
+                e.g. its reachability. It should call update_viz() while
+                holding whatever guards action_step. Defaults to None,
+                in which case the change shows on the next
+                update_viz().
         """
         if ActionStepMarker._im_server is None:
             im_server = InteractiveMarkerServer(TOPIC_IM_SERVER, q_size=5)
             ActionStepMarker._im_server = im_server
+        if ActionStepMarker._reachability_pool is None:
+            ActionStepMarker._reachability_pool = ReachabilityPool()
 
         self._world = world
 
@@ -141,11 +291,24 @@ class ActionStepMarker:
         self.is_edited = False
         self.has_object = False
 
-        self._sub_entries = None
-        self._menu_options = None
-        self._side_refs = []
         self._menu_handler = None
+        # The entry ids of the menu, in menu template order, and the
+        # other way around.
+        self._menu_entries = []
+        self._menu_positions = {}
+        self._menu_version = None
+        self._checked_menu_id = None
         self._prev_is_reachable = None
+        # Reachability is checked in the background; this is the result
+        # (None while unknown) for the target it was requested for.
+        self._reachability = None
+        self._reachability_target = None
+        self._step_changed_cb = step_changed_cb
+        self._viz_changed_cb = viz_changed_cb
+        # What the marker and its menu were last rendered from, see
+        # _get_revision() and _get_menu_revision().
+        self._revision = None
+        self._menu_revision = None
         ActionStepMarker._marker_click_cb = marker_click_cb
 
     # ##################################################################
@@ -167,6 +330,40 @@ class ActionStepMarker:
         """
         return len(ARM_NAMES) * step_number + arm_index
 
+    @staticmethod
+    @contextmanager
+    def batch_update(is_flushed=True):
+        """Context for updating many action step markers at once.
+
+        Interactive marker changes made inside it are published
+        together, with a single applyChanges, when the outermost batch
+        update ends.
+
+        Args:
+            is_flushed (bool, optional): Whether to publish the changes
+                when the outermost batch update ends. Pass False to
+                publish them later with flush_changes(), e.g. once the
+                caller's own locks are released. Defaults to True.
+        """
+        ActionStepMarker._im_lock.acquire()
+        ActionStepMarker._update_depth += 1
+        try:
+            yield
+        finally:
+            ActionStepMarker._update_depth -= 1
+            if ActionStepMarker._update_depth == 0 and is_flushed:
+                ActionStepMarker._flush_changes()
+            ActionStepMarker._im_lock.release()
+
+    @staticmethod
+    def flush_changes():
+        """Publishes the interactive marker changes made so far, unless
+        inside a batch update (which publishes them when it ends)."""
+        ActionStepMarker._im_lock.acquire()
+        if ActionStepMarker._update_depth == 0:
+            ActionStepMarker._flush_changes()
+        ActionStepMarker._im_lock.release()
+
     # ##################################################################
     # Static methods: Internal ("private")
     # ##################################################################
@@ -213,6 +410,24 @@ class ActionStepMarker:
             transform, offset_transform)
         return world.get_pose_from_transform(hand_transform)
 
+    @staticmethod
+    def _apply_changes():
+        """Records that interactive marker changes were made, publishing
+        them right away unless inside a batch update (which publishes
+        them when it ends)."""
+        ActionStepMarker._im_lock.acquire()
+        ActionStepMarker._has_pending_changes = True
+        if ActionStepMarker._update_depth == 0:
+            ActionStepMarker._flush_changes()
+        ActionStepMarker._im_lock.release()
+
+    @staticmethod
+    def _flush_changes():
+        """Publishes pending interactive marker changes, if any."""
+        if ActionStepMarker._has_pending_changes:
+            ActionStepMarker._im_server.applyChanges()
+            ActionStepMarker._has_pending_changes = False
+
     # ##################################################################
     # Instance methods: Public (API)
     # ##################################################################
@@ -231,41 +446,51 @@ class ActionStepMarker:
         self.step_number -= 1
         self._update_menu()
 
-    def update_ref_frames(self, ref_frame_list):
+    def update_ref_frames(self, ref_frame_list, landmark_map=None):
         """Updates and re-assigns coordinate frames when the world changes.
 
         Args:
             ref_frame_list ([Landmark]): List of Landmark.msg objects, the
                 reference frames of the system.
+            landmark_map ({str: Landmark|None}, optional): Correspondences
+                from previous landmark names to new landmarks, as
+                computed once for all markers by
+                world.associate_landmarks(...). Defaults to None, in
+                which case this marker's landmark is matched on its own.
         """
         # There is a new list of objects. If the current frame is
         # relative (already assigned to an object) we need to figure out
         # the correspondences.
 
-        ActionStepMarker._ref_object_list = ref_frame_list
-        ActionStepMarker._ref_object_list += World.side_refs
+        ActionStepMarker._ref_frames.update(ref_frame_list)
         arm_pose = self.get_target()
         if arm_pose.refFrame == ArmState.OBJECT:
             prev_ref_obj = arm_pose.refFrameLandmark
-            new_ref_obj = world.get_most_similar_obj(prev_ref_obj,
-                                                     ref_frame_list)
+            if landmark_map is not None:
+                new_ref_obj = landmark_map.get(prev_ref_obj.name)
+            else:
+                new_ref_obj = world.get_most_similar_obj(prev_ref_obj,
+                                                         ref_frame_list)
             if new_ref_obj is not None:
                 self.has_object = True
                 arm_pose.refFrameLandmark = new_ref_obj
+                self._step_changed()
             else:
                 self.has_object = False
 
-        # Re-populate cached list of reference names.
-        ActionStepMarker._ref_names = [BASE_LINK]
-        for obj in ActionStepMarker._ref_object_list:
-            ActionStepMarker._ref_names.append(obj.name)
-
         self._update_menu()
 
     def destroy(self):
         """Removes marker from the world."""
-        ActionStepMarker._im_server.erase(self._get_name())
-        ActionStepMarker._im_server.applyChanges()
+        ActionStepMarker._reachability_pool.cancel(self)
+        with ActionStepMarker.batch_update():
+            ActionStepMarker._im_server.erase(self._get_name())
+            self._revision = None
+            self._menu_revision = None
+            self._menu_version = None
+            self._reachability_target = None
+            self._reachability = None
+            ActionStepMarker._apply_changes()
 
     def update_pose(self, new_arm_state):
         """Changes the pose of the action step to that given by new_arm_state.
@@ -289,6 +514,7 @@ class ActionStepMarker:
                 t.rArm = updated_arm_state
             else:
                 t.lArm = updated_arm_state
+            self._step_changed()
             self.update_viz()
         elif self.action_step.type == ActionStep.ARM_TRAJECTORY:
             rospy.logwarn('Modification of whole trajectory segments is not ' +
@@ -339,6 +565,18 @@ class ActionStepMarker:
         world_pose = world.get_absolute_pose(arm_state)
         return world_pose
 
+    def get_ref_landmark(self):
+        """Returns the landmark this action step is relative to.
+
+        Returns:
+            Landmark|None: The reference landmark, or None if the step
+                is not relative to an object.
+        """
+        arm_state = self.get_target()
+        if arm_state.refFrame == ArmState.OBJECT:
+            return arm_state.refFrameLandmark
+        return None
+
     def get_pose(self):
         """Returns the pose of the action step.
 
@@ -361,6 +599,7 @@ class ActionStepMarker:
                 at.rArm = target
             else:
                 at.lArm = target
+            self._step_changed()
             self.has_object = True
             self._update_menu()
         self.is_edited = False
@@ -389,10 +628,12 @@ class ActionStepMarker:
             return arm[traj_index]
 
     def update_viz(self):
-        """Updates visualization fully."""
-        self._update_viz_core()
-        self._menu_handler.reApply(ActionStepMarker._im_server)
-        ActionStepMarker._im_server.applyChanges()
+        """Updates visualization fully, if anything it shows changed
+        since it was last rendered."""
+        with ActionStepMarker.batch_update():
+            if self._update_viz_core():
+                self._menu_handler.reApply(ActionStepMarker._im_server)
+                ActionStepMarker._apply_changes()
 
     def pose_reached(self):
         """Update when a requested pose is reached."""
@@ -404,14 +645,7 @@ class ActionStepMarker:
         Args:
             feedback (InteractiveMarkerFeedback (?))
         """
-        if "Obj" in self._get_ref_name():
-            menu_id = self._menu_options[-1]
-        else:
-            menu_id = self._get_menu_id(self._get_ref_name())
-        self._menu_handler.setCheckState(
-                menu_id, MenuHandler.UNCHECKED)
-        self._menu_handler.setCheckState(
-                feedback.menu_entry_id, MenuHandler.CHECKED)
+        self._set_checked_menu_id(feedback.menu_entry_id)
         old_ref = self._get_ref_name()
         new_ref = self._get_menu_name(feedback.menu_entry_id)
         self._set_ref(new_ref)
@@ -419,7 +653,7 @@ class ActionStepMarker:
             'Switching reference frame from {} to {} for action step {}'.format(
                 old_ref, new_ref, self._get_name()))
         self._menu_handler.reApply(ActionStepMarker._im_server)
-        ActionStepMarker._im_server.applyChanges()
+        ActionStepMarker._apply_changes()
         self.update_viz()
 
     def select_one_cb(self, feedback):
@@ -429,33 +663,20 @@ class ActionStepMarker:
             feedback (InteractiveMarkerFeedback (?))
         """
         World.selected_obj_side = None
-        state = self._menu_handler.getCheckState(feedback.menu_entry_id)
-        self._menu_handler.setCheckState(self._get_menu_id(self._get_ref_name()), MenuHandler.UNCHECKED)
-        self._menu_handler.setCheckState(feedback.menu_entry_id, MenuHandler.CHECKED)
+        self._set_checked_menu_id(feedback.menu_entry_id)
         rospy.loginfo('Left-click on a marker side to use it as a reference frame')
         ref_marker = World.wait_for_selection()
 
-        for obj in World.get_frame_list(self._world):
-            if obj.name == World.selected_obj_side.marker_name:
-                obj_num = World.get_frame_list(self._world).index(obj)
-
-        if "X-Minimum" in World.selected_obj_side.control_name:
-            self._set_ref('Obj #' + str(obj_num) + ' X-Minimum Ref')
-        elif "X-Maximum" in World.selected_obj_side.control_name:
-            self._set_ref('Obj #' + str(obj_num) + ' X-Maximum Ref')
-        elif "Y-Minimum" in World.selected_obj_side.control_name:
-            self._set_ref('Obj #' + str(obj_num) + ' Y-Minimum Ref')
-        elif "Y-Maximum" in World.selected_obj_side.control_name:
-            self._set_ref('Obj #' + str(obj_num) + ' Y-Maximum Ref')
-        elif "Z-Minimum" in World.selected_obj_side.control_name:
-            self._set_ref('Obj #' + str(obj_num) + ' Z-Minimum Ref')
-        elif "Z-Maximum" in World.selected_obj_side.control_name:
-            self._set_ref('Obj #' + str(obj_num) + ' Z-Maximum Ref')
+        # Side controls are named like their reference frames, e.g.
+        # "Obj #0 X-Minimum" for the "Obj #0 X-Minimum Ref" landmark.
+        side_name = World.selected_obj_side.control_name
+        if any(side_name.endswith(' ' + side) for side in world.SIDE_NAMES):
+            self._set_ref(side_name + ' Ref')
         else:
             rospy.loginfo("\nSelected object not valid to reference")
 
         self._menu_handler.reApply(ActionStepMarker._im_server)
-        ActionStepMarker._im_server.applyChanges()
+        ActionStepMarker._apply_changes()
         self.update_viz()
 
     def marker_feedback_cb(self, feedback):
@@ -522,14 +743,58 @@ class ActionStepMarker:
     # ##################################################################
 
     def _is_reachable(self):
-        """Checks and returns whether there is an IK solution for this
-        action step.
+        """Returns whether there is an IK solution for this action step.
+
+        This doesn't wait for IK: if the target changed since the last
+        check, a new one is started in the background and the marker is
+        rendered again once it finishes.
 
         Returns:
-            bool: Whether this action step is reachable.
+            bool|None: Whether this action step is reachable, or None if
+                that isn't known yet.
+        """
+        target = self.get_target()
+        key = (target.refFrame, get_pose_row(target.ee_pose),
+               get_pose_row(target.refFrameLandmark.pose))
+        if key != self._reachability_target:
+            # This also cancels the check for the previous target.
+            self._reachability_target = key
+            self._reachability = None
+            ActionStepMarker._reachability_pool.request(
+                self, self.arm_index, copy.deepcopy(target),
+                lambda is_reachable: self._reachability_cb(key,
+                                                           is_reachable))
+        return self._reachability
+
+    def _reachability_cb(self, key, is_reachable):
+        """Callback for when a reachability check finishes (called on a
+        reachability worker thread).
+
+        This only records the result: the action step may be changing
+        meanwhile, so rendering it is left to the owner of the marker
+        (see viz_changed_cb).
+
+        Args:
+            key (tuple): The target that was checked.
+            is_reachable (bool): Whether it is reachable.
+        """
+        ActionStepMarker._im_lock.acquire()
+        # The step may have changed (or been destroyed) in the meantime.
+        is_current = key == self._reachability_target
+        if is_current:
+            self._log_reachability(is_reachable)
+            self._reachability = is_reachable
+        ActionStepMarker._im_lock.release()
+        if is_current and self._viz_changed_cb is not None:
+            self._viz_changed_cb(self)
+
+    def _log_reachability(self, is_reachable):
+        """Logs the reachability of this action step if it's the first
+        one known or it changed.
+
+        Args:
+            is_reachable (bool): Whether this action step is reachable.
         """
-        dummy, is_reachable = Arms.solve_ik_for_arm(self.arm_index,
-                                                    self.get_target())
         # A bit more complicated logging to avoid spamming the logs
         # while still giving useful info. It now logs when reachability
         # is first calculated, or changes.
@@ -551,9 +816,7 @@ class ActionStepMarker:
             rospy.loginfo('Pose (' + str(self.step_number) + ', ' +
                           self.arm_name + ') ' + reachable_str)
 
-        # Cache and return.
         self._prev_is_reachable = is_reachable
-        return is_reachable
 
     def _get_name(self):
         """Generates the unique name for the marker.
@@ -564,28 +827,58 @@ class ActionStepMarker:
         return 'step' + str(self.step_number) + 'arm' + str(self.arm_index)
 
     def _update_menu(self):
-        """Recreates the menu when something has changed."""
+        """Updates the menu when something has changed. The menu is only
+        made again when the reference frames changed; otherwise only
+        the checked reference frame may change."""
+        with ActionStepMarker.batch_update():
+            menu_revision = self._get_menu_revision()
+            if menu_revision == self._menu_revision:
+                # The menu is the same; only the marker may need updating.
+                if self._get_menu_id(self._get_ref_name()) is None:
+                    self.has_object = False
+                self.update_viz()
+                return
+            self._menu_revision = menu_revision
+            ref_frames = ActionStepMarker._ref_frames
+            version, template = ref_frames.get_menu_template()
+            if version != self._menu_version:
+                self._make_menu(template)
+                self._menu_version = version
+
+            # Check the current reference frame, if there is one.
+            menu_id = self._get_menu_id(self._get_ref_name())
+            if menu_id is None:
+                self.has_object = False
+            self._set_checked_menu_id(menu_id)
+
+            # Update.
+            self._update_viz_core()
+            self._menu_handler.apply(ActionStepMarker._im_server,
+                                     self._get_name())
+            ActionStepMarker._apply_changes()
+
+    def _make_menu(self, template):
+        """Makes the menu handler from the reference frame menu template.
+
+        Args:
+            template (((str, str|None))): See
+                RefFrameRegistry.get_menu_template().
+        """
         self._menu_handler = MenuHandler()
+        self._menu_entries = []
+        self._menu_positions = {}
+        self._checked_menu_id = None
 
-        # Insert sub entries.
-        self._sub_entries = []
-        self._menu_options = []
+        # Insert sub entries, all unchecked to start.
         frame_entry = self._menu_handler.insert(MENU_OPTIONS['ref'])
-        refs = ActionStepMarker._ref_names
-        for ref in refs:
-            if ref != BASE_LINK and "Obj" not in str(ref):
-                subent = self._menu_handler.insert(
-                    ref + ' center', parent=frame_entry, callback=self.subent_cb)
-                self._sub_entries += [subent]
-                self._menu_options += [subent]
-            elif ref == BASE_LINK:
-                subent = self._menu_handler.insert(
-                        ref, parent=frame_entry, callback=self.subent_cb)
-                self._sub_entries += [subent]
-                self._menu_options += [subent]
-        select_one = self._menu_handler.insert(
-            'Select an object side', parent=frame_entry, callback=self.select_one_cb)
-        self._menu_options += [select_one]
+        for title, ref_name in template:
+            callback = self.subent_cb if ref_name is not None else (
+                self.select_one_cb)
+            menu_id = self._menu_handler.insert(
+                title, parent=frame_entry, callback=callback)
+            self._menu_handler.setCheckState(menu_id, MenuHandler.UNCHECKED)
+            self._menu_positions[menu_id] = len(self._menu_entries)
+            self._menu_entries.append(menu_id)
 
         # Inset main menu entries.
         self._menu_handler.insert(MENU_OPTIONS['move_here'],
@@ -595,22 +888,19 @@ class ActionStepMarker:
         self._menu_handler.insert(MENU_OPTIONS['del'],
                                   callback=self.delete_step_cb)
 
-        # Make all unchecked to start.
-        for subent in self._sub_entries:
-            self._menu_handler.setCheckState(subent, MenuHandler.UNCHECKED)
-        self._menu_handler.setCheckState(select_one, MenuHandler.UNCHECKED)
+    def _set_checked_menu_id(self, menu_id):
+        """Checks one reference frame menu entry (and unchecks the one
+        that was checked).
 
-        # Check if necessary. Set base_link to checked
-        menu_id = self._get_menu_id(self._get_ref_name())
-        if menu_id is None:
-            self.has_object = False
-        else:
+        Args:
+            menu_id (int|None): The entry to check, or None for none.
+        """
+        if self._checked_menu_id is not None:
+            self._menu_handler.setCheckState(self._checked_menu_id,
+                                             MenuHandler.UNCHECKED)
+        if menu_id is not None:
             self._menu_handler.setCheckState(menu_id, MenuHandler.CHECKED)
-
-        # Update.
-        self._update_viz_core()
-        self._menu_handler.apply(ActionStepMarker._im_server, self._get_name())
-        ActionStepMarker._im_server.applyChanges()
+        self._checked_menu_id = menu_id
 
     def _get_menu_id(self, ref_name):
         """Returns the unique menu id from its name or None if the
@@ -619,14 +909,10 @@ class ActionStepMarker:
         Returns:
             int (?)|None
         """
-        if ref_name in ActionStepMarker._ref_names:
-            index = ActionStepMarker._ref_names.index(ref_name)
-            if "Obj" in ref_name:
-                return (self._menu_options[-1])
-            else:
-                return self._menu_options[index]
-        else:
+        position = ActionStepMarker._ref_frames.get_menu_position(ref_name)
+        if position is None or position >= len(self._menu_entries):
             return None
+        return self._menu_entries[position]
 
     def _get_menu_name(self, menu_id):
         """Returns the menu name from its unique menu id.
@@ -634,8 +920,8 @@ class ActionStepMarker:
         Returns:
             str
         """
-        index = self._menu_options.index(menu_id)
-        return ActionStepMarker._ref_names[index]
+        version, template = ActionStepMarker._ref_frames.get_menu_template()
+        return template[self._menu_positions[menu_id]][1]
 
     def _get_ref_name(self):
         """Returns the name string for the reference frame object of the
@@ -677,8 +963,8 @@ class ActionStepMarker:
         # Get the id of the new ref (an int).
         new_ref = world.get_ref_from_name(new_ref_name)
         if new_ref != ArmState.ROBOT_BASE:
-            index = ActionStepMarker._ref_names.index(new_ref_name)
-            new_ref_obj = ActionStepMarker._ref_object_list[index - 1]
+            new_ref_obj = ActionStepMarker._ref_frames.get_landmark(
+                new_ref_name)
         else:
             new_ref_obj = Landmark()
 
@@ -693,11 +979,7 @@ class ActionStepMarker:
             # Handle trajectory steps.
             t = self.action_step.armTrajectory
             arm = t.rArm if self.arm_index == Side.RIGHT else t.lArm
-            for i in range(len(arm)):
-                arm_old = arm[i]
-                arm_new = world.convert_ref_frame(arm_old, new_ref,
-                                                  new_ref_obj)
-                arm[i] = arm_new
+            arm[:] = world.convert_ref_frames(arm, new_ref, new_ref_obj)
             # Fix up reference frames.
             if self.arm_index == Side.RIGHT:
                 t.rRefFrameLandmark = new_ref_obj
@@ -705,6 +987,13 @@ class ActionStepMarker:
             else:
                 t.lRefFrameLandmark = new_ref_obj
                 t.lRefFrame = new_ref
+        self._step_changed()
+
+    def _step_changed(self):
+        """Lets the owner of this marker know that it changed the
+        action step."""
+        if self._step_changed_cb is not None:
+            self._step_changed_cb(self.step_number - 1)
 
     def _is_hand_open(self):
         """Returns whether the gripper is open for this action step.
@@ -736,8 +1025,46 @@ class ActionStepMarker:
                 'Cannot request trajectory pose on non-trajectory action ' +
                 'step.')
 
+    def _get_revision(self):
+        """Returns what the marker is rendered from: the step number,
+        whether the controls are shown, the gripper state, the
+        reference frame, the pose and its reachability.
+
+        Returns:
+            tuple|None: None for trajectories, which are always
+                rendered again.
+        """
+        if self.action_step.type != ActionStep.ARM_TARGET:
+            return None
+        target = self.get_target()
+        return (self.step_number, self.is_control_visible,
+                self._is_hand_open(), self._get_ref_name(), target.refFrame,
+                get_pose_row(target.ee_pose),
+                get_pose_row(target.refFrameLandmark.pose),
+                self._is_reachable())
+
+    def _get_menu_revision(self):
+        """Returns what the menu is made from: the marker's name, the
+        version of the available reference frames and the current one.
+
+        Returns:
+            tuple
+        """
+        return (self._get_name(), ActionStepMarker._ref_frames.get_version(),
+                self._get_ref_name())
+
     def _update_viz_core(self):
-        """Updates visualization after a change."""
+        """Updates visualization after a change, unless nothing it
+        shows changed since it was last rendered.
+
+        Returns:
+            bool: Whether the marker was rendered again.
+        """
+        revision = self._get_revision()
+        if revision is not None and revision == self._revision:
+            return False
+        self._revision = revision
+
         # Create a new IM control.
         menu_control = InteractiveMarkerControl()
         menu_control.interaction_mode = InteractiveMarkerControl.BUTTON
@@ -824,6 +1151,7 @@ class ActionStepMarker:
         self._add_6dof_marker(int_marker, True)
         int_marker.controls.append(menu_control)
         ActionStepMarker._im_server.insert(int_marker, self.marker_feedback_cb)
+        return True
 
     def _add_6dof_marker(self, int_marker, is_fixed):
         """Adds a 6 DoF control marker to the interactive marker.
@@ -902,7 +1230,10 @@ class ActionStepMarker:
         Returns:
             ColorRGBA: The color for the gripper mesh for this step.
         """
-        if self._is_reachable():
+        is_reachable = self._is_reachable()
+        if is_reachable is None:
+            return COLOR_MESH_UNKNOWN
+        elif is_reachable:
             return COLOR_MESH_REACHABLE
         else:
             return COLOR_MESH_UNREACHABLE
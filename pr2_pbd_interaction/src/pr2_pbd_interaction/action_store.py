@@ -0,0 +1,252 @@
+'''An append-only file that holds the steps of all of an experiment's
+actions.'''
+
+# ######################################################################
+# Imports
+# ######################################################################
+
+# Core ROS imports come first.
+import roslib
+roslib.load_manifest('pr2_pbd_interaction')
+import rospy
+
+# System builtins
+from cStringIO import StringIO
+import mmap
+import os
+import struct
+import threading
+
+# Local
+from pr2_pbd_interaction.msg import ActionStepSequence
+
+# ######################################################################
+# Module level constants
+# ######################################################################
+
+STORE_FILENAME = 'actions.store'
+
+# Each record is this header (the lengths of the action id and of the
+# serialized ActionStepSequence), then the action id, then the
+# serialized ActionStepSequence.
+RECORD_HEADER = struct.Struct('<II')
+
+# Compact on open when at least this fraction of the file is records
+# that were superseded by later ones.
+COMPACT_GARBAGE_RATIO = 0.5
+
+# ######################################################################
+# Classes
+# ######################################################################
+
+
+class ActionStore(object):
+    '''Stores the steps of actions in a single append-only file.
+
+    Saving an action appends one record to the file, so it only costs
+    the size of that action; actions that didn't change aren't written
+    at all. An index from action id to the offset of its latest record
+    is built when the file is opened, and records are read from a
+    memory map of the file, without re-opening or scanning it.
+
+    Superseded records are only removed by compact(), which rewrites the
+    file and should be run while nothing is being saved (e.g. when a
+    session starts).
+    '''
+
+    def __init__(self, data_dir, filename=STORE_FILENAME):
+        '''
+        Args:
+            data_dir (str): Directory that holds the store file.
+            filename (str, optional): Name of the store file. Defaults
+                to STORE_FILENAME.
+        '''
+        self._lock = threading.Lock()
+        self._path = os.path.join(data_dir, filename)
+        # action id -> (payload offset, payload length)
+        self._index = {}
+        self._size = 0
+        self._garbage_size = 0
+        self._file = None
+        self._map = None
+        self._open()
+
+    # ##################################################################
+    # Instance methods: Public (API)
+    # ##################################################################
+
+    def has_action(self, action_id):
+        '''Returns whether the store holds steps for an action.
+
+        Args:
+            action_id (str): The id of the action.
+
+        Returns:
+            bool
+        '''
+        with self._lock:
+            return str(action_id) in self._index
+
+    def save(self, action_id, seq):
+        '''Saves the steps of an action, unless they are the same as the
+        ones saved last.
+
+        Args:
+            action_id (str): The id of the action.
+            seq (ActionStepSequence): The steps of the action.
+
+        Returns:
+            bool: Whether anything was written.
+        '''
+        key = str(action_id)
+        buff = StringIO()
+        seq.serialize(buff)
+        payload = buff.getvalue()
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and self._read(*entry) == payload:
+                return False
+            header = RECORD_HEADER.pack(len(key), len(payload))
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(header + key + payload)
+            self._file.flush()
+            offset = self._size + RECORD_HEADER.size + len(key)
+            self._size = offset + len(payload)
+            if entry is not None:
+                self._garbage_size += RECORD_HEADER.size + len(key) + entry[1]
+            self._index[key] = (offset, len(payload))
+        return True
+
+    def load(self, action_id):
+        '''Loads the latest saved steps of an action.
+
+        Args:
+            action_id (str): The id of the action.
+
+        Returns:
+            ActionStepSequence|None: None if the store doesn't hold the
+                action.
+        '''
+        with self._lock:
+            entry = self._index.get(str(action_id))
+            if entry is None:
+                return None
+            payload = self._read(*entry)
+        return ActionStepSequence().deserialize(payload)
+
+    def compact(self):
+        '''Rewrites the file with only the latest record of each action.
+        '''
+        with self._lock:
+            if self._garbage_size == 0:
+                return
+            tmp_path = self._path + '.tmp'
+            with open(tmp_path, 'wb') as tmp_file:
+                for key, entry in self._index.iteritems():
+                    payload = self._read(*entry)
+                    tmp_file.write(RECORD_HEADER.pack(len(key), len(payload)))
+                    tmp_file.write(key)
+                    tmp_file.write(payload)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            self._close()
+            os.rename(tmp_path, self._path)
+            self._open_locked()
+        rospy.loginfo('Compacted action store ' + self._path)
+
+    def close(self):
+        '''Closes the store file.'''
+        with self._lock:
+            self._close()
+
+    # ##################################################################
+    # Instance methods: Internal ("private")
+    # ##################################################################
+
+    def _open(self):
+        '''Opens the store file, building the index, and compacts it if
+        it has much garbage.'''
+        with self._lock:
+            self._open_locked()
+        if (self._size > 0 and
+                self._garbage_size >= COMPACT_GARBAGE_RATIO * self._size):
+            self.compact()
+
+    def _open_locked(self):
+        '''Opens (creating if needed) the store file and builds the index
+        by scanning the record headers.
+
+        NOTE: self._lock should be acquired before calling this method.
+        '''
+        self._file = open(self._path, 'ab+')
+        self._file.seek(0, os.SEEK_END)
+        self._size = self._file.tell()
+        self._map = None
+        self._index = {}
+        self._garbage_size = 0
+        self._remap()
+        offset = 0
+        while offset + RECORD_HEADER.size <= self._size:
+            key_len, payload_len = RECORD_HEADER.unpack_from(self._map,
+                                                             offset)
+            record_end = offset + RECORD_HEADER.size + key_len + payload_len
+            if record_end > self._size:
+                break
+            key_start = offset + RECORD_HEADER.size
+            key = self._map[key_start:key_start + key_len]
+            prev = self._index.get(key)
+            if prev is not None:
+                self._garbage_size += RECORD_HEADER.size + key_len + prev[1]
+            self._index[key] = (key_start + key_len, payload_len)
+            offset = record_end
+        if offset < self._size:
+            # A save was interrupted; drop the partial record.
+            rospy.logwarn('Dropping partial record at the end of ' +
+                          self._path)
+            self._map.close()
+            self._map = None
+            self._file.truncate(offset)
+            self._size = offset
+            self._remap()
+
+    def _remap(self):
+        '''Maps the whole file into memory (if it isn't empty).
+
+        NOTE: self._lock should be acquired before calling this method.
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._size > 0:
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+
+    def _read(self, offset, length):
+        '''Returns the bytes of the file at offset.
+
+        NOTE: self._lock should be acquired before calling this method.
+
+        Args:
+            offset (int)
+            length (int)
+
+        Returns:
+            str
+        '''
+        if self._map is None or offset + length > len(self._map):
+            # The file grew since it was mapped.
+            self._remap()
+        return self._map[offset:offset + length]
+
+    def _close(self):
+        '''Unmaps and closes the store file.
+
+        NOTE: self._lock should be acquired before calling this method.
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
@@ -124,7 +124,7 @@ class Arms:
             return True
 
     @staticmethod
-    def solve_ik_for_arm(arm_index, arm_state, z_offset=0.0):
+    def solve_ik_for_arm(arm_index, arm_state, z_offset=0.0, ik_srv=None):
         '''Finds an  IK solution for a particular arm pose.
 
         Args:
@@ -132,6 +132,10 @@ class Arms:
             arm_state (ArmState): The arm's state,
             z_offset (float, optional): Offset to add to z-values of
                 pose positions. Defaults to 0.0.
+            ik_srv (rospy.ServiceProxy, optional): IK service proxy to
+                use, as made by Arm.create_ik_service(). Threads other
+                than the main one should pass their own. Defaults to
+                None, which uses the arm's own proxy.
 
         Returns:
             (ArmState, bool): Tuple of
@@ -155,14 +159,14 @@ class Arms:
         if arm_state.refFrame == ArmState.OBJECT:
             # Arm is relative.
             solution = ArmState()
-            target_pose_state = world.convert_ref_frame(arm_state,
-                                                        ArmState.ROBOT_BASE)
-            target_pose = target_pose_state.ee_pose
-            target_pose.position.z = target_pose.position.z + z_offset
+            abs_pose = world.get_absolute_pose(arm_state)
+            pos = abs_pose.position
+            target_pose = Pose(Point(pos.x, pos.y, pos.z + z_offset),
+                               abs_pose.orientation)
 
             # Try solving IK.
             target_joints = Arms.arms[arm_index].get_ik_for_ee(
-                target_pose, arm_state.joint_pose)
+                target_pose, arm_state.joint_pose, ik_srv)
 
             # Check whether solution found.
             if target_joints is None:
@@ -185,7 +189,7 @@ class Arms:
 
             # Try solving IK.
             target_joints = Arms.arms[arm_index].get_ik_for_ee(
-                target_pose, arm_state.joint_pose)
+                target_pose, arm_state.joint_pose, ik_srv)
             if target_joints is None:
                 # No IK found; return the original.
                 rospy.logdebug('No IK for absolute end-effector pose.')
@@ -301,7 +305,9 @@ class Arms:
             z_offset (float): Amount to add to z-values of pose
                 positions.
         '''
-        # This will take long; create a thread.
+        # Execute a snapshot of the action, so that editing the action
+        # while it executes doesn't change what is executed. Taking it
+        # is cheap; the rest will take long, so create a thread.
         self.action = action.copy()
         self.preempt = False
         self.z_offset = z_offset
@@ -323,46 +329,47 @@ class Arms:
                 action.
         '''
         # Go over steps of the action, checking the type for each and
-        # solving IK.
+        # solving IK. Steps are copies; the solutions are written back
+        # with set_step(...).
         for i in range(self.action.n_frames()):
+            step = self.action.get_step(i)
             # See whether this step is an arm target step.
-            if self.action.seq.seq[i].type == ActionStep.ARM_TARGET:
+            if step.type == ActionStep.ARM_TARGET:
                 # Solve IK for both arms.
                 r_arm, has_solution_r = Arms.solve_ik_for_arm(
-                    Side.RIGHT, self.action.seq.seq[i].armTarget.rArm,
-                    self.z_offset)
+                    Side.RIGHT, step.armTarget.rArm, self.z_offset)
                 l_arm, has_solution_l = Arms.solve_ik_for_arm(
-                    Side.LEFT, self.action.seq.seq[i].armTarget.lArm,
-                    self.z_offset)
-                self.action.seq.seq[i].armTarget.rArm = r_arm
-                self.action.seq.seq[i].armTarget.lArm = l_arm
+                    Side.LEFT, step.armTarget.lArm, self.z_offset)
+                step.armTarget.rArm = r_arm
+                step.armTarget.lArm = l_arm
+                self.action.set_step(i, step)
 
                 # If either doesn't have a solution, we return false.
                 if not has_solution_r or not has_solution_l:
                     return False
 
             # See whether this step is an arm trajectory step.
-            if self.action.seq.seq[i].type == ActionStep.ARM_TRAJECTORY:
+            if step.type == ActionStep.ARM_TRAJECTORY:
                 # If it's an arm trajectory, we have to check all arm
                 # targets within the trajectory.
-                n_frames = len(self.action.seq.seq[i].armTrajectory.timing)
+                n_frames = len(step.armTrajectory.timing)
                 for j in range(n_frames):
                     # Solve IK for both arms.
                     r_arm, has_solution_r = Arms.solve_ik_for_arm(
-                        Side.RIGHT,
-                        self.action.seq.seq[i].armTrajectory.rArm[j],
+                        Side.RIGHT, step.armTrajectory.rArm[j],
                         self.z_offset)
                     l_arm, has_solution_l = Arms.solve_ik_for_arm(
-                        Side.LEFT,
-                        self.action.seq.seq[i].armTrajectory.lArm[j],
+                        Side.LEFT, step.armTrajectory.lArm[j],
                         self.z_offset)
-                    self.action.seq.seq[i].armTrajectory.rArm[j] = r_arm
-                    self.action.seq.seq[i].armTrajectory.lArm[j] = l_arm
+                    step.armTrajectory.rArm[j] = r_arm
+                    step.armTrajectory.lArm[j] = l_arm
 
                     # If either doesn't have a solution, we return
                     # false.
                     if not has_solution_r or not has_solution_l:
+                        self.action.set_step(i, step)
                         return False
+                self.action.set_step(i, step)
         # Because no steps returned False, at the point everything is
         # good and we can signal a complete IK solution.
         return True
@@ -0,0 +1,189 @@
+'''The result of an operation that finishes in the background.'''
+
+# ######################################################################
+# Imports
+# ######################################################################
+
+# Core ROS imports come first.
+import rospy
+
+# System builtins
+import threading
+
+# ######################################################################
+# Classes
+# ######################################################################
+
+
+class ResultTimeoutError(Exception):
+    '''Raised by AsyncResult.result(...) when the operation doesn't
+    finish in time.'''
+    pass
+
+
+class AsyncResult(object):
+    '''Holds the result of an operation that finishes later, e.g. on an
+    action client's or a worker thread.
+
+    Callers that need the result can block on result(); callers that
+    don't can register done-callbacks instead. Only the first
+    set_result(...) / set_exception(...) counts; later ones are ignored,
+    so e.g. a timeout and a late completion can race safely.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    @staticmethod
+    def completed(result):
+        '''Returns an AsyncResult that is already done.
+
+        Args:
+            result: The result.
+
+        Returns:
+            AsyncResult
+        '''
+        async_result = AsyncResult()
+        async_result.set_result(result)
+        return async_result
+
+    def done(self):
+        '''Returns whether the operation has finished.
+
+        Returns:
+            bool
+        '''
+        return self._done_event.is_set()
+
+    def wait(self, timeout=None):
+        '''Waits for the operation to finish.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most. Defaults
+                to None, which waits for as long as it takes.
+
+        Returns:
+            bool: Whether the operation has finished.
+        '''
+        # Event.wait without a timeout can't be interrupted in Python 2,
+        # so wait in slices.
+        if timeout is None:
+            while not self._done_event.wait(1.0):
+                pass
+            return True
+        return self._done_event.wait(timeout)
+
+    def result(self, timeout=None):
+        '''Returns the result, waiting for the operation to finish.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most. Defaults
+                to None, which waits for as long as it takes.
+
+        Returns:
+            The result passed to set_result(...).
+
+        Raises:
+            ResultTimeoutError: If the operation didn't finish in time.
+            Exception: What was passed to set_exception(...), if the
+                operation failed.
+        '''
+        if not self.wait(timeout):
+            raise ResultTimeoutError(
+                'Operation did not finish within ' + str(timeout) + ' s')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        '''Calls callback with this AsyncResult once it is done.
+
+        If it is already done, callback is called right away (on this
+        thread); otherwise it is called on the thread that finishes the
+        operation.
+
+        Args:
+            callback (function(AsyncResult))
+        '''
+        self._lock.acquire()
+        is_done = self.done()
+        if not is_done:
+            self._callbacks.append(callback)
+        self._lock.release()
+        if is_done:
+            self._run_callback(callback)
+
+    def then(self, function):
+        '''Chains another step after this operation.
+
+        Args:
+            function (function): Called with this operation's result once
+                it is done.
+
+        Returns:
+            AsyncResult: Resolves to what function returns. If this
+                operation or function fails, it fails with the same
+                error.
+        '''
+        chained = AsyncResult()
+
+        def chain(__):
+            try:
+                chained.set_result(function(self.result()))
+            except Exception, e:
+                chained.set_exception(e)
+        self.add_done_callback(chain)
+        return chained
+
+    def set_result(self, result):
+        '''Finishes the operation with result.
+
+        Args:
+            result: The result.
+        '''
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        '''Finishes the operation with an error.
+
+        Args:
+            exception (Exception)
+        '''
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        '''Stores the outcome (if this is the first one) and runs the
+        done-callbacks.
+
+        Args:
+            result: The result, if the operation succeeded.
+            exception (Exception|None): The error, if it failed.
+        '''
+        self._lock.acquire()
+        if self.done():
+            self._lock.release()
+            return
+        self._result = result
+        self._exception = exception
+        self._done_event.set()
+        callbacks, self._callbacks = self._callbacks, []
+        self._lock.release()
+        for callback in callbacks:
+            self._run_callback(callback)
+
+    def _run_callback(self, callback):
+        '''Runs a done-callback, logging rather than propagating its
+        errors so one bad callback doesn't stop the others.
+
+        Args:
+            callback (function(AsyncResult))
+        '''
+        try:
+            callback(self)
+        except Exception, e:
+            rospy.logerr('Error in done-callback: ' + str(e))
@@ -1,15 +1,335 @@
-from pr2_pbd_interaction.msg import Action
+from pr2_pbd_interaction.msg import Action, ActionStepSequence
 from mongo_msg_db_msgs.msg import Message
 from mongo_msg_db_msgs.srv import Find, FindRequest
 from mongo_msg_db_msgs.srv import Insert, InsertRequest
 from mongo_msg_db_msgs.srv import Update, UpdateRequest
 from rospy_message_converter import json_message_converter
 
+from collections import OrderedDict
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+import base64
+import json
+import threading
+import time
+import zlib
+
 import rospy
 
+# Updates are written this long after the last update of the same
+# action, so bursts of edits are written once.
+WRITE_BEHIND_DELAY = 0.5  # seconds
+
+# How much memory found actions may take up in the cache, as estimated
+# by the size of their serialized form (see get_msg_size()).
+FIND_CACHE_BYTES = 64 * 1024 * 1024
+
+# How many threads make the service calls (and decode the results) of
+# bulk operations and of batches of updates.
+BULK_THREADS = 8
+
+# The codec new and updated actions are stored with (see CODECS). The
+# binary codecs are faster and smaller, but other tools can't read what
+# they store, so they have to be chosen with the ~action_codec param.
+DEFAULT_CODEC = 'json'
+PARAM_CODEC = '~action_codec'
+
+# Key of the codec name in documents stored by binary codecs. Documents
+# without it are JSON (as made by rospy_message_converter).
+CODEC_KEY = '_codec'
+
+
+class JsonCodec(object):
+    """Stores msgs as JSON documents, with rospy_message_converter.
+
+    This is slow, but the documents can be read (and queried) by other
+    tools.
+    """
+
+    def __init__(self):
+        self.name = 'json'
+
+    def encode(self, msg):
+        """Returns the document to store for msg.
+
+        Args:
+            msg: The msg to encode.
+
+        Returns: string, the JSON document.
+        """
+        return json_message_converter.convert_ros_message_to_json(msg)
+
+    def decode(self, msg_type, doc):
+        """Returns the msg stored in a document made by encode().
+
+        Args:
+            msg_type: string, the type of the msg, e.g.
+                'pr2_pbd_interaction/Action'.
+            doc: string, the JSON document.
+
+        Returns: The decoded msg.
+        """
+        return json_message_converter.convert_json_to_ros_message(msg_type,
+                                                                  doc)
+
+
+class BinaryCodec(object):
+    """Stores msgs in their (genpy) serialized form, optionally
+    compressed with zlib.
+
+    Documents are small JSON objects holding the codec name, the msg
+    type and its md5sum (so msgs whose definition changed since they
+    were stored are rejected rather than misread) and the serialized
+    msg in base64.
+    """
+
+    def __init__(self, is_compressed=True):
+        """Initialize this BinaryCodec.
+
+        Args:
+            is_compressed: bool, whether to compress serialized msgs.
+        """
+        self.name = 'genpy_zlib' if is_compressed else 'genpy'
+        self._is_compressed = is_compressed
+
+    def encode(self, msg):
+        """Returns the document to store for msg.
+
+        Args:
+            msg: The msg to encode.
+
+        Returns: string, the document.
+        """
+        buff = StringIO()
+        msg.serialize(buff)
+        data = buff.getvalue()
+        if self._is_compressed:
+            data = zlib.compress(data)
+        return json.dumps({
+            CODEC_KEY: self.name,
+            'msg_type': msg._type,
+            'md5sum': msg._md5sum,
+            'data': base64.b64encode(data),
+        })
+
+    def decode(self, msg_type, doc):
+        """Returns the msg stored in a document made by encode().
+
+        Args:
+            msg_type: string, the type of the msg, e.g.
+                'pr2_pbd_interaction/Action'.
+            doc: string or dict, the document (or it parsed).
+
+        Returns: The decoded msg.
+
+        Raises: ValueError if the msg definition changed since the msg
+            was stored.
+        """
+        if not isinstance(doc, dict):
+            doc = json.loads(doc)
+        msg_class = MSG_CLASSES[msg_type]
+        if doc['md5sum'] != msg_class._md5sum:
+            raise ValueError(
+                'Stored {} has md5sum {}, but the current one is {}'.format(
+                    msg_type, doc['md5sum'], msg_class._md5sum))
+        data = base64.b64decode(doc['data'])
+        if self._is_compressed:
+            data = zlib.decompress(data)
+        return msg_class().deserialize(data)
+
+
+# The msg types binary codecs can decode.
+MSG_CLASSES = {Action._type: Action}
+
+# All codecs, by name.
+CODECS = dict((codec.name, codec) for codec in
+              [JsonCodec(), BinaryCodec(False), BinaryCodec(True)])
+
+
+def get_msg_size(msg):
+    """Returns an estimate of how much memory a decoded msg takes.
+
+    This is the length of its uncompressed serialized form, so it
+    doesn't depend on the codec the msg was stored with.
+
+    Args:
+        msg: The msg to measure.
+
+    Returns: int, the estimated size in bytes.
+    """
+    buff = StringIO()
+    msg.serialize(buff)
+    return buff.tell()
+
+
+def decode_msg(msg_type, doc):
+    """Returns the msg stored in a document made by any codec.
+
+    Args:
+        msg_type: string, the type of the msg, e.g.
+            'pr2_pbd_interaction/Action'.
+        doc: string, the document.
+
+    Returns: The decoded msg.
+    """
+    # Check for the codec key before parsing, so JSON documents (which
+    # can be big) aren't parsed twice.
+    if '"' + CODEC_KEY + '"' in doc:
+        parsed = json.loads(doc)
+        if CODEC_KEY in parsed:
+            return CODECS[parsed[CODEC_KEY]].decode(msg_type, parsed)
+    return CODECS['json'].decode(msg_type, doc)
+
+
+class ActionCache(object):
+    """A least-recently-used cache of decoded Action msgs, bounded by
+    their total size in bytes (see get_msg_size()).
+
+    Every invalidation starts a new generation; put() ignores values
+    that were looked up in an earlier one, so a find() that races with
+    an update() never caches the old version.
+    """
+
+    def __init__(self, max_bytes=FIND_CACHE_BYTES):
+        """Initialize this ActionCache.
+
+        Args:
+            max_bytes: int, the most bytes the cached actions may take.
+        """
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        # ID -> (Action, size), least recently used first.
+        self._entries = OrderedDict()
+        self._n_bytes = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_generation(self):
+        """Returns the current generation, to pass to put()."""
+        return self._generation
+
+    def get(self, db_id):
+        """Returns the cached action with the given ID.
+
+        Args:
+            db_id: string, the ID of the action.
+
+        Returns: An Action msg, or None if it isn't cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(db_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[db_id] = entry
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, db_id):
+        """Returns the cached action with the given ID, without counting
+        it as a lookup or making it recently used.
+
+        Args:
+            db_id: string, the ID of the action.
+
+        Returns: An Action msg, or None if it isn't cached.
+        """
+        with self._lock:
+            entry = self._entries.get(db_id)
+            return None if entry is None else entry[0]
+
+    def put(self, db_id, action, size, generation):
+        """Caches an action, evicting the least recently used ones if
+        needed.
+
+        Args:
+            db_id: string, the ID of the action.
+            action: The Action msg. It must not be changed afterwards.
+            size: int, the size of the action in bytes.
+            generation: int, what get_generation() returned before the
+                action was looked up.
+        """
+        with self._lock:
+            if generation != self._generation or size > self._max_bytes:
+                return
+            self._remove(db_id)
+            self._entries[db_id] = (action, size)
+            self._n_bytes += size
+            while self._n_bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, db_id):
+        """Drops the action with the given ID from the cache.
+
+        Args:
+            db_id: string, the ID of the action.
+        """
+        with self._lock:
+            self._generation += 1
+            self._remove(db_id)
+
+    def get_stats(self):
+        """Returns statistics about the cache.
+
+        Returns: dict with the number of hits and misses ('hits',
+            'misses'), the hit rate ('hit_rate'), the number of cached
+            actions ('n_entries') and the bytes they take ('n_bytes',
+            at most 'max_bytes').
+        """
+        with self._lock:
+            n_lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / n_lookups if n_lookups else 0.0,
+                'n_entries': len(self._entries),
+                'n_bytes': self._n_bytes,
+                'max_bytes': self._max_bytes,
+            }
+
+    def _remove(self, db_id):
+        """Removes an entry, if there is one. The lock should be held
+        when calling this.
+        """
+        entry = self._entries.pop(db_id, None)
+        if entry is not None:
+            self._n_bytes -= entry[1]
+
 
 class ActionDatabase(object):
-    def __init__(self, db_name, coll_name, find, insert, update):
+    """Stores actions in the mongo_msg_db database.
+
+    Updates are write-behind: update() only records the latest Action
+    for its ID, and a background thread writes it once the action has
+    not changed for WRITE_BEHIND_DELAY seconds (or sooner when a flush
+    is requested). find() sees pending updates. An update that fails to
+    be written is pending again (unless a newer one is), and is retried
+    after the delay.
+
+    Edits of single steps can be made as deltas (append_step(),
+    remove_step(), replace_step(), rename()), which don't need the whole
+    Action msg from the caller. mongo_msg_db only replaces whole
+    documents, so deltas are applied to the latest version of the action
+    held here (a pending update or a cached action) and written with the
+    next update. If there is no such version, or it doesn't have the
+    number of steps the caller expects, the delta is a conflict and the
+    caller has to update() the whole action instead.
+
+    Found actions are cached (see ActionCache), so finding an action
+    again doesn't go to the database.
+
+    Many actions can be found, inserted or updated at once (find_many(),
+    insert_many(), update_many()). mongo_msg_db takes one action per
+    call, so these skip the calls they can (actions held here, repeated
+    IDs) and make the rest concurrently on a pool of threads, which also
+    encode and decode the actions. Updates that are due together are
+    written the same way.
+    """
+
+    def __init__(self, db_name, coll_name, find, insert, update,
+                 write_delay=WRITE_BEHIND_DELAY, cache_bytes=FIND_CACHE_BYTES,
+                 codec=DEFAULT_CODEC):
         """Initialize this ActionDatabase.
 
         Args:
@@ -18,6 +338,12 @@ class ActionDatabase(object):
             find: the rospy.ServiceProxy for searching the database.
             insert: the rospy.ServiceProxy for inserting into the database.
             update: the rospy.ServiceProxy for updating the database.
+            write_delay: float, seconds to wait for more updates of an
+                action before writing it.
+            cache_bytes: int, the most bytes that found actions may take
+                in the cache.
+            codec: string, the name of the codec (see CODECS) to store
+                actions with. Actions stored with any codec can be read.
         """
         self._db_name = db_name
         self._collection_name = coll_name
@@ -25,6 +351,28 @@ class ActionDatabase(object):
         self._insert = insert
         self._update = update
         self._MSG_TYPE = 'pr2_pbd_interaction/Action'
+        self._codec = CODECS[codec]
+
+        # Write-behind state: ID -> (Action, time of the last update),
+        # oldest first.
+        self._write_delay = write_delay
+        self._write_cond = threading.Condition()
+        self._pending = OrderedDict()
+        # ID -> Action being written.
+        self._writing = {}
+        self._is_flush_requested = False
+        self._n_writes = 0
+        self._n_coalesced = 0
+        self._n_failures = 0
+        self._last_write_latency = 0.0
+        self._total_write_latency = 0.0
+        self._writer = None
+
+        self._cache = ActionCache(cache_bytes)
+
+        # Started when first needed.
+        self._pool = None
+        self._pool_lock = threading.Lock()
 
     @staticmethod
     def build_real():
@@ -35,7 +383,9 @@ class ActionDatabase(object):
         find = rospy.ServiceProxy("mongo_msg_db/find", Find)
         insert = rospy.ServiceProxy("mongo_msg_db/insert", Insert)
         update = rospy.ServiceProxy("mongo_msg_db/update", Update)
-        d = ActionDatabase(db_name, coll_name, find, insert, update)
+        codec = rospy.get_param(PARAM_CODEC, DEFAULT_CODEC)
+        d = ActionDatabase(db_name, coll_name, find, insert, update,
+                           codec=codec)
         return d
 
     def insert_new(self, action_name):
@@ -47,22 +397,333 @@ class ActionDatabase(object):
         Returns:
             string, the ID of this action in the database.
         """
-        req = InsertRequest()
-        req.collection.db = self._db_name
-        req.collection.collection = self._collection_name
-        req.msg_type = self._MSG_TYPE
         action = Action()
         action.name = action_name
-        req.json = json_message_converter.convert_ros_message_to_json(action)
-        res = self._insert(req)
-        return res.id
+        return self.insert_many([action])[0]
+
+    def insert_many(self, actions):
+        """Inserts actions into the database.
+
+        Args:
+            actions: [Action], the Action msgs to insert. They must not
+                be changed afterwards.
+
+        Returns: [string], the IDs of the actions in the database, in
+            the order of actions.
+        """
+        generation = self._cache.get_generation()
+        return self._map(
+            lambda action: self._insert_action(action, generation), actions)
 
     def update(self, db_id, action):
         """Updates the action with the given ID.
 
+        This returns right away; the action is written in the
+        background, see flush().
+
+        Args:
+            db_id: The ID of this action in the database.
+            action: The replacemen Action msg. It must not be changed
+                afterwards.
+        """
+        self.update_many([(db_id, action)])
+
+    def update_many(self, pairs):
+        """Updates the actions with the given IDs.
+
+        Like update(), this returns right away. The actions are due to
+        be written at the same time, so they are written in one batch.
+        Of several updates of the same ID, the last one is written.
+
+        Args:
+            pairs: [(string, Action)], the IDs of the actions in the
+                database and their replacement Action msgs. The msgs
+                must not be changed afterwards.
+        """
+        for db_id, action in pairs:
+            self._cache.invalidate(db_id)
+        with self._write_cond:
+            for db_id, action in pairs:
+                self._set_pending(db_id, action)
+
+    def append_step(self, db_id, step, n_steps):
+        """Appends a step to the action with the given ID.
+
+        Args:
+            db_id: The ID of this action in the database.
+            step: The ActionStep msg to append. It must not be changed
+                afterwards.
+            n_steps: int, the number of steps the action has before the
+                step is appended.
+
+        Returns: True if the step was appended, False on a conflict.
+        """
+        def append(seq):
+            seq.append(step)
+        return self._apply_delta(db_id, n_steps, append)
+
+    def remove_step(self, db_id, index, n_steps):
+        """Removes a step from the action with the given ID.
+
+        Args:
+            db_id: The ID of this action in the database.
+            index: int, the index (0-based) of the step to remove.
+            n_steps: int, the number of steps the action has before the
+                step is removed.
+
+        Returns: True if the step was removed, False on a conflict.
+        """
+        if index < 0 or index >= n_steps:
+            return False
+
+        def remove(seq):
+            del seq[index]
+        return self._apply_delta(db_id, n_steps, remove)
+
+    def replace_step(self, db_id, index, step, n_steps):
+        """Replaces a step of the action with the given ID.
+
+        Args:
+            db_id: The ID of this action in the database.
+            index: int, the index (0-based) of the step to replace.
+            step: The new ActionStep msg. It must not be changed
+                afterwards.
+            n_steps: int, the number of steps the action has.
+
+        Returns: True if the step was replaced, False on a conflict.
+        """
+        if index < 0 or index >= n_steps:
+            return False
+
+        def replace(seq):
+            seq[index] = step
+        return self._apply_delta(db_id, n_steps, replace)
+
+    def rename(self, db_id, name):
+        """Renames the action with the given ID.
+
+        Args:
+            db_id: The ID of this action in the database.
+            name: string, the new human-friendly name for this action.
+
+        Returns: True if the action was renamed, False on a conflict.
+        """
+        return self._apply_delta(db_id, None, None, name)
+
+    def request_flush(self):
+        """Starts writing all pending updates now, without waiting for
+        more updates of the same actions.
+        """
+        with self._write_cond:
+            if len(self._pending) > 0:
+                self._is_flush_requested = True
+                self._write_cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Writes all pending updates now and waits for them.
+
+        Args:
+            timeout: float, seconds to wait at most, or None to wait for
+                as long as it takes.
+
+        Returns: True if all updates were written, False on a timeout
+            or if writing one failed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._write_cond:
+            n_failures = self._n_failures
+            while len(self._pending) > 0 or len(self._writing) > 0:
+                if self._n_failures > n_failures:
+                    return False
+                if len(self._pending) > 0:
+                    self._is_flush_requested = True
+                    self._write_cond.notify_all()
+                remaining = 1.0
+                if deadline is not None:
+                    remaining = min(remaining, deadline - time.time())
+                    if remaining <= 0:
+                        return False
+                self._write_cond.wait(remaining)
+        return True
+
+    def get_write_stats(self):
+        """Returns statistics about the write-behind updates.
+
+        Returns: dict with the number of pending updates ('queue_depth'),
+            of updates written ('n_writes'), of updates replaced by
+            later ones before being written ('n_coalesced') and of
+            failed attempts to write an update ('n_failures'), and the
+            latest and mean time in seconds to write an update
+            ('last_latency', 'mean_latency').
+        """
+        with self._write_cond:
+            mean_latency = 0.0
+            if self._n_writes > 0:
+                mean_latency = self._total_write_latency / self._n_writes
+            return {
+                'queue_depth': len(self._pending),
+                'n_writes': self._n_writes,
+                'n_coalesced': self._n_coalesced,
+                'n_failures': self._n_failures,
+                'last_latency': self._last_write_latency,
+                'mean_latency': mean_latency,
+            }
+
+    def get_cache_stats(self):
+        """Returns statistics about the cache of found actions.
+
+        Returns: dict, see ActionCache.get_stats().
+        """
+        return self._cache.get_stats()
+
+    def _apply_delta(self, db_id, n_steps, change_seq, name=None):
+        """Applies a delta to the latest version of an action held here
+        and schedules writing the result.
+
+        Args:
+            db_id: The ID of the action in the database.
+            n_steps: int, the number of steps the action should have, or
+                None to not check.
+            change_seq: function(list), changes the list of steps in
+                place, or None to not change it.
+            name: string, the new name, or None to keep it.
+
+        Returns: True if the delta was applied, False on a conflict.
+        """
+        with self._write_cond:
+            base = self._get_unwritten(db_id)
+            if base is None:
+                base = self._cache.peek(db_id)
+            if base is None or (n_steps is not None and
+                                len(base.sequence.seq) != n_steps):
+                return False
+            # Others may hold the base, so change a copy. Steps aren't
+            # changed, so they can be shared.
+            action = Action()
+            action.name = base.name if name is None else name
+            action.sequence = ActionStepSequence(list(base.sequence.seq))
+            if change_seq is not None:
+                change_seq(action.sequence.seq)
+            self._cache.invalidate(db_id)
+            self._set_pending(db_id, action)
+        return True
+
+    def _get_unwritten(self, db_id):
+        """Returns the latest update of the action with the given ID
+        that wasn't written yet, or None if there is none.
+
+        The write lock should be held when calling this.
+        """
+        if db_id in self._pending:
+            return self._pending[db_id][0]
+        return self._writing.get(db_id)
+
+    def _set_pending(self, db_id, action):
+        """Makes action the pending update of the action with the given
+        ID, replacing any earlier one.
+
+        The write lock should be held when calling this.
+        """
+        if db_id in self._pending:
+            del self._pending[db_id]
+            self._n_coalesced += 1
+        self._pending[db_id] = (action, time.time())
+        self._start_writer()
+        self._write_cond.notify_all()
+
+    def _start_writer(self):
+        """Starts the background writer thread if it isn't running.
+
+        The write lock should be held when calling this.
+        """
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_pending,
+                                            name='action_db_writer')
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _write_pending(self):
+        """Writes pending updates in the background, each once it has
+        not changed for the write delay or when a flush is requested.
+
+        All updates that are due are written together, as one batch.
+        """
+        while True:
+            with self._write_cond:
+                while True:
+                    if len(self._pending) == 0:
+                        self._is_flush_requested = False
+                        self._write_cond.wait(1.0)
+                        continue
+                    updated = next(self._pending.itervalues())[1]
+                    wait = updated + self._write_delay - time.time()
+                    if self._is_flush_requested or wait <= 0:
+                        break
+                    self._write_cond.wait(wait)
+                # Pending updates are oldest first, so the due ones come
+                # first.
+                due = time.time() - self._write_delay
+                batch = []
+                for db_id, (action, updated) in self._pending.iteritems():
+                    if not self._is_flush_requested and updated > due:
+                        break
+                    batch.append((db_id, action))
+                for db_id, action in batch:
+                    del self._pending[db_id]
+                self._writing = dict(batch)
+                # Failed updates are pending again; they are retried
+                # after the delay, not right away for this flush.
+                self._is_flush_requested = False
+                generation = self._cache.get_generation()
+            results = self._map(self._write_timed, batch)
+            with self._write_cond:
+                for (db_id, action), (is_failed, size, latency) in zip(
+                        batch, results):
+                    if is_failed:
+                        self._n_failures += 1
+                        if db_id not in self._pending:
+                            self._pending[db_id] = (action, time.time())
+                        continue
+                    if size is not None:
+                        # Keep what was written, e.g. as the base for
+                        # deltas.
+                        self._cache.put(db_id, action, size, generation)
+                    self._n_writes += 1
+                    self._last_write_latency = latency
+                    self._total_write_latency += latency
+                self._writing = {}
+                self._write_cond.notify_all()
+
+    def _write_timed(self, pair):
+        """Writes an update, logging errors.
+
+        Args:
+            pair: (string, Action), the ID of the action in the database
+                and the replacement Action msg.
+
+        Returns: (bool, int, float), whether writing failed, the size of
+            the action in bytes (or None if it wasn't written) and the
+            seconds it took.
+        """
+        db_id, action = pair
+        start = time.time()
+        try:
+            size = self._write_update(db_id, action)
+        except Exception, e:
+            rospy.logerr('Unable to update action with ID {}, will retry: '
+                         '{}'.format(db_id, e))
+            return True, None, time.time() - start
+        return False, size, time.time() - start
+
+    def _write_update(self, db_id, action):
+        """Writes an update of the action with the given ID.
+
         Args:
             db_id: The ID of this action in the database.
             action: The replacemen Action msg.
+
+        Returns: int, the size of the action in bytes (see
+            get_msg_size()), or None if the action was not found.
         """
         req = UpdateRequest()
         req.collection.db = self._db_name
@@ -70,12 +731,13 @@ class ActionDatabase(object):
         req.message = Message()
         req.message.id = db_id
         req.message.msg_type = self._MSG_TYPE
-        req.message.json = json_message_converter.convert_ros_message_to_json(
-            action)
+        req.message.json = self._codec.encode(action)
         res = self._update(req)
         if res.matched_count == 0:
             rospy.logerr(
                 'Action with ID {} not found, unable to update.'.format(db_id))
+            return None
+        return get_msg_size(action)
 
     def find(self, db_id):
         """Retrieves an action message with the given ID.
@@ -83,7 +745,53 @@ class ActionDatabase(object):
         Args:
             db_id: string, the ID in the database to look up.
 
-        Returns: An Action msg, or None if the ID was not found.
+        Returns: An Action msg, or None if the ID was not found. The msg
+            may be shared with later callers, so it must not be changed.
+        """
+        return self.find_many([db_id])[0]
+
+    def find_many(self, db_ids):
+        """Retrieves the action messages with the given IDs.
+
+        Args:
+            db_ids: [string], the IDs in the database to look up. They
+                may repeat.
+
+        Returns: [Action], the Action msgs (or None where the ID was not
+            found) in the order of db_ids. The msgs may be shared with
+            later callers, so they must not be changed.
+        """
+        # Anything looked up from here on may be cached, unless it is
+        # updated meanwhile.
+        generation = self._cache.get_generation()
+        # Updates that weren't written yet are the latest versions.
+        found = {}
+        with self._write_cond:
+            for db_id in db_ids:
+                action = self._get_unwritten(db_id)
+                if action is not None:
+                    found[db_id] = action
+        missing = []
+        for db_id in db_ids:
+            if db_id not in found:
+                found[db_id] = self._cache.get(db_id)
+                if found[db_id] is None:
+                    missing.append(db_id)
+        for db_id, result in zip(missing, self._map(self._fetch, missing)):
+            if result is not None:
+                action, size = result
+                self._cache.put(db_id, action, size, generation)
+                found[db_id] = action
+        return [found[db_id] for db_id in db_ids]
+
+    def _fetch(self, db_id):
+        """Retrieves and decodes an action from the database.
+
+        Args:
+            db_id: string, the ID in the database to look up.
+
+        Returns: (Action, int), the Action msg and its size in bytes (see
+            get_msg_size()), or None if the ID was not found.
         """
         req = FindRequest()
         req.collection.db = self._db_name
@@ -95,7 +803,42 @@ class ActionDatabase(object):
                 'Action with ID {} not found, unable to retrieve.'.format(
                     db_id))
             return None
-        else:
-            msg_type = res.message.msg_type
-            return json_message_converter.convert_json_to_ros_message(
-                msg_type, res.message.json)
+        action = decode_msg(res.message.msg_type, res.message.json)
+        return action, get_msg_size(action)
+
+    def _insert_action(self, action, generation):
+        """Inserts an action into the database and caches it.
+
+        Args:
+            action: The Action msg to insert.
+            generation: int, the cache generation from before the
+                insert.
+
+        Returns: string, the ID of the action in the database.
+        """
+        req = InsertRequest()
+        req.collection.db = self._db_name
+        req.collection.collection = self._collection_name
+        req.msg_type = self._MSG_TYPE
+        req.json = self._codec.encode(action)
+        res = self._insert(req)
+        # Keep the new action, e.g. as the base for deltas.
+        self._cache.put(res.id, action, get_msg_size(action), generation)
+        return res.id
+
+    def _map(self, func, items):
+        """Returns [func(item) for item in items], calling func on the
+        thread pool if there is more than one item.
+
+        Args:
+            func: function(item), must not use the thread pool itself.
+            items: list, what to call func on.
+
+        Returns: list, the results in the order of items.
+        """
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(BULK_THREADS)
+        return self._pool.map(func, items)
@@ -1,5 +1,9 @@
+from async_result import ResultTimeoutError
 from response import Response
+from robot_speech import RobotSpeech
 from pr2_pbd_interaction.srv import ExecuteActionById, ExecuteActionByIdResponse
+from pr2_social_gaze.msg import GazeGoal
+from world import OBJECTS_TIMEOUT
 import rospy
 
 
@@ -16,7 +20,20 @@ class ExecuteActionServer(object):
         """Callback for serving ExecuteActionById requests.
         """
         self._interaction.switch_to_action_by_id(request.action_id)
-        response_params = self._interaction._execute_action()
+        # This waits for objects to be found, if the action needs them.
+        pending = self._interaction._execute_action_async()
+        try:
+            response_params = pending.result(OBJECTS_TIMEOUT)
+        except ResultTimeoutError:
+            rospy.logwarn('Objects for the PbD action were not found in time')
+            # Don't start executing once they are.
+            self._interaction._stop_execution()
+            response_params = [RobotSpeech.OBJECT_NOT_DETECTED,
+                               GazeGoal.SHAKE]
+        except Exception, e:
+            rospy.logerr('Unable to start the PbD action: ' + str(e))
+            response_params = [RobotSpeech.OBJECT_NOT_DETECTED,
+                               GazeGoal.SHAKE]
         response = Response(self._interaction._empty_response, response_params)
         response.respond()
         rate = rospy.Rate(10)
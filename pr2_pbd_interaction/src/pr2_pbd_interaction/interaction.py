@@ -12,6 +12,7 @@ import rospy
 
 # System builtins
 from collections import Counter
+import Queue
 import signal
 import threading
 
@@ -30,6 +31,7 @@ from pr2_pbd_speech_recognition.msg import Command
 from pr2_social_gaze.msg import GazeGoal
 from response import Response
 from robot_speech import RobotSpeech
+from async_result import AsyncResult
 from std_msgs.msg import String
 from world_landmark import WorldLandmark
 import world
@@ -90,6 +92,20 @@ class Interaction:
         self._arm_trajectory = None
         self._trajectory_start_time = None
 
+        # Execution that is waiting for objects to be found before it
+        # starts (an AsyncResult), and whether it was stopped while
+        # waiting. Commands are ignored while it's pending, as they are
+        # during execution.
+        self._pending_execution = None
+        self._is_pending_execution_stopped = False
+        self._execution_lock = threading.Lock()
+
+        # Operations that finished on other threads, handed back to
+        # update() so what follows them runs on the update thread, like
+        # the rest of the action and world changes. See
+        # _in_update_loop(...).
+        self._handed_back = Queue.Queue()
+
         # This is the main mechanism by which code is executed. A
         # Response as a combination of a function to call and a
         # parameter. Responses are created here to be triggered by
@@ -154,6 +170,7 @@ class Interaction:
         experiment state) before exiting.'''
         rospy.loginfo('Interaction signal handler intercepted signal; saving.')
         self.session.save_current_action()
+        self.session.flush()
         # NOTE(mbforbes): We don't call sys.exit(0) here because that
         # would prevent cleanup from happening outside interaction
         # (e.g. in the node that's running it).
@@ -183,6 +200,9 @@ class Interaction:
         run before returning.
         '''
 
+        # Continue what waited on other threads.
+        self._finish_handed_back()
+
         # Update arms.
         self.arms.update()
         if self.arms.status != ExecutionStatus.NOT_EXECUTING:
@@ -243,7 +263,7 @@ class Interaction:
                           + '\033[0m')
             response = self.responses[strCmd]
 
-            if ((not self.arms.is_executing()) or
+            if ((not self._is_busy()) or
                 strCmd == Command.STOP_EXECUTION):
                 response.respond()
             else:
@@ -270,7 +290,7 @@ class Interaction:
         # Because the GUI commands involve selecting actions or steps
         # within actions, we have two prerequisites: first, we cannot be
         # currently executing an action, and second, we must have at least one action.
-        if not self.arms.is_executing():
+        if not self._is_busy():
             if strCmd == GuiCommand.SWITCH_TO_ACTION:
                 index = int(command.param) - 1
                 response = self.switch_to_action_by_index(index)
@@ -539,11 +559,17 @@ class Interaction:
         Returns:
             [str, int]: a speech response and a GazeGoal.* constant
         '''
-        if self.arms.is_executing():
-            self.arms.stop_execution()
-            return [RobotSpeech.STOPPING_EXECUTION, GazeGoal.NOD]
-        else:
-            return [RobotSpeech.ERROR_NO_EXECUTION, GazeGoal.SHAKE]
+        # Under the lock, a pending execution can't start meanwhile.
+        with self._execution_lock:
+            if self.arms.is_executing():
+                self.arms.stop_execution()
+                return [RobotSpeech.STOPPING_EXECUTION, GazeGoal.NOD]
+            elif self._is_execution_pending():
+                # Still looking for objects; don't start once they're
+                # found.
+                self._is_pending_execution_stopped = True
+                return [RobotSpeech.STOPPING_EXECUTION, GazeGoal.NOD]
+        return [RobotSpeech.ERROR_NO_EXECUTION, GazeGoal.SHAKE]
 
     def _start_recording(self, __=None):
         '''Starts recording continuous motion.
@@ -638,21 +664,20 @@ class Interaction:
     def _record_object_pose(self, __=None):
         '''Makes the robot look for a table and objects.
 
-        Only does anything when at least one action has been created.
+        This doesn't wait for the robot to look; it responds once the
+        objects have been updated.
 
         Args:
             __ (Landmark): unused, default: None
 
         Returns:
-            [str, int]: a speech response and a GazeGoal.* constant
+            [str, int]: a speech response and a GazeGoal.* constant, or
+                [None, None] if the response will come later.
         '''
-        if self._world.update_object_pose():
-            if self.session.n_actions() > 0:
-                self.session.get_current_action().update_objects(
-                    self._world.get_frame_list())
-            return [RobotSpeech.START_STATE_RECORDED, GazeGoal.NOD]
-        else:
-            return [RobotSpeech.OBJECT_NOT_DETECTED, GazeGoal.SHAKE]
+        return self._respond_later(
+            self._in_update_loop(
+                self._world.update_object_pose_async()).then(
+                    self._objects_updated))
 
     def _freeze_head(self, __=None):
         '''Freezes the head.
@@ -693,54 +718,220 @@ class Interaction:
 
         This saves the action before starting it.
 
+        If the action needs objects, the robot looks for them first
+        without blocking, and responds once execution starts (or
+        can't).
+
         Args:
             __ (Landmark): unused, default: None
 
         Returns:
-            [str, int]: a speech response and a GazeGoal.* constant
+            [str, int]: a speech response and a GazeGoal.* constant, or
+                [None, None] if the response will come later.
+        '''
+        return self._respond_later(self._execute_action_async())
+
+    def _execute_action_async(self):
+        '''Starts the execution of the current action, first looking
+        for objects if the action needs them.
+
+        This saves the action before starting it.
+
+        Returns:
+            AsyncResult: Resolves to a speech response and a GazeGoal.*
+                constant ([str, int]).
+        '''
+        with self._execution_lock:
+            if self._is_execution_pending():
+                # Objects are still being looked for the last execution.
+                return AsyncResult.completed(
+                    [RobotSpeech.EXECUTION_PENDING, GazeGoal.SHAKE])
+            return self._start_execution_async()
+
+    def _start_execution_async(self):
+        '''Starts the execution of the current action; see
+        _execute_action_async().
+
+        Returns:
+            AsyncResult: Resolves to a speech response and a GazeGoal.*
+                constant ([str, int]).
         '''
         # We must *have* a current action.
         if self.session.n_actions() > 0:
             # We must have also recorded steps (/poses/frames) in it.
             if self.session.n_frames() > 1:
-                # Save curent action and retrieve it.
+                # Save curent action (in the background, so execution
+                # doesn't wait for the disk) and retrieve it.
                 self.session.save_current_action()
 
-                # Now, see if we can execute.
-                if self.session.get_current_action().is_object_required():
+                # Now, see if we can execute. The action executed is the
+                # one current now, even if the session switches while
+                # objects are looked for.
+                action = self.session.get_current_action()
+                action_id = self.session.current_action_id
+                if action.is_object_required():
                     # We need an object; check if we have one.
-                    if self._world.update_object_pose():
-                        self._world.update()
-                        # An object is required, and we got one. Execute.
-                        self.session.get_current_action().update_objects(
-                            self._world.get_frame_list())
-                        self.arms.start_execution(
-                            self.session.get_current_action(),
-                            EXECUTION_Z_OFFSET)
-                    else:
-                        # An object is required, but we didn't get it.
-                        return [RobotSpeech.OBJECT_NOT_DETECTED,
-                                GazeGoal.SHAKE]
+                    self._is_pending_execution_stopped = False
+                    self._pending_execution = self._in_update_loop(
+                        self._world.update_object_pose_async()).then(
+                            lambda is_updated: self._execute_with_objects(
+                                is_updated, action, action_id))
+                    return self._pending_execution
                 else:
                     # No object is required: start execution now.
-                    self.arms.start_execution(
-                        self.session.get_current_action(), EXECUTION_Z_OFFSET)
+                    self.arms.start_execution(action, EXECUTION_Z_OFFSET)
 
                 # Reply: starting execution.
-                return [RobotSpeech.START_EXECUTION + ' ' +
-                        str(self.session.current_action_id), None]
+                return AsyncResult.completed(
+                    [RobotSpeech.START_EXECUTION + ' ' + str(action_id),
+                     None])
             else:
                 # No steps / poses / frames recorded.
-                return [RobotSpeech.EXECUTION_ERROR_NOPOSES + ' ' +
-                        str(self.session.current_action_id), GazeGoal.SHAKE]
+                return AsyncResult.completed(
+                    [RobotSpeech.EXECUTION_ERROR_NOPOSES + ' ' +
+                     str(self.session.current_action_id), GazeGoal.SHAKE])
         else:
             # No actions.
-            return [RobotSpeech.ERROR_NO_SKILLS, GazeGoal.SHAKE]
+            return AsyncResult.completed(
+                [RobotSpeech.ERROR_NO_SKILLS, GazeGoal.SHAKE])
 
     # The following are "normal" private helper functions; they aren't
     # called from within a Response, and serve to help the above
     # functions.
 
+    def _respond_later(self, pending):
+        '''Returns the response to a command if it is ready, or
+        arranges for the robot to respond once it is.
+
+        Args:
+            pending (AsyncResult): Resolves to a speech response and a
+                GazeGoal.* constant.
+
+        Returns:
+            [str, int]: a speech response and a GazeGoal.* constant, or
+                [None, None] if the response will come later.
+        '''
+        if pending.done():
+            return self._get_async_response(pending)
+        pending.add_done_callback(
+            lambda __: Response(self._empty_response,
+                                self._get_async_response(pending)).respond())
+        return [None, None]
+
+    def _in_update_loop(self, pending):
+        '''Returns an AsyncResult that finishes like pending, but from
+        update(), so that what is chained to it runs on the update
+        thread rather than on the thread that finishes pending.
+
+        Args:
+            pending (AsyncResult)
+
+        Returns:
+            AsyncResult
+        '''
+        handed_back = AsyncResult()
+        pending.add_done_callback(
+            lambda done: self._handed_back.put((done, handed_back)))
+        return handed_back
+
+    def _finish_handed_back(self):
+        '''Finishes the operations handed back by _in_update_loop(...)
+        since the last call.'''
+        while True:
+            try:
+                done, handed_back = self._handed_back.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                handed_back.set_result(done.result())
+            except Exception, e:
+                handed_back.set_exception(e)
+
+    def _get_async_response(self, pending):
+        '''Returns the response a finished operation resolved to, or
+        an error response if it failed.
+
+        The operations responded to later all look for objects first,
+        so a failure is reported as the objects not being detected.
+
+        Args:
+            pending (AsyncResult): Resolved to a speech response and a
+                GazeGoal.* constant, or failed.
+
+        Returns:
+            [str, int]: a speech response and a GazeGoal.* constant
+        '''
+        try:
+            return pending.result()
+        except Exception, e:
+            rospy.logerr('Command failed: ' + str(e))
+            return [RobotSpeech.OBJECT_NOT_DETECTED, GazeGoal.SHAKE]
+
+    def _objects_updated(self, is_updated):
+        '''Updates the current action (if any) after the objects were
+        looked for.
+
+        Args:
+            is_updated (bool): Whether objects were updated.
+
+        Returns:
+            [str, int]: a speech response and a GazeGoal.* constant
+        '''
+        if is_updated:
+            if self.session.n_actions() > 0:
+                self.session.get_current_action().update_objects(
+                    self._world.get_frame_list())
+            return [RobotSpeech.START_STATE_RECORDED, GazeGoal.NOD]
+        else:
+            return [RobotSpeech.OBJECT_NOT_DETECTED, GazeGoal.SHAKE]
+
+    def _is_execution_pending(self):
+        '''Returns whether an execution is waiting for objects to be
+        found before it starts.
+
+        Returns:
+            bool
+        '''
+        pending = self._pending_execution
+        return pending is not None and not pending.done()
+
+    def _is_busy(self):
+        '''Returns whether an action is executing or about to.
+
+        Returns:
+            bool
+        '''
+        return self.arms.is_executing() or self._is_execution_pending()
+
+    def _execute_with_objects(self, is_updated, action, action_id):
+        '''Starts the execution of an action once the objects it needs
+        were looked for.
+
+        Args:
+            is_updated (bool): Whether objects were updated.
+            action (ProgrammedAction): The action to execute, as it
+                was when execution was requested.
+            action_id (int): The ID of action.
+
+        Returns:
+            [str, int]: a speech response and a GazeGoal.* constant
+        '''
+        # This runs from update() (see _in_update_loop(...)); the lock
+        # keeps a stop from coming between the check and the start.
+        with self._execution_lock:
+            if self._is_pending_execution_stopped:
+                # Stopped while looking for objects; that was responded
+                # to.
+                return [None, None]
+            if not is_updated:
+                # An object is required, but we didn't get it.
+                return [RobotSpeech.OBJECT_NOT_DETECTED, GazeGoal.SHAKE]
+            self._world.update()
+            # An object is required, and we got one. Execute.
+            action.update_objects(self._world.get_frame_list())
+            self.arms.start_execution(action, EXECUTION_Z_OFFSET)
+        return [RobotSpeech.START_EXECUTION + ' ' + str(action_id), None]
+
     def _save_gripper_step(self, arm_index, gripper_state):
         '''Saves an action step that involves a gripper state change.
 
@@ -787,17 +978,16 @@ class Interaction:
 
         # Next, alter all trajectory steps (ArmState's) so that they use
         # the dominant reference frame as their reference frame.
-        for i in range(len(self._arm_trajectory.timing)):
-            t.rArm[i] = world.convert_ref_frame(
-                self._arm_trajectory.rArm[i],  # arm_frame (ArmState)
-                r_ref_n,  # ref_frame (int)
-                r_ref_obj  # ref_frame_obj (Objet)
-            )
-            t.lArm[i] = world.convert_ref_frame(
-                self._arm_trajectory.lArm[i],  # arm_frame (ArmState)
-                l_ref_n,  # ref_frame (int)
-                l_ref_obj  # ref_frame_obj (Objet)
-            )
+        t.rArm = world.convert_ref_frames(
+            t.rArm,  # arm_states ([ArmState])
+            r_ref_n,  # ref_frame (int)
+            r_ref_obj  # ref_frame_obj (Landmark)
+        )
+        t.lArm = world.convert_ref_frames(
+            t.lArm,  # arm_states ([ArmState])
+            l_ref_n,  # ref_frame (int)
+            l_ref_obj  # ref_frame_obj (Landmark)
+        )
 
         # Save the dominant ref. frame no./name in the trajectory for
         # reference.
@@ -869,9 +1059,10 @@ class Interaction:
         states = [None, None]
         rel_ee_poses = [None, None]
 
+        # One query for both arms.
+        nearest_objs = self._world.get_nearest_objects(abs_ee_poses)
         for arm_index in [Side.RIGHT, Side.LEFT]:
-            nearest_obj = self._world.get_nearest_object(
-                abs_ee_poses[arm_index])
+            nearest_obj = nearest_objs[arm_index]
             if not self._world.has_objects() or nearest_obj is None:
                 # Arm state is absolute (relative to robot's base_link).
                 states[arm_index] = ArmState(
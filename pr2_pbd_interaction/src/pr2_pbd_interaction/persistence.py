@@ -0,0 +1,131 @@
+'''Writes things to disk in the background.'''
+
+# ######################################################################
+# Imports
+# ######################################################################
+
+# Core ROS imports come first.
+import rospy
+
+# System builtins
+from collections import OrderedDict
+import os
+import threading
+import time
+
+# ######################################################################
+# Module level constants
+# ######################################################################
+
+# Suffix of the file that is written before being renamed into place.
+TMP_FILE_SUFFIX = '.tmp'
+
+# ######################################################################
+# Functions
+# ######################################################################
+
+
+def write_atomically(path, data):
+    '''Writes data to a file such that readers (and a crash) see either
+    the old or the new contents, never a partly written file.
+
+    Args:
+        path (str): The file to write.
+        data (str): What to write.
+    '''
+    tmp_path = path + TMP_FILE_SUFFIX
+    with open(tmp_path, 'wb') as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.rename(tmp_path, path)
+
+# ######################################################################
+# Classes
+# ######################################################################
+
+
+class PersistenceWorker(object):
+    '''Runs saves on a background thread, so callers don't wait on the
+    disk.
+
+    Things to save are marked dirty by key, along with the function that
+    saves them. Marking a key dirty again before it is saved replaces
+    the pending save, so bursts of saves of the same thing are written
+    once.
+    '''
+
+    def __init__(self, name='persistence_worker'):
+        '''
+        Args:
+            name (str, optional): Name of the worker thread. Defaults to
+                'persistence_worker'.
+        '''
+        self._cond = threading.Condition()
+        # key -> save function, in the order they were marked dirty.
+        self._dirty = OrderedDict()
+        self._is_saving = False
+        worker = threading.Thread(target=self._work, name=name)
+        worker.daemon = True
+        worker.start()
+
+    def mark_dirty(self, key, save):
+        '''Schedules a save, replacing any pending one for key.
+
+        Args:
+            key: Identifies what is saved.
+            save (function()): Saves it; called on the worker thread.
+        '''
+        with self._cond:
+            self._dirty.pop(key, None)
+            self._dirty[key] = save
+            self._cond.notify_all()
+
+    def is_idle(self):
+        '''Returns whether there's nothing left to save.
+
+        Returns:
+            bool
+        '''
+        with self._cond:
+            return len(self._dirty) == 0 and not self._is_saving
+
+    def flush(self, timeout=None):
+        '''Waits for all saves scheduled so far (and any scheduled
+        meanwhile) to finish.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most. Defaults
+                to None, which waits for as long as it takes.
+
+        Returns:
+            bool: Whether everything was saved.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while len(self._dirty) > 0 or self._is_saving:
+                # Condition.wait without a timeout can't be interrupted
+                # in Python 2, so wait in slices.
+                remaining = 1.0
+                if deadline is not None:
+                    remaining = min(remaining, deadline - time.time())
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+        return True
+
+    def _work(self):
+        '''The worker thread function.'''
+        while True:
+            with self._cond:
+                while len(self._dirty) == 0:
+                    self._cond.wait(1.0)
+                key, save = self._dirty.popitem(last=False)
+                self._is_saving = True
+            try:
+                save()
+            except Exception, e:
+                rospy.logerr('Error while saving ' + str(key) + ': ' + str(e))
+            with self._cond:
+                self._is_saving = False
+                self._cond.notify_all()
@@ -10,6 +10,7 @@ roslib.load_manifest('pr2_pbd_interaction')
 import rospy
 
 # System builtins
+from contextlib import contextmanager
 import threading
 import os
 
@@ -21,10 +22,12 @@ from visualization_msgs.msg import MarkerArray, Marker
 
 # Local
 from action_step_marker import ActionStepMarker
+from step_table import StepTable
+import world
 from pr2_arm_control.msg import Side, GripperState
 from pr2_pbd_interaction.msg import Action
-from pr2_pbd_interaction.msg import (ArmState, ActionStepSequence, ActionStep,
-                                     ArmTarget, GripperAction, ArmTrajectory)
+from pr2_pbd_interaction.msg import (ArmState, ActionStep, ArmTarget,
+                                     GripperAction, ArmTrajectory)
 
 # ######################################################################
 # Module level constants
@@ -32,16 +35,20 @@ from pr2_pbd_interaction.msg import (ArmState, ActionStepSequence, ActionStep,
 
 # Filename related
 FILENAME_BASE = 'Action'
+# Actions used to be saved in their own bag files; these are still read
+# if an action isn't in the action store.
 DEFAULT_FILE_EXT = '.bag'
 
 # Marker properties for little arrows drawn between consecutive steps.
-LINK_MARKER_LIFETIME = rospy.Duration(2)
+# Links are only re-published when they change, so they must not
+# expire (0 means forever); removed links are deleted explicitly.
+LINK_MARKER_LIFETIME = rospy.Duration(0)
 LINK_SCALE = Vector3(0.01, 0.03, 0.01)
 LINK_COLOR = ColorRGBA(0.8, 0.8, 0.8, 0.3)  # sort of light gray
 
 # ROS topics, etc.
 TOPIC_MARKERS = 'visualization_marker_array'
-TOPIC_BAG_SEQ = 'sequence'  # used when saving
+TOPIC_BAG_SEQ = 'sequence'  # used in legacy bag files
 
 # TODO(mbforbes): This should be in one module only.
 BASE_LINK = 'base_link'
@@ -51,8 +58,27 @@ BASE_LINK = 'base_link'
 # ######################################################################
 
 
-class ProgrammedAction:
-    '''Holds information for one action.'''
+class ProgrammedAction(object):
+    '''Holds information for one action.
+
+    The steps are kept as a StepTable, which takes a fraction of the
+    memory of the messages and serves the aggregate queries
+    (is_object_required(), get_gripper_states(...), ...). While the
+    action is being edited (visualized), the steps are also kept as
+    ActionStep messages that the step markers change in place;
+    otherwise the messages are only made when they're needed (e.g. by
+    to_msg() or save(...)).
+
+    StepTables are frozen, so each change to a step makes a new
+    version of the table (and bumps get_version()). That way copy()
+    only has to share the current version: nothing done to this
+    action afterwards changes the copy, and vice versa.
+
+    The same goes for readers: the read-only accessors (n_frames(),
+    get_step(...), get_gripper_states(...), ...) work on whichever
+    version is current when they're called, without taking self.lock,
+    which only serializes the writers.
+    '''
 
     _marker_publisher = None
 
@@ -68,13 +94,28 @@ class ProgrammedAction:
         # Initialize a bunch of state.
         self.name = ''  # Human-friendly name for this action.
         self._world = world
-        self.seq = ActionStepSequence()
+        # The steps as messages (None if not materialized) and as a
+        # StepTable (None if out of date); at least one is set. Each
+        # StepTable is published with a single assignment, so readers
+        # can use it without locking.
+        self._seq = None
+        self._steps = StepTable()
+        self._version = 0
+        # Guards swapping in new versions of the steps and marking
+        # links dirty, which the step markers do from their own
+        # callbacks. It's only held briefly (never while publishing or
+        # doing file I/O).
+        self._steps_lock = threading.RLock()
         self.action_index = action_index
         self.step_click_cb = step_click_cb
         self.r_markers = []
         self.l_markers = []
         self.r_links = {}
         self.l_links = {}
+        # Indices of links that need to be (re-)computed and published,
+        # and links that need to be deleted.
+        self._dirty_links = set()
+        self._deleted_links = []
 
         # NOTE(mbforbes): It appears that this is locking manipulation
         # of the internal sequence (self.seq). There have been race
@@ -93,6 +134,10 @@ class ProgrammedAction:
         # Unless the information you have (e.g. about the number of
         # steps that exist) was learned while this lock was acquired,
         # you cannot assume it is true.
+        #
+        # Only methods that change the action (or its visualization)
+        # take this lock; the read-only accessors don't, see
+        # _get_steps().
         self.lock = threading.Lock()
 
         if ProgrammedAction._marker_publisher is None:
@@ -107,17 +152,39 @@ class ProgrammedAction:
             callback = lambda x: None
         p = ProgrammedAction(world, action_index, callback)
         p.name = action_msg.name
-        p.seq = action_msg.sequence
+        p._set_steps(StepTable.from_msg(action_msg.sequence))
         return p
 
     def to_msg(self):
         '''Creates an Action ROS msg from this ProgrammedAction.
+
+        The msg is a snapshot of the current version of the steps, which
+        later changes to this action don't affect (so it can e.g. be
+        written out in the background).
         '''
         a = Action()
         a.name = self.name
-        a.sequence = self.seq
+        a.sequence = self._get_steps().to_msg()
         return a
 
+    @property
+    def seq(self):
+        '''ActionStepSequence: The steps of this action, as messages.
+
+        Reading this returns a snapshot of the current version of the
+        steps, made anew each time: changing it doesn't change this
+        action. To change steps, use set_step(...) (or assign a whole
+        new sequence).
+        '''
+        return self._get_steps().to_msg()
+
+    @seq.setter
+    def seq(self, seq):
+        self._steps_lock.acquire()
+        self._seq = seq
+        self._set_steps(None)
+        self._steps_lock.release()
+
     # ##################################################################
     # Static methods: Internal ("private")
     # ##################################################################
@@ -240,36 +307,41 @@ class ProgrammedAction:
             object_list ([Landmark]): List of Landmark (as defined by
                 Landmark.msg), the current reference frames.
         '''
-        self.lock.acquire()
-        self.seq.seq.append(self._copy_action_step(step))
-        # We currently support arm targets and arm trajectories.
-        # NOTE(mbforbes): It's unclear to me this is the best way to
-        # support future step types in the system. Doesn't this just
-        # mark one more spot in the code that needs to be changed to
-        # implement another action type?
-        if (step.type == ActionStep.ARM_TARGET or
-            step.type == ActionStep.ARM_TRAJECTORY):
-            # Create and append new action step markers.
-            # NOTE(mbforbes): One of many instances of code duplication
-            # b/c of right/left...
-            last_step = self.seq.seq[-1]
-            r_marker = ActionStepMarker(self._world, self.n_frames(), Side.RIGHT, last_step,
-                                        self.marker_click_cb)
-            r_marker.update_ref_frames(object_list)
-            l_marker = ActionStepMarker(self._world, self.n_frames(), Side.LEFT, last_step,
-                                        self.marker_click_cb)
-            l_marker.update_ref_frames(object_list)
-            self.r_markers.append(r_marker)
-            self.l_markers.append(l_marker)
-
-            # If we have any steps in this action, we link the previous
-            # one to this new one.
-            if self.n_frames() > 1:
-                self.r_links[self.n_frames() - 1] = self._get_link(
-                    Side.RIGHT, self.n_frames() - 1)
-                self.l_links[self.n_frames() - 1] = self._get_link(
-                    Side.LEFT, self.n_frames() - 1)
-        self.lock.release()
+        with self._editing():
+            new_step = self._copy_action_step(step)
+            self._steps_lock.acquire()
+            steps = self._get_steps()
+            self._get_seq().seq.append(new_step)
+            self._set_steps(steps.append_step(new_step))
+            self._steps_lock.release()
+            # We currently support arm targets and arm trajectories.
+            # NOTE(mbforbes): It's unclear to me this is the best way to
+            # support future step types in the system. Doesn't this just
+            # mark one more spot in the code that needs to be changed to
+            # implement another action type?
+            if (step.type == ActionStep.ARM_TARGET or
+                step.type == ActionStep.ARM_TRAJECTORY):
+                # Create and append new action step markers.
+                # NOTE(mbforbes): One of many instances of code
+                # duplication b/c of right/left...
+                last_step = self._seq.seq[-1]
+                r_marker = ActionStepMarker(self._world, self.n_frames(), Side.RIGHT, last_step,
+                                            self.marker_click_cb,
+                                            self._step_changed,
+                                            self._marker_viz_changed)
+                r_marker.update_ref_frames(object_list)
+                l_marker = ActionStepMarker(self._world, self.n_frames(), Side.LEFT, last_step,
+                                            self.marker_click_cb,
+                                            self._step_changed,
+                                            self._marker_viz_changed)
+                l_marker.update_ref_frames(object_list)
+                self.r_markers.append(r_marker)
+                self.l_markers.append(l_marker)
+
+                # If we have any steps in this action, we link the
+                # previous one to this new one (on the next
+                # update_viz()).
+                self._mark_links_dirty(self.n_frames() - 1)
 
     def update_objects(self, object_list):
         '''Updates the object list for all of this action's steps.
@@ -278,11 +350,12 @@ class ProgrammedAction:
             object_list ([Landmark]): List of Landmark (as defined by
                 Landmark.msg), the current reference frames.
         '''
-        self.lock.acquire()
-        self._update_markers()
-        for marker in self.r_markers + self.l_markers:
-            marker.update_ref_frames(object_list)
-        self.lock.release()
+        with self._editing():
+            self._update_markers()
+            landmark_map = self._associate_landmarks(object_list)
+            for marker in self.r_markers + self.l_markers:
+                marker.update_ref_frames(object_list, landmark_map)
+            self._mark_links_dirty(*range(self.n_frames()))
 
     def reset_targets(self, arm_index):
         '''Resets requests after reaching a previous target.
@@ -303,28 +376,26 @@ class ProgrammedAction:
         Note that this function will only delete at most one step per
         call.
         '''
-        self.lock.acquire()
-        to_delete = None
-        for i in range(len(self.r_markers)):
-            if (self.r_markers[i].is_deleted or self.l_markers[i].is_deleted):
-                # We found something to delete. Mark and break (as we
-                # delete only one thing).
-                rospy.loginfo('Will delete step ' + str(i + 1))
-                self.r_markers[i].is_deleted = False
-                self.l_markers[i].is_deleted = False
-                to_delete = i
-                break
-
-        # If we found anything to delete, delete it.
-        if to_delete is not None:
-            self._delete_step(to_delete)
-
-        self.lock.release()
-
-        # Update if we deleted anything.
-        if to_delete is not None:
-            self.update_viz()
-            self._update_markers()
+        m_array = MarkerArray()
+        with self._editing():
+            to_delete = None
+            for i in range(len(self.r_markers)):
+                if (self.r_markers[i].is_deleted or
+                    self.l_markers[i].is_deleted):
+                    # We found something to delete. Mark and break (as
+                    # we delete only one thing).
+                    rospy.loginfo('Will delete step ' + str(i + 1))
+                    self.r_markers[i].is_deleted = False
+                    self.l_markers[i].is_deleted = False
+                    to_delete = i
+                    break
+
+            # If we found anything to delete, delete it and update.
+            if to_delete is not None:
+                self._delete_step(to_delete)
+                m_array = self._get_link_changes()
+                self._update_markers()
+        self._publish_links(m_array)
 
     def change_requested_steps(self, r_arm, l_arm):
         '''Change an arm step to the current end effector poses if
@@ -334,10 +405,9 @@ class ProgrammedAction:
             r_arm (ArmState)
             l_arm (ArmState)
         '''
-        self.lock.acquire()
-        ProgrammedAction._update_if_edited(self.r_markers, r_arm)
-        ProgrammedAction._update_if_edited(self.l_markers, l_arm)
-        self.lock.release()
+        with self._editing():
+            ProgrammedAction._update_if_edited(self.r_markers, r_arm)
+            ProgrammedAction._update_if_edited(self.l_markers, l_arm)
 
     def get_requested_target(self, arm_index):
         '''Gets an arm step that might have been requested from the
@@ -375,73 +445,92 @@ class ProgrammedAction:
         Returns:
             int
         '''
-        return len(self.seq.seq)
+        steps = self._steps
+        if steps is not None:
+            return len(steps)
+        # The messages are being changed; don't make a StepTable just
+        # to count them.
+        self._steps_lock.acquire()
+        if self._seq is not None:
+            n_steps = len(self._seq.seq)
+        else:
+            n_steps = len(self._steps)
+        self._steps_lock.release()
+        return n_steps
 
-    def save(self, data_dir):
-        '''Saves the action into a file.
+    def save(self, store):
+        '''Saves the action into the action store. Nothing is written if
+        the action didn't change since it was last saved.
 
         Args:
-            data_dir (str): Directory in which to save the action file.
+            store (ActionStore): The store to save the action in.
         '''
-        if self.n_frames() > 0:
-            self.lock.acquire()
-            demo_bag = rosbag.Bag(data_dir + self._get_filename(), 'w')
-            demo_bag.write(TOPIC_BAG_SEQ, self.seq)
-            demo_bag.close()
-            self.lock.release()
+        # Write out a snapshot, so the action can change meanwhile.
+        steps = self._get_steps()
+        if len(steps) > 0:
+            store.save(self.get_name(), steps.to_msg())
         else:
             rospy.logwarn(
                 'Could not save action because it does not have any steps.')
 
-    def load(self, data_dir):
-        '''Loads an action from a file.
+    def load(self, store, data_dir=None):
+        '''Loads the action from the action store.
 
         Args:
-            data_dir (str): Directory where this action's file should be
-                located.
+            store (ActionStore): The store to load the action from.
+            data_dir (str, optional): Directory where a (legacy) bag file
+                of this action may be located, which is read if the
+                action isn't in store. Defaults to None.
         '''
-        filename = data_dir + self._get_filename()
-        if os.path.exists(filename):
-            self.lock.acquire()
-            demo_bag = rosbag.Bag(filename)
-            for dummy, msg, bag_time in demo_bag.read_messages(
-                topics=[TOPIC_BAG_SEQ]):
-                rospy.loginfo(
-                    'Reading demo bag file at time ' + str(bag_time.to_sec()))
-                self.seq = msg
-            demo_bag.close()
-            self.lock.release()
-        else:
-            rospy.logwarn(
-                'File does not exist, cannot load action: ' + filename)
+        seq = store.load(self.get_name())
+        if seq is None and data_dir is not None:
+            seq = self._load_bag(data_dir)
+        if seq is None:
+            rospy.logwarn('Action not found, cannot load: ' + self.get_name())
+            return
+        steps = StepTable.from_msg(seq)
+        self.lock.acquire()
+        self._steps_lock.acquire()
+        self._seq = None
+        self._set_steps(steps)
+        self._steps_lock.release()
+        self.lock.release()
 
     def reset_viz(self):
         '''Removes all visualization from Rviz.'''
-        self.lock.acquire()
-
-        # Destroy the action step markers.
-        for marker in self.r_markers + self.l_markers:
-            marker.destroy()
-
-        # Mark the links for destruction.
-        for i in self.r_links.keys():
-            self.r_links[i].action = Marker.DELETE
-            self.l_links[i].action = Marker.DELETE
-
-        # Publish the link destructions.
-        m_array = MarkerArray()
-        for i in self.r_links.keys():
-            m_array.markers.append(self.r_links[i])
-        for i in self.l_links.keys():
-            m_array.markers.append(self.l_links[i])
-        self._marker_publisher.publish(m_array)
-
-        # Reset internal data structures.
-        self.r_markers = []
-        self.l_markers = []
-        self.r_links = {}
-        self.l_links = {}
-        self.lock.release()
+        with self._editing():
+            # Destroy the action step markers.
+            for marker in self.r_markers + self.l_markers:
+                marker.destroy()
+
+            # Mark the links for destruction.
+            for i in self.r_links.keys():
+                self.r_links[i].action = Marker.DELETE
+                self.l_links[i].action = Marker.DELETE
+
+            # Collect the link destructions (including ones still
+            # pending) to publish once the lock is released.
+            m_array = MarkerArray()
+            m_array.markers += self._deleted_links
+            for i in self.r_links.keys():
+                m_array.markers.append(self.r_links[i])
+            for i in self.l_links.keys():
+                m_array.markers.append(self.l_links[i])
+
+            # Reset internal data structures.
+            self.r_markers = []
+            self.l_markers = []
+            self.r_links = {}
+            self.l_links = {}
+            self._steps_lock.acquire()
+            self._dirty_links = set()
+            self._steps_lock.release()
+            self._deleted_links = []
+
+            # Nothing is editing the steps anymore, so store them
+            # compactly.
+            self._compact()
+        self._publish_links(m_array)
 
     def marker_click_cb(self, uid, is_selected):
         '''Callback for when one of the markers is clicked.
@@ -455,22 +544,22 @@ class ProgrammedAction:
                 selected (True) or de-selected (False).
 
         '''
-        self.lock.acquire()
-        for marker in self.r_markers + self.l_markers:
-            # If we match the one we've clicked on, select it.
-            if marker.get_uid() == uid:
-                marker.is_control_visible = is_selected
-                marker.update_viz()
-            else:
-                # Otherwise, deselect it.
-                if marker.is_control_visible:
-                    marker.is_control_visible = False
+        with self._editing():
+            for marker in self.r_markers + self.l_markers:
+                # If we match the one we've clicked on, select it.
+                if marker.get_uid() == uid:
+                    marker.is_control_visible = is_selected
                     marker.update_viz()
-
-        # If we selected it, really click on it.
+                else:
+                    # Otherwise, deselect it.
+                    if marker.is_control_visible:
+                        marker.is_control_visible = False
+                        marker.update_viz()
+
+        # If we selected it, really click on it. This happens outside the
+        # lock as the callback may ask this action about its steps.
         if is_selected:
             self.step_click_cb(uid)
-        self.lock.release()
 
     def select_step(self, step_id):
         '''Makes the interactive marker for the indicated action step
@@ -489,45 +578,51 @@ class ProgrammedAction:
             object_list ([Landmark]): List of Landmark (as defined by
                 Landmark.msg), the current reference frames.
         '''
-        self.lock.acquire()
-        for i in range(len(self.seq.seq)):
-            step = self.seq.seq[i]
-            # NOTE(mbforbes): It's unclear to me this is the best way to
-            # support future step types in the system. Doesn't this just
-            # mark one more spot in the code that needs to be changed to
-            # implement another action type?
-            if (step.type == ActionStep.ARM_TARGET or
-                step.type == ActionStep.ARM_TRAJECTORY):
-                # Construct the markers.
-                r_marker = ActionStepMarker(
-                    self._world,
-                    i + 1,  # step_number
-                    Side.RIGHT,  # arm_index
-                    step,  # action_step
-                    self.marker_click_cb  # marker_click_cb
-                )
-                l_marker = ActionStepMarker(
-                    self._world,
-                    i + 1,  # step_number
-                    Side.LEFT,  # arm_index
-                    step,  # action_step
-                    self.marker_click_cb  # marker_click_cb
-                )
-
-                # Update and add.
-                r_marker.update_ref_frames(object_list)
-                l_marker.update_ref_frames(object_list)
-                self.r_markers.append(r_marker)
-                self.l_markers.append(l_marker)
-
-                # If we're not adding the first step, we should link the
-                # last one to it.
-                if i > 0:
-                    self.r_links[i] = self._get_link(Side.RIGHT, i)
-                    self.l_links[i] = self._get_link(Side.LEFT, i)
+        with self._editing():
+            seq = self._get_seq()
+            for i in range(len(seq.seq)):
+                step = seq.seq[i]
+                # NOTE(mbforbes): It's unclear to me this is the best way
+                # to support future step types in the system. Doesn't
+                # this just mark one more spot in the code that needs to
+                # be changed to implement another action type?
+                if (step.type == ActionStep.ARM_TARGET or
+                    step.type == ActionStep.ARM_TRAJECTORY):
+                    # Construct the markers.
+                    r_marker = ActionStepMarker(
+                        self._world,
+                        i + 1,  # step_number
+                        Side.RIGHT,  # arm_index
+                        step,  # action_step
+                        self.marker_click_cb,  # marker_click_cb
+                        self._step_changed,  # step_changed_cb
+                        self._marker_viz_changed  # viz_changed_cb
+                    )
+                    l_marker = ActionStepMarker(
+                        self._world,
+                        i + 1,  # step_number
+                        Side.LEFT,  # arm_index
+                        step,  # action_step
+                        self.marker_click_cb,  # marker_click_cb
+                        self._step_changed,  # step_changed_cb
+                        self._marker_viz_changed  # viz_changed_cb
+                    )
+
+                    self.r_markers.append(r_marker)
+                    self.l_markers.append(l_marker)
+
+            # Re-associate all referenced landmarks in one pass, then
+            # update the markers.
+            landmark_map = self._associate_landmarks(object_list)
+            for i in range(len(self.r_markers)):
+                self.r_markers[i].update_ref_frames(object_list, landmark_map)
+                self.l_markers[i].update_ref_frames(object_list, landmark_map)
+
+            # Link each step to the previous one (on the next
+            # update_viz()).
+            self._mark_links_dirty(*range(len(self.r_markers)))
 
-        self._update_markers()
-        self.lock.release()
+            self._update_markers()
 
     def get_last_step(self):
         '''Returns the last step of the action.
@@ -535,16 +630,13 @@ class ProgrammedAction:
         Returns:
             ActionStep
         '''
-        self.lock.acquire()
-        last_step = self.seq.seq[-1]
-        self.lock.release()
-        return last_step
+        steps = self._get_steps()
+        return steps.get_step(len(steps) - 1)
 
     def delete_last_step(self):
         '''Deletes the last step of the action.'''
-        self.lock.acquire()
-        self._delete_step(len(self.seq.seq) - 1)
-        self.lock.release()
+        with self._editing():
+            self._delete_step(self.n_frames() - 1)
 
     def is_object_required(self):
         '''Returns whether this action has any steps that are relative
@@ -553,25 +645,7 @@ class ProgrammedAction:
         Returns:
             bool
         '''
-        is_required = False
-        self.lock.acquire()
-        for step in self.seq.seq:
-            # Extract reference frames.
-            tp = step.type
-            if tp == ActionStep.ARM_TARGET:
-                r_ref = step.armTarget.rArm.refFrame
-                l_ref = step.armTarget.lArm.refFrame
-            else:
-                # tp == ActionStep.ARM_TRAJECTORY
-                r_ref = step.armTrajectory.rRefFrame
-                l_ref = step.armTrajectory.lRefFrame
-
-            # Logic: If either reference frame is to an object, we return true.
-            if r_ref == ArmState.OBJECT or l_ref == ArmState.OBJECT:
-                is_required = True
-                break
-        self.lock.release()
-        return is_required
+        return self._get_steps().is_object_required()
 
     def get_gripper_states(self, arm_index):
         '''Returns the gripper states for all action steps for arm
@@ -584,14 +658,7 @@ class ProgrammedAction:
             [int]: Each element is either GripperState.OPEN or
                 GripperState.CLOSED.
         '''
-        self.lock.acquire()
-        gripper_states = []
-        for action_step in self.seq.seq:
-            gact = action_step.gripperAction
-            gs = gact.rGripper if arm_index == Side.RIGHT else gact.lGripper
-            gripper_states += [gs.state]
-        self.lock.release()
-        return gripper_states
+        return self._get_steps().get_gripper_states(arm_index)
 
     def get_ref_frame_names(self, arm_index):
         '''Returns the names of the reference frame objects for all
@@ -603,14 +670,7 @@ class ProgrammedAction:
         Returns:
             [str]
         '''
-        self.lock.acquire()
-        ref_frame_names = []
-        for action_step in self.seq.seq:
-            target = action_step.armTarget
-            arm = target.rArm if arm_index == Side.RIGHT else target.lArm
-            ref_frame_names += [arm.refFrameLandmark.name]
-        self.lock.release()
-        return ref_frame_names
+        return self._get_steps().get_ref_frame_names(arm_index)
 
     def get_step(self, index):
         '''Returns a step of the action.
@@ -619,51 +679,90 @@ class ProgrammedAction:
             index (int): Index (0-based) of step to return.
 
         Returns:
-            ActionStep|None: Returns None if no such step exists.
+            ActionStep|None: A copy of the step, or None if no such step
+                exists.
         '''
-        # NOTE(mbforbes): For this lock to be meaningful, we have to
-        # check that the index is valid within it.
-        self.lock.acquire()
-        n_steps = len(self.seq.seq)
+        # Check the index against the same snapshot the step comes from.
+        steps = self._get_steps()
+        n_steps = len(steps)
         if index < 0 or index >= n_steps:
             rospy.logerr("Requested step index " + str(index) +
                          ", but only have " + str(n_steps) + " steps.")
-            requested_step = None
-        else:
-            requested_step = self.seq.seq[index]
-        self.lock.release()
-        return requested_step
+            return None
+        return steps.get_step(index)
+
+    def set_step(self, index, step):
+        '''Replaces a step of the action, making a new version of the
+        steps.
+
+        Args:
+            index (int): Index (0-based) of the step to replace.
+            step (ActionStep): The new step. It is copied, so the caller
+                may keep using it.
+        '''
+        with self._editing():
+            new_step = self._copy_action_step(step)
+            self._steps_lock.acquire()
+            steps = self._get_steps()
+            if self._seq is not None:
+                # The step markers show the messages, so change the
+                # step's message in place.
+                old_step = self._seq.seq[index]
+                for slot in old_step.__slots__:
+                    setattr(old_step, slot, getattr(new_step, slot))
+            self._set_steps(steps.replace_step(index, new_step))
+            self._steps_lock.release()
+            self._mark_links_dirty(index)
+            if index < len(self.r_markers):
+                self.r_markers[index].update_viz()
+                self.l_markers[index].update_viz()
+
+    def get_version(self):
+        '''Returns the version of this action's steps, which changes
+        whenever a step is added, removed or changed.
+
+        Returns:
+            int
+        '''
+        return self._version
 
     def copy(self):
         '''Returns a copy of this instance.
 
+        This is a snapshot of the current version of the steps, which
+        takes constant time: the copy shares the (frozen) StepTable.
+        Changing the steps of either makes a new version, which the
+        other doesn't see.
+
         Returns:
             ProgrammedAction
         '''
         action = ProgrammedAction(self._world, self.action_index, self.step_click_cb)
-        action.seq = ActionStepSequence()
-        for action_step in self.seq.seq:
-            copy = ProgrammedAction._copy_action_step(action_step)
-            action.seq.seq.append(copy)
+        self._steps_lock.acquire()
+        action._steps = self._get_steps()
+        action._version = self._version
+        self._steps_lock.release()
         return action
 
     def update_viz(self):
-        '''Updates the visualization of the action.'''
+        '''Updates the visualization of the action.
+
+        Only links that changed since the last call are re-computed and
+        published, so this costs nothing if the action didn't change.
+        '''
         self.lock.acquire()
-        self._update_links()
-        m_array = MarkerArray()
-        for i in self.r_links.keys():
-            m_array.markers.append(self.r_links[i])
-        for i in self.l_links.keys():
-            m_array.markers.append(self.l_links[i])
-        self._marker_publisher.publish(m_array)
+        m_array = self._get_link_changes()
         self.lock.release()
+        self._publish_links(m_array)
 
     def clear(self):
         '''Clears the action.'''
         self.reset_viz()
         self.lock.acquire()
-        self.seq = ActionStepSequence()
+        self._steps_lock.acquire()
+        self._seq = None
+        self._set_steps(StepTable())
+        self._steps_lock.release()
         self.r_markers = []
         self.l_markers = []
         self.r_links = dict()
@@ -674,6 +773,49 @@ class ProgrammedAction:
     # Instance methods: Internal ("private")
     # ##################################################################
 
+    @contextmanager
+    def _editing(self):
+        '''Context for changing the action or its markers.
+
+        It holds self.lock, and the interactive marker changes made
+        inside it are published together once the lock is released.
+        '''
+        self.lock.acquire()
+        try:
+            with ActionStepMarker.batch_update(is_flushed=False):
+                yield
+        finally:
+            self.lock.release()
+        ActionStepMarker.flush_changes()
+
+    def _get_link_changes(self):
+        '''Returns the link markers to publish: links that were deleted
+        and links that changed (which are updated first).
+
+        NOTE(mbforbes): The lock should be acquired before calling this
+        method.
+
+        Returns:
+            MarkerArray
+        '''
+        m_array = MarkerArray()
+        m_array.markers += self._deleted_links
+        self._deleted_links = []
+        for i in self._update_links():
+            m_array.markers.append(self.r_links[i])
+            m_array.markers.append(self.l_links[i])
+        return m_array
+
+    def _publish_links(self, m_array):
+        '''Publishes link markers, if there are any. This should be
+        called without holding the lock.
+
+        Args:
+            m_array (MarkerArray): As returned by _get_link_changes().
+        '''
+        if len(m_array.markers) > 0:
+            self._marker_publisher.publish(m_array)
+
     def _get_link(self, arm_index, to_index):
         '''Returns a marker representing a link b/w two consecutive
         action steps (both must already exist).
@@ -697,10 +839,33 @@ class ProgrammedAction:
                       color=LINK_COLOR,
                       points=[start, end])
 
-    def _update_markers(self):
-        '''Updates the markers after a change.'''
+    def _associate_landmarks(self, object_list):
+        '''Matches the landmarks referenced by this action's steps to
+        the landmarks in object_list, once for all markers.
+
+        NOTE(mbforbes): The lock should be acquired before calling this
+        method.
+
+        Args:
+            object_list ([Landmark]): List of Landmark (as defined by
+                Landmark.msg), the current reference frames.
+
+        Returns:
+            {str: Landmark|None}: See world.associate_landmarks(...).
+        '''
+        prev_landmarks = []
         for marker in self.r_markers + self.l_markers:
-            marker.update_viz()
+            landmark = marker.get_ref_landmark()
+            if landmark is not None:
+                prev_landmarks.append(landmark)
+        return world.associate_landmarks(prev_landmarks, object_list)
+
+    def _update_markers(self):
+        '''Updates the markers after a change. Only markers that changed
+        are rendered again, and they are published together.'''
+        with ActionStepMarker.batch_update():
+            for marker in self.r_markers + self.l_markers:
+                marker.update_viz()
 
     def _delete_step(self, to_delete):
         '''(Actually) deletes a step from the action.
@@ -712,27 +877,177 @@ class ProgrammedAction:
             to_delete (int): The index of the step to delete.
         '''
         rospy.loginfo('Deleting step: ' + str(to_delete))
-        if len(self.r_links) > 0:
-            self.r_links[self.r_links.keys()[-1]].action = Marker.DELETE
-            self.l_links[self.l_links.keys()[-1]].action = Marker.DELETE
-            self.r_links.pop(self.r_links.keys()[-1])
-            self.l_links.pop(self.l_links.keys()[-1])
-
-        self.r_markers[-1].destroy()
-        self.l_markers[-1].destroy()
-        for i in range(to_delete + 1, self.n_frames()):
-            self.r_markers[i].decrease_id()
-            self.l_markers[i].decrease_id()
+        # The link ids go with the step numbers, so the last link goes
+        # away and the ones from the deleted step on change.
+        last_link = self.n_frames() - 1
+        if last_link in self.r_links:
+            for links in [self.r_links, self.l_links]:
+                link = links.pop(last_link)
+                link.action = Marker.DELETE
+                self._deleted_links.append(link)
+        self._mark_links_dirty(*range(to_delete, self.n_frames()))
+
+        with ActionStepMarker.batch_update():
+            self.r_markers[-1].destroy()
+            self.l_markers[-1].destroy()
+            for i in range(to_delete + 1, self.n_frames()):
+                self.r_markers[i].decrease_id()
+                self.l_markers[i].decrease_id()
         self.r_markers.pop(to_delete)
         self.l_markers.pop(to_delete)
-        self.seq.seq.pop(to_delete)
+        self._steps_lock.acquire()
+        steps = self._get_steps()
+        self._get_seq().seq.pop(to_delete)
+        self._set_steps(steps.delete_step(to_delete))
+        self._steps_lock.release()
+
+    def _get_seq(self):
+        '''Returns the steps as messages, making them from the
+        StepTable first if needed.
+
+        NOTE(mbforbes): The lock should be acquired before calling this
+        method.
+
+        Returns:
+            ActionStepSequence
+        '''
+        self._steps_lock.acquire()
+        if self._seq is None:
+            self._seq = self._steps.to_msg()
+        self._steps_lock.release()
+        return self._seq
+
+    def _get_steps(self):
+        '''Returns the current version of the steps as a StepTable,
+        making it from the messages first if needed.
+
+        This doesn't lock unless the StepTable has to be made: the
+        StepTable is immutable, and a reader that gets one just before a
+        new version is published sees the consistent previous version.
+
+        Returns:
+            StepTable
+        '''
+        steps = self._steps
+        if steps is not None:
+            return steps
+        self._steps_lock.acquire()
+        if self._steps is None:
+            self._steps = StepTable.from_msg(self._seq)
+        steps = self._steps
+        self._steps_lock.release()
+        return steps
+
+    def _set_steps(self, steps):
+        '''Makes steps the current version of the steps.
+
+        NOTE: self._steps_lock should be acquired before calling this
+        method.
+
+        Args:
+            steps (StepTable|None): None if the StepTable is out of
+                date with the messages and should be made from them.
+        '''
+        self._steps = steps
+        self._version += 1
+
+    def _step_changed(self, index):
+        '''Callback for when a step marker changed a step's message;
+        makes a new version of the steps.
+
+        Args:
+            index (int): Index (0-based) of the step.
+        '''
+        self._steps_lock.acquire()
+        if self._seq is not None:
+            steps = self._steps
+            if steps is not None:
+                steps = steps.replace_step(index, self._seq.seq[index])
+            self._set_steps(steps)
+            self._mark_links_dirty(index)
+        self._steps_lock.release()
+
+    def _marker_viz_changed(self, marker):
+        '''Callback for when something a step marker shows changed in
+        the background (e.g. whether its step is reachable); renders the
+        marker again, under the lock that guards its step.
+
+        Args:
+            marker (ActionStepMarker)
+        '''
+        with self._editing():
+            # The marker may have been removed in the meantime.
+            if marker in self.r_markers or marker in self.l_markers:
+                marker.update_viz()
+
+    def _compact(self):
+        '''Keeps only the StepTable, dropping the messages.
+
+        NOTE(mbforbes): The lock should be acquired before calling this
+        method.
+        '''
+        self._steps_lock.acquire()
+        self._get_steps()
+        self._seq = None
+        self._steps_lock.release()
+
+    def _mark_links_dirty(self, *step_indices):
+        '''Marks the links to and from steps as needing to be updated.
+
+        Args:
+            step_indices (int...): Indices (0-based) of the steps that
+                changed (or were added).
+        '''
+        self._steps_lock.acquire()
+        for i in step_indices:
+            # Step i is the end of link i and the start of link i + 1.
+            self._dirty_links.update([i, i + 1])
+        self._steps_lock.release()
 
     def _update_links(self):
-        '''Updates the visualized links b/w action steps.'''
-        for i in self.r_links.keys():
-            self.r_links[i] = self._get_link(Side.RIGHT, i)
-        for i in self.l_links.keys():
-            self.l_links[i] = self._get_link(Side.LEFT, i)
+        '''Updates the visualized links b/w action steps that were
+        marked dirty.
+
+        NOTE(mbforbes): The lock should be acquired before calling this
+        method.
+
+        Returns:
+            [int]: The indices of the updated links.
+        '''
+        self._steps_lock.acquire()
+        dirty_links, self._dirty_links = self._dirty_links, set()
+        self._steps_lock.release()
+        updated = []
+        for i in sorted(dirty_links):
+            # Link i goes from step i - 1 to step i, which must exist.
+            if 0 < i < len(self.r_markers):
+                self.r_links[i] = self._get_link(Side.RIGHT, i)
+                self.l_links[i] = self._get_link(Side.LEFT, i)
+                updated.append(i)
+        return updated
+
+    def _load_bag(self, data_dir):
+        '''Reads the steps of the action from its (legacy) bag file.
+
+        Args:
+            data_dir (str): Directory where the bag file should be
+                located.
+
+        Returns:
+            ActionStepSequence|None: None if there's no bag file.
+        '''
+        filename = data_dir + self._get_filename()
+        if not os.path.exists(filename):
+            return None
+        seq = None
+        demo_bag = rosbag.Bag(filename)
+        for dummy, msg, bag_time in demo_bag.read_messages(
+            topics=[TOPIC_BAG_SEQ]):
+            rospy.loginfo(
+                'Reading demo bag file at time ' + str(bag_time.to_sec()))
+            seq = msg
+        demo_bag.close()
+        return seq
 
     def _get_filename(self, ext=DEFAULT_FILE_EXT):
         '''Returns the filename of the bag that holds this action.
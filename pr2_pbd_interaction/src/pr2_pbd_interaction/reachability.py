@@ -0,0 +1,123 @@
+'''Checks whether action steps are reachable in the background.'''
+
+# ######################################################################
+# Imports
+# ######################################################################
+
+# Core ROS imports come first.
+import rospy
+
+# System builtins
+import Queue
+import threading
+
+# Local
+from arms import Arms
+
+# ######################################################################
+# Module level constants
+# ######################################################################
+
+# How many IK requests can be in flight at once.
+N_REACHABILITY_WORKERS = 2
+
+# ######################################################################
+# Classes
+# ######################################################################
+
+
+class ReachabilityPool(object):
+    '''A few worker threads that check whether arm states are reachable
+    (i.e. have an IK solution), each with its own IK service proxies.
+
+    Requests are made for a key (e.g. the marker that shows the result);
+    a new request for a key cancels the earlier one, whose callback is
+    then never called.
+    '''
+
+    def __init__(self, n_workers=N_REACHABILITY_WORKERS):
+        '''
+        Args:
+            n_workers (int, optional): The number of worker threads.
+                Defaults to N_REACHABILITY_WORKERS.
+        '''
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        # The id of the current request for each key.
+        self._pending = {}
+        self._next_id = 0
+        for i in range(n_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='reachability_worker_' + str(i))
+            worker.daemon = True
+            worker.start()
+
+    def request(self, key, arm_index, arm_state, callback):
+        '''Requests a reachability check, cancelling the previous one
+        for key, if any.
+
+        Args:
+            key: Identifies what the check is for.
+            arm_index (int): Side.RIGHT or Side.LEFT
+            arm_state (ArmState): The arm state to check. It must not be
+                changed afterwards.
+            callback (function(bool)): Called (on a worker thread) with
+                whether arm_state is reachable.
+        '''
+        self._lock.acquire()
+        request_id = self._next_id
+        self._next_id += 1
+        self._pending[key] = request_id
+        self._lock.release()
+        self._queue.put((key, request_id, arm_index, arm_state, callback))
+
+    def cancel(self, key):
+        '''Cancels the current request for key, if any.
+
+        Args:
+            key: As passed to request(...).
+        '''
+        self._lock.acquire()
+        self._pending.pop(key, None)
+        self._lock.release()
+
+    def _is_current(self, key, request_id, is_done=False):
+        '''Returns whether a request is still current (not cancelled).
+
+        Args:
+            key: As passed to request(...).
+            request_id (int): The id of the request.
+            is_done (bool, optional): Whether the request has finished,
+                in which case it stops being current. Defaults to False.
+
+        Returns:
+            bool
+        '''
+        self._lock.acquire()
+        is_current = self._pending.get(key) == request_id
+        if is_current and is_done:
+            del self._pending[key]
+        self._lock.release()
+        return is_current
+
+    def _work(self):
+        '''The worker thread function.'''
+        # Persistent service proxies can't be shared between threads,
+        # so each worker makes its own, per arm.
+        ik_services = {}
+        while not rospy.is_shutdown():
+            key, request_id, arm_index, arm_state, callback = (
+                self._queue.get())
+            if not self._is_current(key, request_id):
+                continue
+            if arm_index not in ik_services:
+                ik_services[arm_index] = (
+                    Arms.arms[arm_index].create_ik_service())
+            try:
+                dummy, is_reachable = Arms.solve_ik_for_arm(
+                    arm_index, arm_state, ik_srv=ik_services[arm_index])
+            except Exception, e:
+                rospy.logerr('Error while checking reachability: ' + str(e))
+                continue
+            if self._is_current(key, request_id, is_done=True):
+                callback(is_reachable)
@@ -140,16 +140,19 @@ class Response:
             Response.gaze_client.send_goal(goal)
 
     @staticmethod
-    def force_gaze_action(gaze_action):
+    def force_gaze_action(gaze_action, done_cb=None):
         '''Triggers a gaze action, even if enable_social_gaze is false.
 
         Args:
             gaze_action (int): One of the constants defined in
                 Gaze.action.
+            done_cb (function(int, GazeResult), optional): Called with
+                the final state and result when the gaze action
+                finishes. Defaults to None.
         '''
         goal = GazeGoal()
         goal.action = gaze_action
-        Response.gaze_client.send_goal(goal)
+        Response.gaze_client.send_goal(goal, done_cb=done_cb)
 
     @staticmethod
     def look_at_point(point):
@@ -207,6 +210,7 @@ class Response:
               speech_resp == RobotSpeech.EXECUTION_ERROR_NOIK or
               speech_resp == RobotSpeech.EXECUTION_ERROR_NOPOSES or
               speech_resp == RobotSpeech.EXECUTION_PREEMPTED or
+              speech_resp == RobotSpeech.EXECUTION_PENDING or
               speech_resp == RobotSpeech.RIGHT_HAND_ALREADY_OPEN or
               speech_resp == RobotSpeech.LEFT_HAND_ALREADY_OPEN or
               speech_resp == RobotSpeech.RIGHT_HAND_ALREADY_CLOSED or
@@ -95,6 +95,7 @@ class RobotSpeech:
     ERROR_NO_EXECUTION = 'No executions in progress.'
     EXECUTION_PREEMPTED = 'Stopping execution.'
     STOPPING_EXECUTION = 'Execution stopped.'
+    EXECUTION_PENDING = 'Still looking for objects to execute with.'
     EXECUTION_ERROR_NOIK = 'Cannot execute action'
     EXECUTION_ERROR_NOPOSES = 'Not enough poses in action'
 
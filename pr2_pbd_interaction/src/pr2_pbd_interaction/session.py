@@ -16,6 +16,8 @@ import threading
 import yaml
 
 # Local
+from action_store import ActionStore
+from persistence import PersistenceWorker, write_atomically
 from programmed_action import ProgrammedAction
 from pr2_arm_control.msg import Side
 from pr2_pbd_interaction.msg import ExperimentState
@@ -33,6 +35,9 @@ YAML_KEY_NACTIONS = 'nProgrammedActions'
 YAML_KEY_ACTION_LIST = 'actionList'
 YAML_KEY_CURIDX = 'currentProgrammedActionIndex'
 
+# How long to wait at most for pending saves when shutting down.
+SHUTDOWN_FLUSH_TIMEOUT = 5.0  # seconds
+
 # ROS params, topics, services, etc.
 PARAM_DATA_ROOT = '/pr2_pbd_interaction/dataRoot'
 PARAM_EXP_NO = '/pr2_pbd_interaction/experimentNumber'
@@ -77,6 +82,18 @@ class Session:
         if not os.path.exists(self._data_dir):
             os.makedirs(self._data_dir)
         rospy.set_param(PARAM_DATA_DIR, self._data_dir)
+        # All actions are saved in one store in the data directory. The
+        # versions of the actions last saved there are kept so only
+        # actions that changed are saved again. Saving happens in the
+        # background.
+        self._store = ActionStore(self._data_dir)
+        self._saved_versions = {}
+        self._persistence = PersistenceWorker()
+        # The versions of the actions the database was last sent. Steps
+        # changed by their markers aren't sent right away, so an action
+        # whose version moved on since can't take a delta; it is sent
+        # whole instead.
+        self._db_versions = {}
 
         # Public attributes.
         self.actions = {}
@@ -129,35 +146,64 @@ class Session:
     def save_session_state(self, is_save_actions=True):
         '''Saves the session state onto the disk.
 
+        This only schedules the writes, which happen in the background;
+        see flush(...).
+
         Args:
             is_save_actions (bool): Whether to have the actions
-                themselves also write out to disk (as ROS bags).
+                themselves also write out to disk (to the action store).
+                Only actions that changed since they were last saved
+                are written.
         '''
         # Always save the light, high-level state, like number of
         # actions and current action index.
         exp_state = {}
         exp_state[YAML_KEY_NACTIONS] = self.n_actions()
-        exp_state[YAML_KEY_ACTION_LIST] = self._session_actions
+        exp_state[YAML_KEY_ACTION_LIST] = list(self._session_actions)
         exp_state[YAML_KEY_CURIDX] = self.current_action_id
-        with open(self._data_dir + SAVE_FILENAME, 'w') as state_file:
-            state_file.write(yaml.dump(exp_state))
+        self._persistence.mark_dirty(
+            SAVE_FILENAME, lambda: write_atomically(
+                self._data_dir + SAVE_FILENAME, yaml.dump(exp_state)))
 
-        # If we're told to, have each action write its data out into a
-        # ROS bag.
+        # If we're told to, have each action that changed write its data
+        # out into the action store.
         if is_save_actions:
             for i in self.actions.keys():
-                self.actions[i].save(self._data_dir)
+                self._schedule_save_action(i)
+
+    def flush(self, timeout=SHUTDOWN_FLUSH_TIMEOUT):
+        '''Waits for the scheduled saves (and database updates) to
+        finish, e.g. before shutting down.
+
+        Args:
+            timeout (float, optional): Seconds to wait at most. Defaults
+                to SHUTDOWN_FLUSH_TIMEOUT.
+
+        Returns:
+            bool: Whether everything was saved in time.
+        '''
+        # Flush both, even if the first one fails, so as much as
+        # possible is saved.
+        is_persisted = self._persistence.flush(timeout)
+        is_written = self._db.flush(timeout)
+        is_flushed = is_persisted and is_written
+        if not is_flushed:
+            rospy.logwarn('Unable to save the session in time.')
+        return is_flushed
 
     def new_action(self):
         '''Creates new action.'''
         if self.n_actions() > 0:
             self.get_current_action().reset_viz()
+            # Done with the current action; write it to the database.
+            self._db.request_flush()
         time_str = datetime.datetime.now().strftime('%c')
         name = 'Untitled action {}'.format(time_str)
         action_id = self._db.insert_new(name)
         self.current_action_id = action_id
         action = ProgrammedAction(self._world, self.current_action_id, self._selected_step_cb)
         action.name = name
+        self._db_versions[action_id] = action.get_version()
         self.actions.update({
             self.current_action_id: action
         })
@@ -185,18 +231,26 @@ class Session:
         if self.n_actions() > 0:
             current_action = self.actions[self.current_action_id]
             current_action.clear()
-            self._db.update(self.current_action_id, current_action.to_msg())
+            self._update_db(self.current_action_id)
         else:
             rospy.logwarn("Can't clear action: No actions created yet.")
         self._update_experiment_state()
 
     def save_current_action(self):
-        '''Saves the current action onto disk.
+        '''Saves the current action onto disk (in the background; see
+        flush(...)).
         This does not save to the database because actions are automatically saved to the database.
         '''
         if self.n_actions() > 0:
-            self.actions[self.current_action_id].save(self._data_dir)
+            self._schedule_save_action(self.current_action_id)
             self.save_session_state(is_save_actions=False)
+            # Send the database any edits made by the step markers, and
+            # don't wait for more edits to write it.
+            current_action = self.actions[self.current_action_id]
+            if (self._db_versions.get(self.current_action_id) !=
+                    current_action.get_version()):
+                self._update_db(self.current_action_id)
+            self._db.request_flush()
         else:
             rospy.logwarn("Can't save action: No actions created yet.")
 
@@ -213,8 +267,15 @@ class Session:
         '''
         if self.n_actions() > 0:
             current_action = self.actions[self.current_action_id]
+            n_steps = current_action.n_frames()
+            version = current_action.get_version()
             current_action.add_action_step(step, object_list)
-            self._db.update(self.current_action_id, current_action.to_msg())
+            # Only send the new step to the database, if it can take it.
+            self._update_db(
+                self.current_action_id, version,
+                lambda: self._db.append_step(self.current_action_id,
+                                             current_action.get_last_step(),
+                                             n_steps))
         else:
             rospy.logwarn("Can't add step: No actions created yet.")
         self._object_list = object_list
@@ -224,8 +285,13 @@ class Session:
         '''Removes the last step of the action.'''
         if self.n_actions() > 0:
             current_action = self.actions[self.current_action_id]
+            n_steps = current_action.n_frames()
+            version = current_action.get_version()
             current_action.delete_last_step()
-            self._db.update(self.current_action_id, current_action.to_msg())
+            self._update_db(
+                self.current_action_id, version,
+                lambda: self._db.remove_step(self.current_action_id,
+                                             n_steps - 1, n_steps))
         else:
             rospy.logwarn("Can't delete last step: No actions created yet.")
         self._update_experiment_state()
@@ -242,6 +308,8 @@ class Session:
         '''
         if self.n_actions() > 0:
             self.get_current_action().reset_viz()
+            # Done with the current action; write it to the database.
+            self._db.request_flush()
 
         self.current_action_id = db_id
         if db_id not in self.actions:
@@ -252,6 +320,7 @@ class Session:
                 self.current_action_id: ProgrammedAction.from_msg(
                     msg, self._world, self.current_action_id, self._selected_step_cb)
             })
+            self._db_versions[db_id] = self.actions[db_id].get_version()
             self._session_actions.append(db_id)
         self._update_experiment_state()
         return True
@@ -352,6 +421,53 @@ class Session:
     # Instance methods: Internal ("private")
     # ##################################################################
 
+    def _update_db(self, action_id, base_version=None, write_delta=None):
+        '''Sends the database the latest version of an action: as a
+        delta if the database has the version the delta was made on,
+        whole otherwise.
+
+        Args:
+            action_id (str): The id of the action.
+            base_version (int, optional): The version of the action the
+                delta was made on. Defaults to None.
+            write_delta (function(): bool, optional): Sends the delta,
+                returning False on a conflict. Defaults to None, which
+                sends the whole action.
+        '''
+        action = self.actions[action_id]
+        # Read the version first, so what is sent is at least as new.
+        version = action.get_version()
+        is_delta_written = (
+            write_delta is not None and
+            self._db_versions.get(action_id) == base_version and
+            write_delta())
+        if not is_delta_written:
+            self._db.update(action_id, action.to_msg())
+        self._db_versions[action_id] = version
+
+    def _schedule_save_action(self, action_id):
+        '''Schedules saving an action into the action store.
+
+        Args:
+            action_id (str): The id of the action to save.
+        '''
+        action = self.actions[action_id]
+        self._persistence.mark_dirty(
+            action_id, lambda: self._save_action(action_id, action))
+
+    def _save_action(self, action_id, action):
+        '''Saves an action into the action store if it changed since it
+        was last saved. Called on the persistence worker thread.
+
+        Args:
+            action_id (str): The id of the action to save.
+            action (ProgrammedAction): The action.
+        '''
+        version = action.get_version()
+        if self._saved_versions.get(action_id) != version:
+            action.save(self._store)
+            self._saved_versions[action_id] = version
+
     def _selected_step_cb(self, selected_step):
         '''Updates the selected step when interactive markers are
         clicked on.
@@ -452,8 +568,9 @@ class Session:
         for action_id in session_actions:
             self.actions[action_id] = ProgrammedAction(self._world, action_id,
                                                        self._selected_step_cb)
-            # Load each action's data from a ROS bag.
-            self.actions[action_id].load(self._data_dir)
+            # Load each action's data from the action store (or its old
+            # ROS bag).
+            self.actions[action_id].load(self._store, self._data_dir)
 
         # Select the correct starting action.
         self.current_action_id = exp_state[YAML_KEY_CURIDX]
@@ -0,0 +1,558 @@
+'''A compact, column-oriented store for the steps of an action.'''
+
+# ######################################################################
+# Imports
+# ######################################################################
+
+# Core ROS imports come first.
+import roslib
+roslib.load_manifest('pr2_pbd_interaction')
+import rospy
+
+# System builtins
+import threading
+
+# 3rd party
+import numpy as np
+
+# ROS builtins
+from geometry_msgs.msg import Point, Pose, Quaternion, Vector3
+
+# Local
+from pr2_arm_control.msg import Side, GripperState
+from pr2_pbd_interaction.msg import (ArmState, ActionStepSequence, ActionStep,
+                                     ArmTarget, ArmTrajectory, GripperAction,
+                                     Landmark)
+
+# ######################################################################
+# Module level constants
+# ######################################################################
+
+# Columns are indexed by arm; make sure that matches Side.
+ARM_INDICES = (Side.RIGHT, Side.LEFT)
+
+# Poses are stored as (x, y, z, qx, qy, qz, qw).
+POSE_SIZE = 7
+
+# Joint poses are padded to (at least) this many joints with NaN.
+N_ARM_JOINTS = 7
+
+# The per-step columns of a StepTable.
+STEP_COLUMNS = ('types', 'ee_poses', 'joint_poses', 'n_joints', 'velocities',
+                'gripper_states', 'ref_frames', 'landmark_ids',
+                'traj_ref_frames', 'traj_landmark_ids', 'traj_starts',
+                'traj_lengths')
+
+# The per-trajectory-point columns of a StepTable.
+POINT_COLUMNS = ('point_ee_poses', 'point_joint_poses', 'point_n_joints',
+                 'point_ref_frames', 'point_landmark_ids', 'point_timing')
+
+# ######################################################################
+# Module level functions
+# ######################################################################
+
+
+def get_pose_row(pose):
+    '''Returns pose as a POSE_SIZE-tuple.
+
+    Args:
+        pose (Pose)
+
+    Returns:
+        (float)
+    '''
+    return (pose.position.x, pose.position.y, pose.position.z,
+            pose.orientation.x, pose.orientation.y, pose.orientation.z,
+            pose.orientation.w)
+
+
+def get_pose(row):
+    '''Returns a new Pose from a row as returned by get_pose_row(...).
+
+    Args:
+        row (np.ndarray): POSE_SIZE floats.
+
+    Returns:
+        Pose
+    '''
+    return Pose(Point(row[0], row[1], row[2]),
+                Quaternion(row[3], row[4], row[5], row[6]))
+
+
+def _get_arm_states(action_step):
+    '''Returns all arm states of a step: those of its arm target and,
+    for trajectories, those of the trajectory points.
+
+    Args:
+        action_step (ActionStep)
+
+    Returns:
+        [ArmState]
+    '''
+    arm_states = [action_step.armTarget.rArm, action_step.armTarget.lArm]
+    if action_step.type == ActionStep.ARM_TRAJECTORY:
+        arm_states += action_step.armTrajectory.rArm
+        arm_states += action_step.armTrajectory.lArm
+    return arm_states
+
+
+def _get_n_points(action_step):
+    '''Returns the number of trajectory points of a step.
+
+    Args:
+        action_step (ActionStep)
+
+    Returns:
+        int: 0 unless action_step is a trajectory.
+    '''
+    if action_step.type == ActionStep.ARM_TRAJECTORY:
+        return len(action_step.armTrajectory.timing)
+    return 0
+
+
+def _nans(shape):
+    '''Returns a float array of shape filled with NaN. (np.full needs
+    numpy 1.8, newer than what ships with hydro.)
+
+    Args:
+        shape (tuple(int))
+
+    Returns:
+        numpy.ndarray
+    '''
+    array = np.empty(shape)
+    array.fill(np.nan)
+    return array
+
+
+# ######################################################################
+# Classes
+# ######################################################################
+
+
+class LandmarkTable(object):
+    '''The distinct landmarks referenced by the steps of an action.
+
+    Rows are only ever added, so all versions of an action's StepTable
+    can share one LandmarkTable: a version only refers to rows that
+    existed when it was made.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}
+        self.types = []
+        self.names = []
+        self.poses = []
+        self.dimensions = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, landmark):
+        '''Returns the row of landmark, adding it if it is new.
+
+        Args:
+            landmark (Landmark)
+
+        Returns:
+            int
+        '''
+        pose = get_pose_row(landmark.pose)
+        dimensions = (landmark.dimensions.x, landmark.dimensions.y,
+                      landmark.dimensions.z)
+        key = (landmark.type, landmark.name, pose, dimensions)
+        self._lock.acquire()
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self.names)
+            self.types.append(landmark.type)
+            self.poses.append(pose)
+            self.dimensions.append(dimensions)
+            # Append the name last; its length is the number of rows.
+            self.names.append(landmark.name)
+            self._rows[key] = row
+        self._lock.release()
+        return row
+
+    def get_landmark(self, row):
+        '''Makes the Landmark msg for one row.
+
+        Args:
+            row (int)
+
+        Returns:
+            Landmark
+        '''
+        return Landmark(self.types[row], self.names[row],
+                        get_pose(self.poses[row]),
+                        Vector3(*self.dimensions[row]))
+
+
+class StepTable(object):
+    '''The steps of an action, stored column-wise in NumPy arrays
+    instead of as a sequence of nested ActionStep messages.
+
+    Row i holds step i; where there is a second dimension of size 2 it
+    is indexed by arm (Side.RIGHT, Side.LEFT). Reference landmarks are
+    interned: steps refer to rows of a LandmarkTable that holds each
+    distinct landmark once.
+
+    A StepTable is frozen once it is made, so it can be shared freely
+    (e.g. with an execution that must not see later edits). Editing
+    methods (replace_step(...), ...) return a new version instead,
+    which shares the landmark table. Messages are made from it only
+    when asked for with to_msg() or get_step(...).
+
+    The points of trajectory steps are stored the same way, in point
+    columns (point_ee_poses, ...): trajectory step i has the
+    traj_lengths[i] points from row traj_starts[i] on.
+
+    Only the fields the rest of the system uses are kept; pre- and
+    post-conditions (which are unused) are dropped, the same as
+    ProgrammedAction._copy_action_step(...) does.
+    '''
+
+    def __init__(self, action_steps=[], landmarks=None):
+        '''
+        Args:
+            action_steps ([ActionStep], optional): The steps to store.
+                Defaults to no steps.
+            landmarks (LandmarkTable, optional): The landmark table to
+                add to. Defaults to None, in which case a new one is
+                made.
+        '''
+        if landmarks is None:
+            landmarks = LandmarkTable()
+        self.landmarks = landmarks
+        n_joints = max([N_ARM_JOINTS] + [
+            len(arm_state.joint_pose) for step in action_steps
+            for arm_state in _get_arm_states(step)])
+        self._allocate(len(action_steps), n_joints,
+                       sum(_get_n_points(step) for step in action_steps))
+        for i in range(len(action_steps)):
+            self._set_row(i, action_steps[i])
+        self._freeze()
+
+    @staticmethod
+    def from_msg(seq):
+        '''Creates a StepTable from an ActionStepSequence ROS msg.
+
+        Args:
+            seq (ActionStepSequence)
+
+        Returns:
+            StepTable
+        '''
+        return StepTable(seq.seq)
+
+    def to_msg(self):
+        '''Creates an ActionStepSequence ROS msg from this StepTable.
+
+        The messages are new each time, so they can be changed freely.
+
+        Returns:
+            ActionStepSequence
+        '''
+        seq = ActionStepSequence()
+        for i in range(len(self)):
+            seq.seq.append(self.get_step(i))
+        return seq
+
+    def __len__(self):
+        return len(self.types)
+
+    def replace_step(self, index, action_step):
+        '''Returns a new version of this table with one step replaced.
+
+        Args:
+            index (int): Index (0-based) of the step to replace.
+            action_step (ActionStep): The new step.
+
+        Returns:
+            StepTable
+        '''
+        table = self._derive(np.arange(len(self)), len(self),
+                             _get_n_points(action_step))
+        table._set_row(index, action_step)
+        table._freeze()
+        return table
+
+    def append_step(self, action_step):
+        '''Returns a new version of this table with a step added at
+        the end.
+
+        Args:
+            action_step (ActionStep): The new step.
+
+        Returns:
+            StepTable
+        '''
+        table = self._derive(np.arange(len(self)), len(self) + 1,
+                             _get_n_points(action_step))
+        table._set_row(len(self), action_step)
+        table._freeze()
+        return table
+
+    def delete_step(self, index):
+        '''Returns a new version of this table with one step removed.
+
+        Args:
+            index (int): Index (0-based) of the step to remove.
+
+        Returns:
+            StepTable
+        '''
+        table = self._derive(np.delete(np.arange(len(self)), index),
+                             len(self) - 1)
+        table._freeze()
+        return table
+
+    def get_step(self, index):
+        '''Makes the ActionStep msg for one step.
+
+        Args:
+            index (int): Index (0-based) of the step.
+
+        Returns:
+            ActionStep
+        '''
+        step = ActionStep()
+        step.type = int(self.types[index])
+        step.armTarget = ArmTarget(
+            self._get_arm_state(index, Side.RIGHT),
+            self._get_arm_state(index, Side.LEFT),
+            float(self.velocities[index, Side.RIGHT]),
+            float(self.velocities[index, Side.LEFT]))
+        step.gripperAction = GripperAction(
+            GripperState(int(self.gripper_states[index, Side.RIGHT])),
+            GripperState(int(self.gripper_states[index, Side.LEFT])))
+        if step.type == ActionStep.ARM_TRAJECTORY:
+            step.armTrajectory = self._get_trajectory(index)
+        return step
+
+    def is_object_required(self):
+        '''Returns whether any step is relative to an object in the
+        world (instead of absolute).
+
+        Returns:
+            bool
+        '''
+        # Trajectories are relative to their own reference frames.
+        is_trajectory = (self.types == ActionStep.ARM_TRAJECTORY)[:, np.newaxis]
+        ref_frames = np.where(is_trajectory, self.traj_ref_frames,
+                              self.ref_frames)
+        return bool(np.any(ref_frames == ArmState.OBJECT))
+
+    def get_gripper_states(self, arm_index):
+        '''Returns the gripper states of all steps for arm arm_index.
+
+        Args:
+            arm_index (int): Side.RIGHT or Side.LEFT
+
+        Returns:
+            [int]: Each element is either GripperState.OPEN or
+                GripperState.CLOSED.
+        '''
+        return self.gripper_states[:, arm_index].tolist()
+
+    def get_ref_frame_names(self, arm_index):
+        '''Returns the names of the reference landmarks of all steps'
+        arm targets for arm arm_index.
+
+        Args:
+            arm_index (int): Side.RIGHT or Side.LEFT
+
+        Returns:
+            [str]
+        '''
+        names = self.landmarks.names
+        return [names[landmark_id]
+                for landmark_id in self.landmark_ids[:, arm_index]]
+
+    # ##################################################################
+    # Instance methods: Internal ("private")
+    # ##################################################################
+
+    def _allocate(self, n_steps, n_joints, n_points=0):
+        '''Makes the (empty) columns.
+
+        Args:
+            n_steps (int): The number of rows.
+            n_joints (int): The width of the joint pose columns.
+            n_points (int, optional): The number of trajectory point
+                rows. Defaults to 0.
+        '''
+        self.types = np.zeros(n_steps, dtype=np.uint8)
+        self.ee_poses = np.zeros((n_steps, 2, POSE_SIZE))
+        self.joint_poses = _nans((n_steps, 2, n_joints))
+        self.n_joints = np.zeros((n_steps, 2), dtype=np.uint8)
+        self.velocities = np.zeros((n_steps, 2))
+        self.gripper_states = np.zeros((n_steps, 2), dtype=np.uint8)
+        self.ref_frames = np.zeros((n_steps, 2), dtype=np.uint8)
+        self.landmark_ids = np.zeros((n_steps, 2), dtype=np.int32)
+        self.traj_ref_frames = np.zeros((n_steps, 2), dtype=np.uint8)
+        self.traj_landmark_ids = np.zeros((n_steps, 2), dtype=np.int32)
+        self.traj_starts = np.zeros(n_steps, dtype=np.int32)
+        self.traj_lengths = np.zeros(n_steps, dtype=np.int32)
+        self.point_ee_poses = np.zeros((n_points, 2, POSE_SIZE))
+        self.point_joint_poses = _nans((n_points, 2, n_joints))
+        self.point_n_joints = np.zeros((n_points, 2), dtype=np.uint8)
+        self.point_ref_frames = np.zeros((n_points, 2), dtype=np.uint8)
+        self.point_landmark_ids = np.zeros((n_points, 2), dtype=np.int32)
+        # Nanoseconds from the start of the trajectory.
+        self.point_timing = np.zeros(n_points, dtype=np.int64)
+        # The number of point rows filled in so far.
+        self._n_points = 0
+
+    def _derive(self, indices, n_steps, n_new_points=0):
+        '''Starts a new version of this table. It is not frozen yet,
+        so the caller can fill in rows before calling _freeze().
+
+        Args:
+            indices (np.ndarray): The rows of this table that become
+                the first rows of the new one, in order.
+            n_steps (int): The number of rows of the new table; rows
+                after the copied ones are empty.
+            n_new_points (int, optional): The number of trajectory
+                points the caller will fill in. Defaults to 0.
+
+        Returns:
+            StepTable
+        '''
+        # Only the points of the copied rows are copied, so points of
+        # deleted (or replaced) trajectories don't pile up.
+        lengths = self.traj_lengths[indices]
+        point_indices = np.zeros(0, dtype=np.int32)
+        if np.any(lengths > 0):
+            point_indices = np.concatenate([
+                np.arange(start, start + length) for start, length in
+                zip(self.traj_starts[indices], lengths)])
+        n_points = len(point_indices)
+        table = StepTable(landmarks=self.landmarks)
+        table._allocate(n_steps, self.joint_poses.shape[2],
+                        n_points + n_new_points)
+        for name in STEP_COLUMNS:
+            getattr(table, name)[:len(indices)] = getattr(self, name)[indices]
+        for name in POINT_COLUMNS:
+            getattr(table, name)[:n_points] = getattr(self,
+                                                      name)[point_indices]
+        table.traj_starts[:len(indices)] = np.cumsum(lengths) - lengths
+        table._n_points = n_points
+        return table
+
+    def _set_row(self, index, action_step):
+        '''Fills in one row from a step (and, for a trajectory, the
+        next free point rows from its points).
+
+        Args:
+            index (int): Index (0-based) of the step.
+            action_step (ActionStep)
+        '''
+        self.types[index] = action_step.type
+        gripper_action = action_step.gripperAction
+        self.gripper_states[index] = (gripper_action.rGripper.state,
+                                      gripper_action.lGripper.state)
+        target = action_step.armTarget
+        self.velocities[index] = (target.rArmVelocity, target.lArmVelocity)
+        for arm_index, arm_state in zip(ARM_INDICES, (target.rArm,
+                                                     target.lArm)):
+            self._set_arm_state('', index, arm_index, arm_state)
+        self.traj_ref_frames[index] = 0
+        self.traj_landmark_ids[index] = 0
+        self.traj_starts[index] = self._n_points
+        self.traj_lengths[index] = 0
+        if action_step.type != ActionStep.ARM_TRAJECTORY:
+            return
+        trajectory = action_step.armTrajectory
+        self.traj_ref_frames[index] = (trajectory.rRefFrame,
+                                       trajectory.lRefFrame)
+        self.traj_landmark_ids[index] = (
+            self.landmarks.intern(trajectory.rRefFrameLandmark),
+            self.landmarks.intern(trajectory.lRefFrameLandmark))
+        for j in range(len(trajectory.timing)):
+            point = self._n_points + j
+            self.point_timing[point] = trajectory.timing[j].to_nsec()
+            for arm_index, arm_states in zip(ARM_INDICES, (trajectory.rArm,
+                                                          trajectory.lArm)):
+                self._set_arm_state('point_', point, arm_index,
+                                    arm_states[j])
+        self.traj_lengths[index] = len(trajectory.timing)
+        self._n_points += len(trajectory.timing)
+
+    def _set_arm_state(self, prefix, row, arm_index, arm_state):
+        '''Fills in one arm of one row from an arm state.
+
+        Args:
+            prefix (str): '' for the step columns, 'point_' for the
+                trajectory point columns.
+            row (int): The row to fill in.
+            arm_index (int): Side.RIGHT or Side.LEFT
+            arm_state (ArmState)
+        '''
+        n_arm_joints = len(arm_state.joint_pose)
+        if n_arm_joints > self.joint_poses.shape[2]:
+            # Widen both joint pose columns, which have the same width.
+            for name in ['joint_poses', 'point_joint_poses']:
+                column = getattr(self, name)
+                joint_poses = _nans(column.shape[:2] + (n_arm_joints,))
+                joint_poses[:, :, :column.shape[2]] = column
+                setattr(self, name, joint_poses)
+        getattr(self, prefix + 'ee_poses')[row, arm_index] = get_pose_row(
+            arm_state.ee_pose)
+        joint_poses = getattr(self, prefix + 'joint_poses')
+        joint_poses[row, arm_index] = np.nan
+        joint_poses[row, arm_index, :n_arm_joints] = arm_state.joint_pose
+        getattr(self, prefix + 'n_joints')[row, arm_index] = n_arm_joints
+        getattr(self, prefix + 'ref_frames')[row, arm_index] = (
+            arm_state.refFrame)
+        getattr(self, prefix + 'landmark_ids')[row, arm_index] = (
+            self.landmarks.intern(arm_state.refFrameLandmark))
+
+    def _freeze(self):
+        '''Makes the columns read-only.'''
+        for name in STEP_COLUMNS + POINT_COLUMNS:
+            getattr(self, name).flags.writeable = False
+
+    def _get_arm_state(self, index, arm_index, prefix=''):
+        '''Makes the ArmState msg for one arm of one row.
+
+        Args:
+            index (int): Index (0-based) of the row.
+            arm_index (int): Side.RIGHT or Side.LEFT
+            prefix (str, optional): '' for a step's arm target,
+                'point_' for a trajectory point. Defaults to ''.
+
+        Returns:
+            ArmState
+        '''
+        n_joints = getattr(self, prefix + 'n_joints')[index, arm_index]
+        return ArmState(
+            int(getattr(self, prefix + 'ref_frames')[index, arm_index]),
+            get_pose(getattr(self, prefix + 'ee_poses')[index, arm_index]),
+            getattr(self, prefix + 'joint_poses')[
+                index, arm_index, :n_joints].tolist(),
+            self.landmarks.get_landmark(
+                getattr(self, prefix + 'landmark_ids')[index, arm_index]))
+
+    def _get_trajectory(self, index):
+        '''Makes the ArmTrajectory msg of one (trajectory) step.
+
+        Args:
+            index (int): Index (0-based) of the step.
+
+        Returns:
+            ArmTrajectory
+        '''
+        start = int(self.traj_starts[index])
+        points = range(start, start + int(self.traj_lengths[index]))
+        return ArmTrajectory(
+            [self._get_arm_state(j, Side.RIGHT, 'point_') for j in points],
+            [self._get_arm_state(j, Side.LEFT, 'point_') for j in points],
+            [rospy.Duration(0, int(self.point_timing[j])) for j in points],
+            int(self.traj_ref_frames[index, Side.RIGHT]),
+            int(self.traj_ref_frames[index, Side.LEFT]),
+            self.landmarks.get_landmark(
+                self.traj_landmark_ids[index, Side.RIGHT]),
+            self.landmarks.get_landmark(
+                self.traj_landmark_ids[index, Side.LEFT]))
@@ -11,11 +11,19 @@ To transform the arm state to be relative to the base:
 To transform the arm state to be relative to a landmark:
     transformed_state = convert_ref_frame(arm_state, ArmState.OBJECT, landmark)
 
+To transform many arm states at once (e.g. a recorded trajectory):
+    transformed_states = convert_ref_frames(arm_states, ArmState.OBJECT,
+                                            landmark)
+
+To fit a bounding box to a segmented cluster:
+    pose, dimensions = get_bounding_box(get_points_array(cluster.points))
+
 More helper functions are available, see source for details.
 """
 
-import copy
+import itertools
 import threading
+from contextlib import contextmanager
 import numpy as np
 import rospy
 import tf
@@ -31,10 +39,16 @@ from pr2_pbd_interaction.msg import Landmark, ArmState
 from pr2_pbd_interaction.response import Response
 from pr2_social_gaze.msg import GazeGoal
 from world_landmark import WorldLandmark
+from async_result import AsyncResult, ResultTimeoutError
 
 # Two objects must be closer than this to be considered 'the same'.
 OBJ_SIMILAR_DIST_THRESHOLD = 0.075
 
+# How bounding boxes are fit to segmented clusters: aligned with the
+# base frame, or rotated about z to the cluster's principal axes.
+BBOX_AXIS_ALIGNED = 0
+BBOX_ORIENTED = 1
+
 # When adding objects, if they are closer than this they'll replace one
 # another.
 OBJ_ADD_DIST_THRESHOLD = 0.02
@@ -46,24 +60,54 @@ OBJ_NEAREST_DIST_THRESHOLD = 0.3
 # Landmark distances below this will be clamped to zero.
 OBJ_DIST_ZERO_CLAMP = 0.0001
 
+# Between segmentation snapshots, an object must have moved less than
+# this (on the table) to keep its landmark and name.
+OBJ_TRACK_DIST_THRESHOLD = 0.05
+
+# Quaternions with a squared norm below this are treated as the
+# identity rotation (matches tf.transformations).
+QUATERNION_EPS = np.finfo(float).eps * 4.0
+
+# Transform of the base frame relative to itself.
+IDENTITY_TRANSFORM = np.identity(4)
+
 # Scales
 SCALE_TEXT = Vector3(0.0, 0.0, 0.03)
 SURFACE_HEIGHT = 0.01  # 0.01 == 1cm (I think)
+SIDE_THICKNESS = 0.02  # Thickness of an object's side markers.
 OFFSET_OBJ_TEXT_Z = 0.06  # How high objects' labels are above them.
 
 # Colors
 COLOR_OBJ = ColorRGBA(0.2, 0.8, 0.0, 0.6)
 COLOR_SURFACE = ColorRGBA(0.8, 0.0, 0.4, 0.4)
 COLOR_TEXT = ColorRGBA(0.0, 0.0, 0.0, 0.5)
+COLOR_SIDE = ColorRGBA(0.0, 0.5, 0.5, 0.6)
 
 # Frames
 BASE_LINK = 'base_link'
 
+# Object sides, in the order their markers are created (two per axis).
+SIDE_NAMES = ['X-Minimum', 'X-Maximum', 'Y-Minimum', 'Y-Maximum',
+              'Z-Minimum', 'Z-Maximum']
+SIDE_AXES = np.arange(len(SIDE_NAMES)) // 2
+SIDE_SIGNS = np.array([-1.0, 1.0] * 3)
+
+# One row per object side: its center, its extents (as a box), its
+# orientation (the object's), its index into SIDE_NAMES and the index of
+# the object it belongs to (as in "thing <index>").
+SIDE_FACE_DTYPE = np.dtype([('center', np.float64, (3,)),
+                            ('extents', np.float64, (3,)),
+                            ('orientation', np.float64, (4,)),
+                            ('face', np.int8),
+                            ('object', np.int32)])
+
 # Time
 MARKER_DURATION = rospy.Duration(2)
-# How long to pause when waiting for external code, like gaze actions or
-# object segmentation, to finish before checking again.
-PAUSE_SECONDS = rospy.Duration(0.1)
+# How long to wait for the head to look down at the table.
+GAZE_TIMEOUT = rospy.Duration(10)
+# How long to wait for the objects to be updated when blocking on it,
+# in case the segmentation service hangs.
+OBJECTS_TIMEOUT = 60.0  # seconds
 
 
 def get_pose_from_transform(transform):
@@ -98,69 +142,250 @@ def get_matrix_from_pose(pose):
     transformation[:3, 3] = position
     return transformation
 
-def convert_ref_frame(arm_state, ref_frame, ref_frame_obj=Landmark()):
-    """Transforms an arm frame to a new ref. frame.
+def get_array_from_pose(pose):
+    """Returns the [x, y, z, qx, qy, qz, qw] row for a pose.
 
     Args:
-        arm_state (ArmState): The arm state to transform
+        pose (Pose)
+
+    Returns:
+        [float]: Seven floats; position followed by orientation.
+    """
+    pp, po = pose.position, pose.orientation
+    return [pp.x, pp.y, pp.z, po.x, po.y, po.z, po.w]
+
+def get_pose_from_array(row):
+    """Returns the Pose for a [x, y, z, qx, qy, qz, qw] row.
+
+    Args:
+        row (numpy.ndarray|[float]): Seven floats, as produced by
+            get_array_from_pose.
+
+    Returns:
+        Pose
+    """
+    return Pose(Point(row[0], row[1], row[2]),
+                Quaternion(row[3], row[4], row[5], row[6]))
+
+def get_matrices_from_pose_array(poses):
+    """Returns the stacked transformation matrices for a pose array.
+
+    This is the vectorized version of get_matrix_from_pose. As in
+    tf.transformations.quaternion_matrix, quaternions are normalized
+    and a (near) zero quaternion gives the identity rotation.
+
+    Args:
+        poses (numpy.ndarray): (N, 7) array of [x, y, z, qx, qy, qz, qw].
+
+    Returns:
+        numpy.ndarray: (N, 4, 4) homogeneous transforms.
+    """
+    poses = np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+    q = poses[:, 3:]
+    nq = np.einsum('ni,ni->n', q, q)
+    is_zero = nq < QUATERNION_EPS
+    scale = np.sqrt(2.0 / np.where(is_zero, 1.0, nq))
+    q = q * np.where(is_zero, 0.0, scale)[:, np.newaxis]
+    qq = np.einsum('ni,nj->nij', q, q)
+    transforms = np.zeros((poses.shape[0], 4, 4))
+    transforms[:, 0, 0] = 1.0 - qq[:, 1, 1] - qq[:, 2, 2]
+    transforms[:, 0, 1] = qq[:, 0, 1] - qq[:, 2, 3]
+    transforms[:, 0, 2] = qq[:, 0, 2] + qq[:, 1, 3]
+    transforms[:, 1, 0] = qq[:, 0, 1] + qq[:, 2, 3]
+    transforms[:, 1, 1] = 1.0 - qq[:, 0, 0] - qq[:, 2, 2]
+    transforms[:, 1, 2] = qq[:, 1, 2] - qq[:, 0, 3]
+    transforms[:, 2, 0] = qq[:, 0, 2] - qq[:, 1, 3]
+    transforms[:, 2, 1] = qq[:, 1, 2] + qq[:, 0, 3]
+    transforms[:, 2, 2] = 1.0 - qq[:, 0, 0] - qq[:, 1, 1]
+    transforms[:, :3, 3] = poses[:, :3]
+    transforms[:, 3, 3] = 1.0
+    return transforms
+
+
+def get_pose_array_from_matrices(transforms):
+    """Returns the pose array for stacked transformation matrices.
+
+    This is the vectorized version of get_pose_from_transform, and
+    follows tf.transformations.quaternion_from_matrix branch for
+    branch so both give the same quaternion sign.
+
+    Args:
+        transforms (numpy.ndarray): (N, 4, 4) homogeneous transforms.
+
+    Returns:
+        numpy.ndarray: (N, 7) array of [x, y, z, qx, qy, qz, qw].
+    """
+    m = np.asarray(transforms, dtype=np.float64).reshape(-1, 4, 4)
+    rows = np.arange(m.shape[0])
+    m33 = m[:, 3, 3]
+    trace = np.einsum('nii->n', m)
+
+    # Branch used when the trace dominates.
+    q_trace = np.column_stack((m[:, 2, 1] - m[:, 1, 2],
+                               m[:, 0, 2] - m[:, 2, 0],
+                               m[:, 1, 0] - m[:, 0, 1], trace))
+
+    # Branch keyed on the largest diagonal element otherwise.
+    diag = np.einsum('nii->ni', m[:, :3, :3])
+    i = np.where(diag[:, 1] > diag[:, 0], 1, 0)
+    i = np.where(diag[:, 2] > diag[rows, i], 2, i)
+    j = (i + 1) % 3
+    k = (i + 2) % 3
+    t_diag = m[rows, i, i] - (m[rows, j, j] + m[rows, k, k]) + m33
+    q_diag = np.zeros((m.shape[0], 4))
+    q_diag[rows, i] = t_diag
+    q_diag[rows, j] = m[rows, i, j] + m[rows, j, i]
+    q_diag[rows, k] = m[rows, k, i] + m[rows, i, k]
+    q_diag[:, 3] = m[rows, k, j] - m[rows, j, k]
+
+    use_trace = trace > m33
+    q = np.where(use_trace[:, np.newaxis], q_trace, q_diag)
+    t = np.where(use_trace, trace, t_diag)
+    q *= (0.5 / np.sqrt(t * m33))[:, np.newaxis]
+    return np.hstack((m[:, :3, 3], q))
+
+def get_rigid_inverse(transforms):
+    """Returns the inverse of rigid transformation matrices.
+
+    Uses the closed form (R^T, -R^T t) instead of a general matrix
+    inverse.
+
+    Args:
+        transforms (numpy.ndarray): (4, 4) or (N, 4, 4) rigid transforms.
+
+    Returns:
+        numpy.ndarray: Inverse(s), with the same shape as transforms.
+    """
+    transforms = np.asarray(transforms, dtype=np.float64)
+    inverses = np.zeros(transforms.shape)
+    rotations_t = np.swapaxes(transforms[..., :3, :3], -1, -2)
+    inverses[..., :3, :3] = rotations_t
+    inverses[..., :3, 3] = -np.einsum('...ij,...j->...i', rotations_t,
+                                      transforms[..., :3, 3])
+    inverses[..., 3, 3] = 1.0
+    return inverses
+
+def convert_pose_array(poses, source_poses=None, target_pose=None):
+    """Transforms an array of poses from their source reference frames
+    into a single target reference frame in one pass.
+
+    Reference frames are given by their pose in the base frame; None
+    means the base frame itself.
+
+    Args:
+        poses (numpy.ndarray): (N, 7) array of [x, y, z, qx, qy, qz, qw],
+            each row expressed in its source frame.
+        source_poses (numpy.ndarray|None): Either a single (7,) pose
+            shared by all rows or an (N, 7) array with one source frame
+            per row. Defaults to None (poses are in the base frame).
+        target_pose (numpy.ndarray|None): (7,) pose of the frame to
+            transform into. Defaults to None (the base frame).
+
+    Returns:
+        numpy.ndarray: (N, 7) array of the transformed poses.
+    """
+    source_to_base = None
+    base_to_target = None
+    if source_poses is not None:
+        source_to_base = get_matrices_from_pose_array(source_poses)
+    if target_pose is not None:
+        base_to_target = get_rigid_inverse(
+            get_matrices_from_pose_array(target_pose)[0])
+    return _transform_pose_array(poses, source_to_base, base_to_target)
+
+def convert_ref_frames(arm_states, ref_frame, ref_frame_obj=Landmark()):
+    """Transforms a list of arm states to a new ref. frame.
+
+    All conversions are done in a single call to convert_pose_array, so
+    this should be preferred over calling convert_ref_frame in a loop
+    (e.g. for the samples of a trajectory).
+
+    Args:
+        arm_states ([ArmState]): The arm states to transform. They may
+            be relative to different reference frames.
         ref_frame (int): One of ArmState.*, the desired reference frame to
             transform into.
         ref_frame_obj (Landmark): The landmark to transform relative to.
 
     Returns:
-        ArmState: A copy of arm_state, but transformed.
-    """
-    output_state = copy.deepcopy(arm_state)
-    ref_frame_obj_copy = copy.deepcopy(ref_frame_obj)
-    if ref_frame == ArmState.ROBOT_BASE:
-        if arm_state.refFrame == ArmState.ROBOT_BASE:
-            pass  # Nothing to do
-        elif arm_state.refFrame == ArmState.OBJECT:
-            # Transform from object to robot base.
-            ee_in_obj = get_matrix_from_pose(arm_state.ee_pose)
-            obj_pose = arm_state.refFrameLandmark.pose  # In base frame
-            obj_to_base = get_matrix_from_pose(obj_pose)
-            abs_ee_pose = get_pose_from_transform(
-                np.dot(obj_to_base, ee_in_obj))
-            output_state.ee_pose = abs_ee_pose
-            output_state.refFrame = ArmState.ROBOT_BASE
-            output_state.refFrameLandmark = Landmark()
-        else:
-            rospy.logerr(
-                'Unhandled reference frame conversion: {} to {}'.format(
-                    arm_state.refFrame, ref_frame))
-    elif ref_frame == ArmState.OBJECT:
-        if arm_state.refFrame == ArmState.ROBOT_BASE:
-            # Transform from robot base to provided object.
-            arm_in_base = get_matrix_from_pose(arm_state.ee_pose)
-            base_to_obj = np.linalg.inv(
-                get_matrix_from_pose(ref_frame_obj.pose))
-            rel_ee_pose = get_pose_from_transform(
-                np.dot(base_to_obj, arm_in_base))
-            output_state.ee_pose = rel_ee_pose
-            output_state.refFrame = ArmState.OBJECT
-            output_state.refFrameLandmark = ref_frame_obj_copy
-        elif arm_state.refFrame == ArmState.OBJECT:
-            if arm_state.refFrameLandmark.name == ref_frame_obj.name:
+        [ArmState]: The transformed arm states. Arm states that are
+            already in the requested frame are returned as they are
+            (not copied). Converted arm states are new ArmState objects
+            that share their joint_pose list with the input and, for
+            object-relative results, share one shallow copy of
+            ref_frame_obj (and its pose and dimensions). Treat the
+            results as read-only unless you replace fields wholesale.
+    """
+    output_states = list(arm_states)
+    to_convert = []
+    for i, arm_state in enumerate(arm_states):
+        if ref_frame == ArmState.ROBOT_BASE:
+            if arm_state.refFrame == ArmState.ROBOT_BASE:
                 pass  # Nothing to do
+            elif arm_state.refFrame == ArmState.OBJECT:
+                to_convert.append(i)
+            else:
+                rospy.logerr(
+                    'Unhandled reference frame conversion: {} to {}'.format(
+                        arm_state.refFrame, ref_frame))
+        elif ref_frame == ArmState.OBJECT:
+            if arm_state.refFrame == ArmState.ROBOT_BASE:
+                to_convert.append(i)
+            elif arm_state.refFrame == ArmState.OBJECT:
+                if arm_state.refFrameLandmark.name == ref_frame_obj.name:
+                    pass  # Nothing to do
+                else:
+                    to_convert.append(i)
             else:
-                # Transform from arm state's object to provided object.
-                ee_in_source_obj = get_matrix_from_pose(arm_state.ee_pose)
-                source_obj_to_base = get_matrix_from_pose(
-                    arm_state.refFrameLandmark.pose)
-                base_to_target_obj = np.linalg.inv(
-                    get_matrix_from_pose(ref_frame_obj.pose))
-                rel_ee_pose = get_pose_from_transform(
-                    np.dot(np.dot(base_to_target_obj, source_obj_to_base),
-                           ee_in_source_obj))
-                output_state.ee_pose = rel_ee_pose
-                output_state.refFrame = ArmState.OBJECT
-                output_state.refFrameLandmark = ref_frame_obj_copy
+                rospy.logerr(
+                    'Unhandled reference frame conversion: {} to {}'.format(
+                        arm_state.refFrame, ref_frame))
+    if len(to_convert) == 0:
+        return output_states
+
+    # Frames the arm states are currently in; base-relative ones use
+    # the identity transform.
+    poses = np.empty((len(to_convert), 7))
+    source_to_base = np.empty((len(to_convert), 4, 4))
+    for row, i in enumerate(to_convert):
+        arm_state = arm_states[i]
+        poses[row] = get_array_from_pose(arm_state.ee_pose)
+        if arm_state.refFrame == ArmState.OBJECT:
+            source_to_base[row] = landmark_transforms.get(
+                arm_state.refFrameLandmark)[0]
         else:
-            rospy.logerr(
-                'Unhandled reference frame conversion: {} to {}'.format(
-                    arm_state.refFrame, ref_frame))
-    return output_state
+            source_to_base[row] = IDENTITY_TRANSFORM
+    if ref_frame == ArmState.OBJECT:
+        base_to_target = landmark_transforms.get(ref_frame_obj)[1]
+    else:
+        base_to_target = None
+    converted = _transform_pose_array(poses, source_to_base, base_to_target)
+
+    if ref_frame == ArmState.OBJECT:
+        landmark = _copy_landmark(ref_frame_obj)
+    else:
+        landmark = Landmark()
+    for row, i in enumerate(to_convert):
+        output_states[i] = ArmState(ref_frame,
+                                    get_pose_from_array(converted[row]),
+                                    arm_states[i].joint_pose, landmark)
+    return output_states
+
+def convert_ref_frame(arm_state, ref_frame, ref_frame_obj=Landmark()):
+    """Transforms an arm frame to a new ref. frame.
+
+    Args:
+        arm_state (ArmState): The arm state to transform
+        ref_frame (int): One of ArmState.*, the desired reference frame to
+            transform into.
+        ref_frame_obj (Landmark): The landmark to transform relative to.
+
+    Returns:
+        ArmState: arm_state itself if it is already in the requested
+            frame, otherwise a new, transformed ArmState that shares
+            unchanged fields with arm_state (see convert_ref_frames).
+    """
+    return convert_ref_frames([arm_state], ref_frame, ref_frame_obj)[0]
 
 
 def get_absolute_pose(arm_state):
@@ -269,11 +494,513 @@ def get_most_similar_obj(ref_object, ref_frame_list):
     # Regardless, return the "closest object," which may be None.
     return chosen_obj
 
+def associate_landmarks(prev_landmarks, new_landmarks):
+    """Matches previously referenced landmarks to new landmarks in one
+    pass, e.g. after the world changes.
+
+    Landmarks are compared as in object_dissimilarity. Each distinct
+    previous landmark (by name) is matched to at most one new landmark
+    and vice versa, greedily taking the most similar remaining pair
+    first, so all steps that referenced the same landmark end up
+    referencing the same new one.
+
+    Args:
+        prev_landmarks ([Landmark]): Landmarks currently referenced
+            (duplicates are fine).
+        new_landmarks ([Landmark]): The current reference frames.
+
+    Returns:
+        {str: Landmark|None}: Maps each previous landmark's name to its
+            new landmark, or to None if no new landmark was similar
+            enough.
+    """
+    mapping = {}
+    names = []
+    prev_dims = []
+    for landmark in prev_landmarks:
+        if landmark.name not in mapping:
+            mapping[landmark.name] = None
+            names.append(landmark.name)
+            prev_dims.append(_get_dimensions_array(landmark))
+    if len(names) == 0 or len(new_landmarks) == 0:
+        return mapping
+
+    new_dims = np.array([_get_dimensions_array(landmark)
+                         for landmark in new_landmarks])
+    diff = (np.array(prev_dims)[:, np.newaxis, :] -
+            new_dims[np.newaxis, :, :])
+    dissimilarity = np.sqrt(np.einsum('pkd,pkd->pk', diff, diff))
+    for prev_index, new_index in _greedy_match(dissimilarity,
+                                               OBJ_SIMILAR_DIST_THRESHOLD):
+        mapping[names[prev_index]] = new_landmarks[new_index]
+
+    for name in names:
+        if mapping[name] is None:
+            rospy.loginfo('Did not find a similar object for ' + name + '.')
+        else:
+            rospy.loginfo('Matched ' + name + ' to ' + mapping[name].name)
+    return mapping
+
+def get_points_array(points):
+    """Returns points (e.g. of a segmented cluster) as one contiguous
+    array.
+
+    Args:
+        points ([Point32]): Points with x, y and z.
+
+    Returns:
+        numpy.ndarray: (N, 3) float array.
+    """
+    coords = np.fromiter(
+        itertools.chain.from_iterable((pt.x, pt.y, pt.z) for pt in points),
+        dtype=float, count=3 * len(points))
+    return coords.reshape(len(points), 3)
+
+
+def get_bounding_box(points, method=BBOX_AXIS_ALIGNED):
+    """Fits a bounding box to a cluster of points.
+
+    Axis-aligned boxes are aligned with the base frame. Oriented boxes
+    keep z vertical (objects rest on the table) and rotate x and y to
+    the principal axes of the cluster's footprint, with x the major axis,
+    so rotated objects get tight boxes.
+
+    Args:
+        points (numpy.ndarray): (N, 3) points with N > 0, e.g. from
+            get_points_array(...).
+        method (int, optional): BBOX_AXIS_ALIGNED or BBOX_ORIENTED.
+            Defaults to BBOX_AXIS_ALIGNED.
+
+    Returns:
+        (Pose, Vector3): The center pose and dimensions of the box.
+    """
+    if method == BBOX_ORIENTED:
+        yaw = _get_principal_yaw(points[:, :2])
+    else:
+        yaw = 0.0
+    cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+    # Columns are the box's x and y axes in the base frame.
+    axes = np.array([[cos_yaw, -sin_yaw], [sin_yaw, cos_yaw]])
+
+    local_xy = np.dot(points[:, :2], axes)
+    mins = np.append(local_xy.min(axis=0), points[:, 2].min())
+    maxs = np.append(local_xy.max(axis=0), points[:, 2].max())
+    center = (mins + maxs) / 2
+    center_xy = np.dot(axes, center[:2])
+    dims = maxs - mins
+    pose = Pose(Point(float(center_xy[0]), float(center_xy[1]),
+                      float(center[2])),
+                Quaternion(0, 0, float(np.sin(yaw / 2)),
+                           float(np.cos(yaw / 2))))
+    return pose, Vector3(float(dims[0]), float(dims[1]), float(dims[2]))
+
+
+class LandmarkTransformCache(object):
+    """Caches the forward and inverse transforms of landmarks.
+
+    Entries are keyed by landmark name and are tagged with the cache's
+    revision counter, which World bumps whenever landmark poses may
+    have changed. Each entry also remembers the pose it was built from,
+    so stale Landmark copies that share a name with a current landmark
+    (e.g. those stored in saved action steps) are never given the wrong
+    transform.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._revision = 0
+        # name -> (revision, pose key, forward, inverse)
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_revision(self):
+        """Returns the current pose revision.
+
+        Returns:
+            int
+        """
+        return self._revision
+
+    def invalidate(self, name=None):
+        """Drops cached transforms and starts a new pose revision.
+
+        Args:
+            name (str, optional): Only drop the transform of the
+                landmark with this name. Defaults to None (drop all).
+        """
+        with self._lock:
+            self._revision += 1
+            if name is None:
+                self._entries = {}
+            else:
+                self._entries.pop(name, None)
+
+    def get(self, landmark):
+        """Returns the transforms for a landmark, computing them only if
+        they are not already cached.
+
+        Args:
+            landmark (Landmark)
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): Tuple of the (4, 4) landmark
+                to base transform and its (4, 4) rigid inverse. These
+                are shared; callers must not modify them.
+        """
+        pose_key = tuple(get_array_from_pose(landmark.pose))
+        with self._lock:
+            entry = self._entries.get(landmark.name)
+            if (entry is not None and entry[0] == self._revision and
+                    entry[1] == pose_key):
+                self.hits += 1
+                return entry[2], entry[3]
+            self.misses += 1
+            revision = self._revision
+        forward = get_matrices_from_pose_array(pose_key)[0]
+        inverse = get_rigid_inverse(forward)
+        forward.setflags(write=False)
+        inverse.setflags(write=False)
+        with self._lock:
+            if revision == self._revision:
+                self._entries[landmark.name] = (revision, pose_key, forward,
+                                                inverse)
+        return forward, inverse
+
+
+# Shared by all reference frame conversions.
+landmark_transforms = LandmarkTransformCache()
+
+class SideFaces(object):
+    """The side faces of a set of objects, which can be used as
+    reference frames.
+
+    The geometry of all faces is computed in one pass into a structured
+    array (see SIDE_FACE_DTYPE), six rows per object in the order the
+    objects were given. Landmark messages for the faces are only built
+    when asked for. Instances are not modified after construction;
+    build a new one when the objects change.
+    """
+
+    def __init__(self, landmarks=[], object_indices=[]):
+        """
+        Args:
+            landmarks ([Landmark], optional): The objects. Defaults to
+                none.
+            object_indices ([int], optional): For each object, the index
+                its sides are named after (e.g. 0 for "Obj #0 X-Minimum
+                Ref"). Defaults to none.
+        """
+        n_sides = len(SIDE_NAMES)
+        faces = np.zeros(n_sides * len(landmarks), dtype=SIDE_FACE_DTYPE)
+        if len(landmarks) > 0:
+            poses = np.array([get_array_from_pose(landmark.pose)
+                              for landmark in landmarks])
+            dims = np.array([_get_dimensions_array(landmark)
+                             for landmark in landmarks])
+            rotations = get_matrices_from_pose_array(poses)[:, :3, :3]
+            # (K, 6, 3): the object axis each face is normal to.
+            normals = rotations[:, :, SIDE_AXES].transpose(0, 2, 1)
+            offsets = 0.5 * SIDE_SIGNS * dims[:, SIDE_AXES]
+            centers = (poses[:, np.newaxis, :3] +
+                       offsets[:, :, np.newaxis] * normals)
+            extents = np.repeat(dims[:, np.newaxis, :], n_sides, axis=1)
+            extents[:, np.arange(n_sides), SIDE_AXES] = SIDE_THICKNESS
+
+            faces['center'] = centers.reshape(-1, 3)
+            faces['extents'] = extents.reshape(-1, 3)
+            faces['orientation'] = np.repeat(poses[:, 3:], n_sides, axis=0)
+            faces['face'] = np.tile(np.arange(n_sides), len(landmarks))
+            faces['object'] = np.repeat(object_indices, n_sides)
+        self._faces = faces
+        self._names = [
+            _get_side_name(obj, face) + ' Ref'
+            for obj, face in zip(faces['object'], faces['face'])]
+        self._name_index = dict(
+            (name, row) for row, name in enumerate(self._names))
+        # row -> Landmark, filled in as landmarks are asked for.
+        self._landmarks = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    def has_landmark(self, name):
+        """Returns whether there is a side with the reference frame name.
+
+        Args:
+            name (str): E.g. "Obj #0 X-Minimum Ref".
+
+        Returns:
+            bool
+        """
+        return name in self._name_index
+
+    def get_landmark(self, name):
+        """Returns the reference frame of a side, by name.
+
+        Args:
+            name (str): E.g. "Obj #0 X-Minimum Ref".
+
+        Returns:
+            Landmark|None: The side's landmark, or None if there is no
+                side called name.
+        """
+        row = self._name_index.get(name)
+        if row is None:
+            return None
+        return self._get_landmark(row)
+
+    def get_landmarks(self):
+        """Returns the reference frames of all sides.
+
+        Returns:
+            [Landmark]: Six per object, in order.
+        """
+        return [self._get_landmark(row) for row in range(len(self))]
+
+    def get_markers(self, position):
+        """Returns the markers for the sides of one object.
+
+        Args:
+            position (int): The object's position in the list the sides
+                were built from.
+
+        Returns:
+            [Marker]: The object's six side markers.
+        """
+        n_sides = len(SIDE_NAMES)
+        markers = []
+        for face in self._faces[position * n_sides:(position + 1) * n_sides]:
+            center, extents, q = (face['center'], face['extents'],
+                                  face['orientation'])
+            markers.append(Marker(
+                type=Marker.CUBE,
+                action=Marker.ADD,
+                id=int(face['object']) * 10 + int(face['face']),
+                ns=_get_side_name(face['object'], face['face']),
+                header=Header(frame_id=BASE_LINK),
+                color=COLOR_SIDE,
+                pose=Pose(Point(center[0], center[1], center[2]),
+                          Quaternion(q[0], q[1], q[2], q[3])),
+                scale=Vector3(extents[0], extents[1], extents[2])))
+        return markers
+
+    def _get_landmark(self, row):
+        """Returns (building it if needed) the landmark for a row.
+
+        Args:
+            row (int)
+
+        Returns:
+            Landmark
+        """
+        landmark = self._landmarks.get(row)
+        if landmark is None:
+            face = self._faces[row]
+            center, extents, q = (face['center'], face['extents'],
+                                  face['orientation'])
+            landmark = Landmark(
+                Landmark.TABLE_TOP, self._names[row],
+                Pose(Point(center[0], center[1], center[2]),
+                     Quaternion(q[0], q[1], q[2], q[3])),
+                Vector3(extents[0], extents[1], extents[2]))
+            self._landmarks[row] = landmark
+        return landmark
+
+
 # ##################################################################
 # Private helper functions
 # ##################################################################
 
 
+def _copy_landmark(landmark):
+    """Returns a shallow copy of landmark.
+
+    The copy can be renamed or re-posed by assignment without affecting
+    the original, but shares its pose and dimensions messages.
+
+    Args:
+        landmark (Landmark)
+
+    Returns:
+        Landmark
+    """
+    return Landmark(landmark.type, landmark.name, landmark.pose,
+                    landmark.dimensions)
+
+
+def _get_dimensions_array(landmark):
+    """Returns a landmark's dimensions as [x, y, z].
+
+    Args:
+        landmark (Landmark)
+
+    Returns:
+        [float]
+    """
+    dims = landmark.dimensions
+    return [dims.x, dims.y, dims.z]
+
+
+def _get_principal_yaw(points):
+    """Returns the heading of the major principal axis of 2D points.
+
+    Args:
+        points (numpy.ndarray): (N, 2) points.
+
+    Returns:
+        float: Yaw in (-pi/2, pi/2]; 0 for degenerate clusters.
+    """
+    centered = points - points.mean(axis=0)
+    eigenvalues, eigenvectors = np.linalg.eigh(np.dot(centered.T, centered))
+    major = eigenvectors[:, np.argmax(eigenvalues)]
+    yaw = np.arctan2(major[1], major[0])
+    # An eigenvector's sign is arbitrary, so fold yaw onto a half turn.
+    if yaw <= -np.pi / 2:
+        yaw += np.pi
+    elif yaw > np.pi / 2:
+        yaw -= np.pi
+    return yaw
+
+
+def _greedy_match(costs, max_cost):
+    """Matches rows to columns one-to-one, cheapest pair first.
+
+    Args:
+        costs (numpy.ndarray): (M, K) cost of matching each row to each
+            column.
+        max_cost (float): Pairs costing more than this are never
+            matched.
+
+    Returns:
+        [(int, int)]: The matched (row, column) pairs.
+    """
+    pairs = []
+    n_rows, n_cols = costs.shape
+    is_row_used = [False] * n_rows
+    is_col_used = [False] * n_cols
+    # A stable sort keeps ties in index order, as get_most_similar_obj
+    # does.
+    for flat in np.argsort(costs, axis=None, kind='mergesort'):
+        if len(pairs) == min(n_rows, n_cols):
+            break
+        row, col = divmod(int(flat), n_cols)
+        if costs[row, col] > max_cost:
+            break
+        if not is_row_used[row] and not is_col_used[col]:
+            pairs.append((row, col))
+            is_row_used[row] = True
+            is_col_used[col] = True
+    return pairs
+
+
+def _match_boxes(landmarks, boxes):
+    """Matches existing landmarks to newly detected boxes by position
+    (on the table) and size.
+
+    Args:
+        landmarks ([Landmark]): The currently tracked objects.
+        boxes ([(Pose, Vector3)]): Detected center poses and dimensions.
+
+    Returns:
+        [(int, int)]: Matched (landmark index, box index) pairs.
+    """
+    if len(landmarks) == 0 or len(boxes) == 0:
+        return []
+    centroids = np.array([get_array_from_pose(landmark.pose)[:3]
+                          for landmark in landmarks])
+    positions = np.array([get_array_from_pose(pose)[:3]
+                          for pose, __ in boxes])
+    distances = _get_distances(centroids, positions)
+    dims = np.array([_get_dimensions_array(landmark)
+                     for landmark in landmarks])
+    box_dims = np.array([[d.x, d.y, d.z] for __, d in boxes])
+    diff = dims[:, np.newaxis, :] - box_dims[np.newaxis, :, :]
+    dissimilarity = np.sqrt(np.einsum('kmd,kmd->km', diff, diff))
+
+    costs = distances + dissimilarity
+    costs[(distances > OBJ_TRACK_DIST_THRESHOLD) |
+          (dissimilarity > OBJ_SIMILAR_DIST_THRESHOLD)] = np.inf
+    return _greedy_match(
+        costs, OBJ_TRACK_DIST_THRESHOLD + OBJ_SIMILAR_DIST_THRESHOLD)
+
+
+def _is_box_changed(landmark, pose, dimensions):
+    """Returns whether a landmark's box differs from pose and
+    dimensions.
+
+    Args:
+        landmark (Landmark)
+        pose (Pose)
+        dimensions (Vector3)
+
+    Returns:
+        bool
+    """
+    old = (get_array_from_pose(landmark.pose) +
+           _get_dimensions_array(landmark))
+    new = get_array_from_pose(pose) + [dimensions.x, dimensions.y,
+                                       dimensions.z]
+    return np.max(np.abs(np.array(old) - np.array(new))) > OBJ_DIST_ZERO_CLAMP
+
+
+def _get_side_name(obj_index, face):
+    """Returns the name of an object's side, which also names its marker
+    control (its reference frame adds " Ref").
+
+    Args:
+        obj_index (int): The index the object is named after.
+        face (int): Index into SIDE_NAMES.
+
+    Returns:
+        str: E.g. "Obj #0 X-Minimum".
+    """
+    return 'Obj #' + str(obj_index) + ' ' + SIDE_NAMES[face]
+
+
+def _get_distances(points, centroids, is_on_table=True):
+    """Returns the distances between every point and every centroid.
+
+    This is the vectorized version of pose_distance.
+
+    Args:
+        points (numpy.ndarray): (M, 3) positions.
+        centroids (numpy.ndarray): (K, 3) positions.
+        is_on_table (bool, optional): Whether the objects are on the
+            table (if so, disregards z-values in computations).
+
+    Returns:
+        numpy.ndarray: (M, K) distances.
+    """
+    n_dims = 2 if is_on_table else 3
+    diff = (points[:, np.newaxis, :n_dims] -
+            centroids[np.newaxis, :, :n_dims])
+    return np.sqrt(np.einsum('mkd,mkd->mk', diff, diff))
+
+
+def _transform_pose_array(poses, source_to_base=None, base_to_target=None):
+    """Applies frame transforms to an array of poses in one pass.
+
+    Args:
+        poses (numpy.ndarray): (N, 7) array of [x, y, z, qx, qy, qz, qw].
+        source_to_base (numpy.ndarray|None): (4, 4), (1, 4, 4) or
+            (N, 4, 4) transforms from the poses' frames to the base, or
+            None if the poses are already in the base frame.
+        base_to_target (numpy.ndarray|None): (4, 4) transform from the
+            base to the target frame, or None to stay in the base frame.
+
+    Returns:
+        numpy.ndarray: (N, 7) array of the transformed poses.
+    """
+    transforms = get_matrices_from_pose_array(poses)
+    if source_to_base is not None:
+        transforms = np.einsum('...ij,...jk->...ik', source_to_base,
+                               transforms)
+    if base_to_target is not None:
+        transforms = np.einsum('ij,njk->nik', base_to_target, transforms)
+    return get_pose_array_from_matrices(transforms)
+
+
 def _get_mesh_marker(marker, mesh):
     """Generates and returns a marker from a mesh.
 
@@ -354,8 +1081,12 @@ class World:
 
     To populate the object list, call:
         world.update_object_pose()
+    or, to get an AsyncResult instead of waiting:
+        world.update_object_pose_async()
     This causes the robot to look down and segment the tabletop scene.
     The detected objects will be named "thing 0," "thing 1," and so on.
+    Objects that are still there on the next call keep their names; only
+    the objects that appeared, moved or disappeared are updated.
     This also causes the robot to broadcast the TF frame of each object.
 
     To get a list of WorldLandmarks:
@@ -379,13 +1110,20 @@ class World:
     To find the nearest object within 40 cm to an arm pose (provided in
     the base frame):
         obj = world.get_nearest_object(arm_pose)
+
+    To do the same for several poses (e.g. both arms) in one query:
+        r_obj, l_obj = world.get_nearest_objects([r_pose, l_pose])
+
+    Changes to the interactive markers are published once per scene
+    update. To group several changes into one publish:
+        with world.scene_update():
+            ...
     """
 
     selected_obj_side = None
-    side_refs = []
-    side_markers = []
 
-    def __init__(self, tf_listener, im_server, segment_tabletop):
+    def __init__(self, tf_listener, im_server, segment_tabletop,
+                 bbox_method=BBOX_AXIS_ALIGNED):
         """Construct a World instance.
 
         Args:
@@ -393,6 +1131,9 @@ class World:
             im_server: An InteractiveMarkerServer for visualizing objects.
             segment_tabletop: A rospy.ServiceProxy for the tabletop
                 segmentation service.
+            bbox_method (int, optional): How to fit objects' bounding
+                boxes, BBOX_AXIS_ALIGNED or BBOX_ORIENTED. Defaults to
+                BBOX_AXIS_ALIGNED.
         """
         self._objects = []  # Type: [WorldLandmark]
         self._surface = None
@@ -400,8 +1141,19 @@ class World:
         self._tf_listener = tf_listener
         self._im_server = im_server
         self._segment_tabletop = segment_tabletop
-        self._marker_controllers = []
-        self._obj_sides = []
+        self._bbox_method = bbox_method
+        self._sides = SideFaces()
+        # Index used to name the next new object ("thing <index>").
+        self._next_index = 0
+        # (landmarks, (K, 3) centroids) for nearest-object queries;
+        # rebuilt lazily after the object list changes.
+        self._object_index = None
+        # Interactive marker changes are batched by scene_update().
+        self._im_lock = threading.RLock()
+        self._update_depth = 0
+        self._has_pending_changes = False
+        self._n_publishes = 0
+        self._n_update_publishes = 0
         self.clear_all_objects()
 
     def get_frame_list(self):
@@ -411,7 +1163,8 @@ class World:
             [Landmark]: List of Landmark (as defined by Landmark.msg), the
                 current reference frames.
         """
-        return [w_obj.object for w_obj in self._objects] + [ref for ref in World.side_refs]
+        return ([w_obj.object for w_obj in self._objects] +
+                self._sides.get_landmarks())
 
     def has_objects(self):
         """Returns whether there are any objects (reference frames).
@@ -429,7 +1182,8 @@ class World:
         Returns:
             bool
         """
-        return object_name in ([wobj.object.name for wobj in self._objects] + [ref.name for ref in World.side_refs])
+        return (self._sides.has_landmark(object_name) or
+                object_name in [wobj.object.name for wobj in self._objects])
 
     def is_frame_valid(self, object_name):
         """Returns whether the frame (object) name is valid for
@@ -458,70 +1212,85 @@ class World:
     # Instance methods: Public (API)
     # ##################################################################
 
-    def update_object_pose(self):
-        """ Function to externally update an object pose."""
-        # Look down at the table.
-        rospy.loginfo('Head attempting to look at table.')
-        Response.force_gaze_action(GazeGoal.LOOK_DOWN)
-        while (Response.gaze_client.get_state() == GoalStatus.PENDING or
-               Response.gaze_client.get_state() == GoalStatus.ACTIVE):
-            rospy.sleep(PAUSE_SECONDS)
-        if Response.gaze_client.get_state() != GoalStatus.SUCCEEDED:
-            rospy.logerr('Could not look down to take table snapshot')
-            return False
-        rospy.loginfo('Head is now (successfully) staring at table.')
+    @contextmanager
+    def scene_update(self):
+        """Context for one logical scene update.
 
+        Interactive marker changes (inserts, erases and menu
+        applications) made inside it are published together, with a
+        single applyChanges, when the outermost scene update ends.
+        """
+        self._im_lock.acquire()
+        self._update_depth += 1
+        n_publishes = self._n_publishes
         try:
-            resp = self._segment_tabletop()
-            rospy.loginfo("Adding landmarks")
-            self._obj_sides = []
-            self._reset_objects()
+            yield
+        finally:
+            self._update_depth -= 1
+            if self._update_depth == 0:
+                self._flush_changes()
+                self._n_update_publishes = self._n_publishes - n_publishes
+                rospy.logdebug('Scene update published ' +
+                               str(self._n_update_publishes) + ' time(s), ' +
+                               str(self._n_publishes) + ' in total.')
+            self._im_lock.release()
+
+    def get_publish_count(self):
+        """Returns how many times the most recent scene update published
+        to the interactive marker server.
 
-            # add the table
-            xmin = resp.table.x_min
-            ymin = resp.table.y_min
-            xmax = resp.table.x_max
-            ymax = resp.table.y_max
-            depth = xmax - xmin
-            width = ymax - ymin
+        Returns:
+            int
+        """
+        return self._n_update_publishes
 
-            pose = resp.table.pose.pose
-            pose.position.x = pose.position.x + xmin + depth / 2
-            pose.position.y = pose.position.y + ymin + width / 2
-            dimensions = Vector3(depth, width, 0.01)
-            self._surface = _get_surface_marker(pose, dimensions)
-            self._im_server.insert(self._surface, self.marker_feedback_cb)
-            self._im_server.applyChanges()
+    def update_object_pose(self):
+        """Looks at the table and updates the objects, blocking until
+        done. See update_object_pose_async() for a version that doesn't
+        block.
 
-            for cluster in resp.clusters:
-                points = cluster.points
-                if (len(points) == 0):
-                    return Point(0, 0, 0)
-                [minX, maxX, minY, maxY, minZ,
-                 maxZ] = [points[0].x, points[0].x, points[0].y, points[0].y,
-                          points[0].z, points[0].z]
-                for pt in points:
-                    minX = min(minX, pt.x)
-                    minY = min(minY, pt.y)
-                    minZ = min(minZ, pt.z)
-                    maxX = max(maxX, pt.x)
-                    maxY = max(maxY, pt.y)
-                    maxZ = max(maxZ, pt.z)
-                object_sides_list = {'minX':minX, 'minY':minY, 'minZ':minZ, 'maxX':maxX, 'maxY':maxY, 'maxZ':maxZ}
-                self._obj_sides += [object_sides_list]
-                self._add_new_object(Pose(Point((minX + maxX) / 2, (minY + maxY) / 2,
-                                                (minZ + maxZ) / 2), Quaternion(0, 0, 0, 1)),
-                                     Point(maxX - minX, maxY - minY, maxZ - minZ), False)
-            return True
+        Returns:
+            bool: Whether the objects were updated. False if that took
+                longer than OBJECTS_TIMEOUT or failed.
+        """
+        try:
+            return self.update_object_pose_async().result(OBJECTS_TIMEOUT)
+        except ResultTimeoutError:
+            rospy.logerr('Timed out waiting for the objects to be updated')
+        except Exception, e:
+            rospy.logerr('Unable to update the objects: ' + str(e))
+        return False
+
+    def update_object_pose_async(self):
+        """Starts looking at the table and updating the objects, without
+        blocking.
+
+        Each stage starts from the previous one's completion: the head
+        looks down, then the tabletop is segmented (on a worker thread,
+        as the service call blocks), then the objects are updated and
+        their markers published in one scene update.
 
-        except rospy.ServiceException, e:
-            print "Call to segmentation service failed: %s" % e
-            return False
+        Returns:
+            AsyncResult: Resolves to whether the objects were updated
+                (bool).
+        """
+        result = AsyncResult()
+        rospy.loginfo('Head attempting to look at table.')
+        # Sending another gaze goal before this one finishes drops its
+        # callback, so don't wait forever.
+        timer = rospy.Timer(GAZE_TIMEOUT,
+                            lambda __: self._gaze_timeout_cb(result),
+                            oneshot=True)
+        Response.force_gaze_action(
+            GazeGoal.LOOK_DOWN,
+            lambda state, __: self._gaze_done_cb(state, result, timer))
+        return result
 
     def clear_all_objects(self):
         """Removes all objects from the world."""
-        self._reset_objects()
-        self._remove_surface()
+        with self.scene_update():
+            self._reset_objects()
+            self._remove_surface()
 
     def get_nearest_object(self, arm_pose):
         """Returns the nearest object, if one exists.
@@ -533,21 +1302,57 @@ class World:
                 is close enough), or None if there were none close
                 enough.
         """
-        # First, find which object is the closest.
-        distances = []
-        for wobj in self._objects:
-            dist = pose_distance(wobj.object.pose, arm_pose)
-            distances.append(dist)
+        return self.get_nearest_objects([arm_pose])[0]
 
-        # Then, see if the closest is actually below our threshold for
-        # a 'closest object.'
-        if len(distances) > 0:
-            if min(distances) < OBJ_NEAREST_DIST_THRESHOLD:
-                chosen = distances.index(min(distances))
-                return self._objects[chosen].object
+    def get_nearest_objects(self, arm_poses):
+        """Returns the nearest object for each of several poses (e.g.
+        both end-effectors) with a single vectorized query.
 
-        # We didn't have any objects or none were close enough.
-        return None
+        Args:
+            arm_poses ([Pose|None]): End-effector poses. None entries
+                (e.g. failed transform lookups) get None back.
+        Returns:
+            [Landmark|None]: For each pose, as in Landmark.msg, the
+                nearest object (if it is close enough), or None if there
+                were none close enough.
+        """
+        nearest = [None] * len(arm_poses)
+        landmarks, centroids = self._get_object_index()
+        rows = [i for i in range(len(arm_poses)) if arm_poses[i] is not None]
+        if len(landmarks) == 0 or len(rows) == 0:
+            # We didn't have any objects or any poses to look from.
+            return nearest
+
+        positions = np.array([get_array_from_pose(arm_poses[i])[:3]
+                              for i in rows])
+        distances = _get_distances(positions, centroids)
+        closest = np.argmin(distances, axis=1)
+
+        # See if the closest is actually below our threshold for a
+        # 'closest object.'
+        for row, i in enumerate(rows):
+            if distances[row, closest[row]] < OBJ_NEAREST_DIST_THRESHOLD:
+                nearest[i] = landmarks[closest[row]]
+        return nearest
+
+    def get_objects_within(self, pose, radius, is_on_table=True):
+        """Returns the objects whose centers are within radius of pose.
+
+        Args:
+            pose (Pose)
+            radius (float)
+            is_on_table (bool, optional): Whether the objects are on the
+                table (if so, disregards z-values in computations).
+        Returns:
+            [Landmark]: As in Landmark.msg, closest first.
+        """
+        landmarks, centroids = self._get_object_index()
+        if len(landmarks) == 0:
+            return []
+        position = np.array([get_array_from_pose(pose)[:3]])
+        distances = _get_distances(position, centroids, is_on_table)[0]
+        within = np.flatnonzero(distances < radius)
+        return [landmarks[i] for i in within[np.argsort(distances[within])]]
 
     def marker_feedback_cb(self, feedback):
         """Callback for when feedback from a marker is received.
@@ -565,216 +1370,139 @@ class World:
             # fires here).
             rospy.logdebug('Unknown event: ' + str(feedback.event_type))
 
-    def make_mark(self):
-        """Creates the base marker for the side of an object.
-        
-        Args:
-            obj_name (String) The name of the object this side is part of.
-
-        Returns:
-            marker (Marker)
-        """
-        marker = Marker()
-        marker.type = Marker.CUBE
-        marker.header.frame_id = 'base_link'
-        marker.action = Marker.ADD
-        marker.color.r = 0.0
-        marker.color.g = 0.5
-        marker.color.b = 0.5
-        marker.color.a = 0.6
-        marker.pose.orientation.w = 1
-        return marker
-
-    def make_cont(self, parent):
-        """Creates the controller for the marker for the side of an object.
-        
-        Args:
-            parent (Marker)
+    def update(self):
+        """Update function called in a loop.
 
         Returns:
-            control (MarkerController)
+            bool: Whether any tracked objects were removed, AKA "is
+                world changed."
         """
-        control = InteractiveMarkerControl()
-        control.interaction_mode = InteractiveMarkerControl.BUTTON
-        control.always_visible = True
-        control.name = parent.ns
-        return control
+        # Most ticks change nothing; they don't open a scene update, so
+        # get_publish_count() still describes the last one that did.
+        self._lock.acquire()
+        is_removed = any(obj.is_removed for obj in self._objects)
+        self._lock.release()
+        if not is_removed:
+            return False
 
-    def make_ref(self, parent):
-        """Creates the reference frame for the side of an object.
+        # Visualize the detected object
+        is_world_changed = False
+        with self.scene_update():
+            self._lock.acquire()
+            if self.has_objects():
+                to_remove = None
+                for i in range(len(self._objects)):
+                    if self._objects[i].is_removed:
+                        to_remove = i
+                if to_remove is not None:
+                    self._remove_object(to_remove)
+                    is_world_changed = True
+
+            self._lock.release()
+        return is_world_changed
 
-        Args:
-            parent (Marker)
+    # ##################################################################
+    # Instance methods: Internal ("private")
+    # ##################################################################
+
+    def _gaze_done_cb(self, state, result, timer):
+        """Callback for when the look-down gaze action finishes; starts
+        segmentation if the head got there.
 
-        Returns:
-            ref (Landmark)
-        """
-        ref = Landmark()
-        ref.type = 1
-        ref.pose.position.x = parent.pose.position.x
-        ref.pose.position.y = parent.pose.position.y
-        ref.pose.position.z = parent.pose.position.z
-        ref.pose.orientation.x = parent.pose.orientation.x
-        ref.pose.orientation.y = parent.pose.orientation.y
-        ref.pose.orientation.z = parent.pose.orientation.z
-        ref.pose.orientation.w = parent.pose.orientation.w
-        ref.name = parent.ns + " Ref"
-        ref.dimensions.x = parent.scale.x
-        ref.dimensions.y = parent.scale.y
-        ref.dimensions.z = parent.scale.z
-        return ref
-
-    def test_existing(self, loc, subject, subject_cont, subject_ref):
-        """Tests whether it is necessary to create another marker or simply replace an existing one.
         Args:
-            subject (Marker)
-            subject_cont (InteractiveMarkerController)
-            subject_ref (Landmark)
-        """
-        if loc >= len(World.side_markers) or (loc == 0 and len(World.side_markers) == 0):
-            rospy.loginfo("Creating new side")
-            World.side_markers.append(subject)
-            self._marker_controllers.append(subject_cont)
-            World.side_refs.append(subject_ref)
-        elif (loc < len(World.side_markers) and (len(World.side_markers) != 0)):
-            rospy.loginfo("Sides have been created already, replacing...")
-            if World.side_markers[loc].ns == subject.ns:
-                World.side_markers[loc] = subject
-                self._marker_controllers[loc] = subject_cont
-                World.side_refs[loc] = subject_ref
-        else:
-            rospy.loginfo("Test_existing isn't working")
+            state (int): The gaze action's final GoalStatus.
+            result (AsyncResult): The pending object update.
+            timer (rospy.Timer): The gaze timeout, which is stopped.
+        """
+        timer.shutdown()
+        if result.done():
+            # Timed out already.
+            return
+        if state != GoalStatus.SUCCEEDED:
+            rospy.logerr('Could not look down to take table snapshot')
+            result.set_result(False)
+            return
+        rospy.loginfo('Head is now (successfully) staring at table.')
+        threading.Thread(group=None,
+                         target=self._segment_objects,
+                         args=(result,),
+                         name='segmentation_thread').start()
 
-    def create_sides(self, obj):
-        """Combines the functions above to create all sides of an object.
+    def _gaze_timeout_cb(self, result):
+        """Callback for when the head has had GAZE_TIMEOUT to look down;
+        fails the object update if it is still waiting on the gaze.
 
         Args:
-            obj (int) The number of the object.
-        """
-        rospy.loginfo("self._objects[obj].object.dimensions: " + str(
-            self._objects[obj].object.dimensions))
-        o_s = self._obj_sides[obj]
-        front = self.make_mark()
-        front.id = int(obj) * 10 + 0
-        front.pose.position.x = self._objects[obj].object.pose.position.x - self._objects[obj].object.dimensions.x / 2
-        front.pose.position.y = self._objects[obj].object.pose.position.y
-        front.pose.position.z = self._objects[obj].object.pose.position.z
-        front.scale.x = 0.02
-        front.scale.y = self._objects[obj].object.dimensions.y
-        front.scale.z = self._objects[obj].object.dimensions.z
-        front.ns = "Obj #" + str(obj) + " X-Minimum"
-        front_ref = self.make_ref(front)
-        front_cont = self.make_cont(front)
-        front_cont.markers.append(front)
-        self.test_existing(obj*6, front, front_cont, front_ref)
-
-        back = self.make_mark()
-        back.id = int(obj) * 10 + 1
-        back.pose.position.x = self._objects[obj].object.pose.position.x + self._objects[obj].object.dimensions.x / 2
-        back.pose.position.y = self._objects[obj].object.pose.position.y
-        back.pose.position.z = self._objects[obj].object.pose.position.z
-        back.scale.x = 0.02
-        back.scale.y = self._objects[obj].object.dimensions.y
-        back.scale.z = self._objects[obj].object.dimensions.z
-        back.ns = "Obj #" + str(obj) + " X-Maximum"
-        back_ref = self.make_ref(back)
-        back_cont = self.make_cont(back)
-        back_cont.markers.append(back)
-        self.test_existing(obj*6+1, back, back_cont, back_ref)
-        
-        right = self.make_mark()
-        right.id = int(obj) * 10 + 2
-        right.pose.position.x = self._objects[obj].object.pose.position.x
-        right.pose.position.y = self._objects[obj].object.pose.position.y - self._objects[obj].object.dimensions.y / 2
-        right.pose.position.z = self._objects[obj].object.pose.position.z
-        right.scale.x = self._objects[obj].object.dimensions.x
-        right.scale.y = 0.02
-        right.scale.z = self._objects[obj].object.dimensions.z
-        right.ns = "Obj #" + str(obj) + " Y-Minimum"
-        right_ref = self.make_ref(right)
-        right_cont = self.make_cont(right)
-        right_cont.markers.append(right)
-        self.test_existing(obj*6+2, right, right_cont, right_ref)
-
-        left = self.make_mark()
-        left.id = int(obj) * 10 + 3
-        left.pose.position.x = self._objects[obj].object.pose.position.x
-        left.pose.position.y = self._objects[obj].object.pose.position.y + self._objects[obj].object.dimensions.y / 2
-        left.pose.position.z = self._objects[obj].object.pose.position.z
-        left.scale.x = self._objects[obj].object.dimensions.x
-        left.scale.y = 0.02
-        left.scale.z = self._objects[obj].object.dimensions.z
-        left.ns = "Obj #" + str(obj) + " Y-Maximum"
-        left_ref = self.make_ref(left)
-        left_cont = self.make_cont(left)
-        left_cont.markers.append(left)
-        self.test_existing(obj*6+3, left, left_cont, left_ref)
-
-        base = self.make_mark()
-        base.id = int(obj) * 10 + 4
-        base.pose.position.x = self._objects[obj].object.pose.position.x
-        base.pose.position.y = self._objects[obj].object.pose.position.y
-        base.pose.position.z = self._objects[obj].object.pose.position.z - self._objects[obj].object.dimensions.z / 2
-        base.scale.x = self._objects[obj].object.dimensions.x
-        base.scale.y = self._objects[obj].object.dimensions.y
-        base.scale.z = 0.02
-        base.ns = "Obj #" + str(obj) + " Z-Minimum"
-        base_ref = self.make_ref(base)
-        base_cont = self.make_cont(base)
-        base_cont.markers.append(base)
-        self.test_existing(obj*6+4, base, base_cont, base_ref)
-
-        top = self.make_mark()
-        top.id = int(obj) * 10 + 5
-        top.pose.position.x = self._objects[obj].object.pose.position.x
-        top.pose.position.y = self._objects[obj].object.pose.position.y
-        top.pose.position.z = self._objects[obj].object.pose.position.z + self._objects[obj].object.dimensions.z / 2
-        top.scale.x = self._objects[obj].object.dimensions.x
-        top.scale.y = self._objects[obj].object.dimensions.y
-        top.scale.z = 0.02
-        top.ns = "Obj #" + str(obj) + " Z-Maximum"
-        top_ref = self.make_ref(top)
-        top_cont = self.make_cont(top)
-        top_cont.markers.append(top)
-        self.test_existing(obj*6+5, top, top_cont, top_ref)
+            result (AsyncResult): The pending object update.
+        """
+        if not result.done():
+            rospy.logerr('Timed out waiting to look at the table')
+            result.set_result(False)
 
-    def update(self):
-        """Update function called in a loop.
+    def _segment_objects(self, result):
+        """Segments the tabletop and updates the table and objects from
+        the result.
 
-        Returns:
-            bool: Whether any tracked objects were removed, AKA "is
-                world changed."
+        Args:
+            result (AsyncResult): The pending object update, set to
+                whether it succeeded.
         """
-        # Visualize the detected object
-        is_world_changed = False
-        self._lock.acquire()
-        if self.has_objects():
-            to_remove = None
-            for i in range(len(self._objects)):
-                if self._objects[i].is_removed:
-                    to_remove = i
-            if to_remove is not None:
-                self._remove_object(to_remove)
-                is_world_changed = True
+        try:
+            resp = self._segment_tabletop()
+        except rospy.ServiceException, e:
+            rospy.logerr('Call to segmentation service failed: ' + str(e))
+            result.set_result(False)
+            return
 
-        self._lock.release()
-        return is_world_changed
+        try:
+            rospy.loginfo("Adding landmarks")
 
-    # ##################################################################
-    # Instance methods: Internal ("private")
-    # ##################################################################
+            # add the table
+            xmin = resp.table.x_min
+            ymin = resp.table.y_min
+            xmax = resp.table.x_max
+            ymax = resp.table.y_max
+            depth = xmax - xmin
+            width = ymax - ymin
+
+            pose = resp.table.pose.pose
+            pose.position.x = pose.position.x + xmin + depth / 2
+            pose.position.y = pose.position.y + ymin + width / 2
+            dimensions = Vector3(depth, width, 0.01)
+
+            boxes = []
+            for cluster in resp.clusters:
+                if len(cluster.points) == 0:
+                    continue
+                points = get_points_array(cluster.points)
+                boxes.append(get_bounding_box(points, self._bbox_method))
+
+            with self.scene_update():
+                # Inserting replaces the previous surface, if any.
+                self._surface = _get_surface_marker(pose, dimensions)
+                self._im_server.insert(self._surface, self.marker_feedback_cb)
+                self._apply_changes()
+                self._track_objects(boxes)
+        except Exception, e:
+            result.set_exception(e)
+            return
+        result.set_result(True)
 
     def _reset_objects(self):
         """Removes all objects."""
         self._lock.acquire()
         for wobj in self._objects:
             self._im_server.erase(wobj.int_marker.name)
-            self._im_server.applyChanges()
         if self._surface is not None:
             self._remove_surface()
         self._im_server.clear()
-        self._im_server.applyChanges()
+        self._apply_changes()
         self._objects = []
+        self._object_index = None
+        self._next_index = 0
+        self._sides = SideFaces()
+        # Landmark poses are about to change; drop cached transforms.
+        landmark_transforms.invalidate()
         self._lock.release()
 
     def _add_new_object(self, pose, dimensions, is_recognized, mesh=None):
@@ -791,7 +1519,6 @@ class World:
         Returns:
             bool: Whether the object was actually added.
         """
-        to_remove = None
         if is_recognized:
             # TODO(mbforbes): Re-implement object recognition or remove
             # this dead code.
@@ -799,13 +1526,11 @@ class World:
         else:
             # Whether we already have an object at ~ the same
             # location (and if so, don't add).
-            for wobj in self._objects:
-                if (pose_distance(wobj.object.pose, pose) <
-                    OBJ_ADD_DIST_THRESHOLD):
-                    rospy.loginfo(
-                        'Previously detected object at the same location, ' +
-                        'will not add this object.')
-                    return False
+            if len(self.get_objects_within(pose, OBJ_ADD_DIST_THRESHOLD)) > 0:
+                rospy.loginfo(
+                    'Previously detected object at the same location, ' +
+                    'will not add this object.')
+                return False
 
             # Actually add the object.
             self._add_new_object_internal(pose, dimensions, is_recognized,
@@ -816,21 +1541,95 @@ class World:
         """Does the 'internal' adding of an object with the passed
         properties. Call _add_new_object to do all pre-requisite checks
         first (it then calls this function).
+
+        The object's interactive marker is not sent; pass the object to
+        _publish_objects(...) for that.
+
         Args:
             pose (Pose)
             dimensions (Vector3)
             is_recognized (bool)
             mesh (Mesh|None): A mesh, if it exists (can be None).
         """
-        n_objects = len(self._objects)
-        self._objects.append(WorldLandmark(pose, n_objects, dimensions,
-                                           is_recognized))
-        int_marker = self._get_object_marker(len(self._objects) - 1)
-        self._objects[-1].int_marker = int_marker
-        self._im_server.insert(int_marker, self.marker_feedback_cb)
-        self._im_server.applyChanges()
-        self._objects[-1].menu_handler.apply(self._im_server, int_marker.name)
-        self._im_server.applyChanges()
+        self._objects.append(WorldLandmark(pose, self._next_index,
+                                           dimensions, is_recognized))
+        self._next_index += 1
+        self._object_index = None
+
+    def _track_objects(self, boxes):
+        """Updates the objects to match a new segmentation snapshot.
+
+        Detected boxes are matched to the current objects by position and
+        size. Matched objects keep their landmark (and so their name) and
+        are moved in place, unmatched objects are removed and unmatched
+        boxes are added. The changes are sent to the IM server as a
+        single update.
+
+        Args:
+            boxes ([(Pose, Vector3)]): Center poses and dimensions of the
+                detected objects.
+
+        Returns:
+            ([str], [str], [str]): Names of the added, updated and
+                removed objects.
+        """
+        self._lock.acquire()
+        matches = dict(_match_boxes(
+            [wobj.object for wobj in self._objects], boxes))
+        kept, updated, removed = [], [], []
+        for i, wobj in enumerate(self._objects):
+            if i not in matches:
+                removed.append(wobj)
+                continue
+            kept.append(wobj)
+            pose, dimensions = boxes[matches[i]]
+            if _is_box_changed(wobj.object, pose, dimensions):
+                wobj.object.pose = pose
+                wobj.object.dimensions = dimensions
+                updated.append(wobj)
+        self._objects = kept
+        self._object_index = None
+
+        matched_boxes = set(matches.values())
+        for i, (pose, dimensions) in enumerate(boxes):
+            if i not in matched_boxes:
+                self._add_new_object(pose, dimensions, False)
+        added = self._objects[len(kept):]
+
+        for wobj in removed:
+            self._im_server.erase(wobj.int_marker.name)
+        for wobj in removed + updated:
+            landmark_transforms.invalidate(wobj.object.name)
+        self._publish_objects(updated + added)
+        self._lock.release()
+
+        diff = ([wobj.get_name() for wobj in added],
+                [wobj.get_name() for wobj in updated],
+                [wobj.get_name() for wobj in removed])
+        rospy.loginfo('Objects added: ' + str(diff[0]) + ', updated: ' +
+                      str(diff[1]) + ', removed: ' + str(diff[2]))
+        return diff
+
+    def _publish_objects(self, changed):
+        """Sends changed objects to the IM server, along with any pending
+        erasures, in one update.
+
+        Sides are rebuilt for every object (in one pass); only the
+        objects in changed get new interactive markers.
+
+        Args:
+            changed ([WorldLandmark]): Objects that are new or whose
+                boxes changed.
+        """
+        self._sides = SideFaces([wobj.object for wobj in self._objects],
+                                [wobj.index for wobj in self._objects])
+        for index, wobj in enumerate(self._objects):
+            if wobj in changed:
+                int_marker = self._get_object_marker(index)
+                wobj.int_marker = int_marker
+                self._im_server.insert(int_marker, self.marker_feedback_cb)
+                wobj.menu_handler.apply(self._im_server, int_marker.name)
+        self._apply_changes()
 
     def _remove_object(self, to_remove):
         """Remove an object by index.
@@ -840,17 +1639,54 @@ class World:
                 self._objects.
         """
         obj = self._objects.pop(to_remove)
+        self._object_index = None
         rospy.loginfo('Removing object ' + obj.int_marker.name)
+        landmark_transforms.invalidate(obj.object.name)
         self._im_server.erase(obj.int_marker.name)
-        self._im_server.applyChanges()
+        self._publish_objects([])
 
     def _remove_surface(self):
         """Function to request removing surface (from IM)."""
         rospy.loginfo('Removing surface')
         self._im_server.erase('surface')
-        self._im_server.applyChanges()
+        self._apply_changes()
         self._surface = None
 
+    def _apply_changes(self):
+        """Records that interactive marker changes were made, publishing
+        them right away unless inside a scene update (which publishes
+        them when it ends)."""
+        self._im_lock.acquire()
+        self._has_pending_changes = True
+        if self._update_depth == 0:
+            self._flush_changes()
+        self._im_lock.release()
+
+    def _flush_changes(self):
+        """Publishes pending interactive marker changes, if any."""
+        if self._has_pending_changes:
+            self._im_server.applyChanges()
+            self._has_pending_changes = False
+            self._n_publishes += 1
+
+    def _get_object_index(self):
+        """Returns the landmarks and their centroids, rebuilding the
+        index if the object list changed since it was last built.
+
+        Returns:
+            ([Landmark], numpy.ndarray): Tuple of the landmarks and a
+                (K, 3) array of their positions, in the same order.
+        """
+        index = self._object_index
+        if index is None:
+            landmarks = [wobj.object for wobj in self._objects]
+            centroids = np.array(
+                [get_array_from_pose(landmark.pose)[:3]
+                 for landmark in landmarks]).reshape(-1, 3)
+            index = (landmarks, centroids)
+            self._object_index = index
+        return index
+
     def _get_object_marker(self, index, mesh=None):
         """Generate and return a marker for world objects.
 
@@ -879,15 +1715,20 @@ class World:
                                color=COLOR_OBJ,
                                pose=self._objects[index].object.pose)
 
-        self.create_sides(index)
-
         if mesh is not None:
             object_marker = _get_mesh_marker(object_marker, mesh)
             button_control.markers.append(object_marker)
         else:
-            for item in range((6 * (index)), (6 * (index)) + 6):
-                rospy.loginfo("Item: " + str(item) + "\nlen mark cont: " + str(len(self._marker_controllers)))
-                int_marker.controls.append(self._marker_controllers[item])
+            # Each side is its own button, named after the side, so
+            # clicks tell which side was selected.
+            for side_marker in self._sides.get_markers(index):
+                side_control = InteractiveMarkerControl()
+                side_control.interaction_mode = (
+                    InteractiveMarkerControl.BUTTON)
+                side_control.always_visible = True
+                side_control.name = side_marker.ns
+                side_control.markers.append(side_marker)
+                int_marker.controls.append(side_control)
 
         text_pos = Point()
         text_pos.x = self._objects[index].object.pose.position.x
@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+"""Tests the functionality of the action_store module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import shutil
+import tempfile
+import unittest
+from pr2_pbd_interaction import action_store
+from pr2_pbd_interaction.action_store import ActionStore
+from pr2_pbd_interaction.msg import ActionStep, ActionStepSequence
+
+
+def make_seq(n_steps):
+    seq = ActionStepSequence()
+    for i in range(n_steps):
+        step = ActionStep()
+        step.type = ActionStep.ARM_TARGET
+        step.armTarget.rArm.ee_pose.position.x = i
+        step.armTarget.rArm.joint_pose = [float(i)] * 7
+        seq.seq.append(step)
+    return seq
+
+
+class TestActionStore(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def testSaveLoad(self):
+        store = ActionStore(self.data_dir)
+        self.assertIsNone(store.load('Action0'))
+        self.assertTrue(store.save('Action0', make_seq(2)))
+        self.assertTrue(store.save('Action1', make_seq(3)))
+        self.assertTrue(store.save('Action0', make_seq(4)))
+        self.assertEqual(len(store.load('Action0').seq), 4)
+        self.assertEqual(len(store.load('Action1').seq), 3)
+        # Saving the same steps again doesn't write anything.
+        size = os.path.getsize(os.path.join(self.data_dir,
+                                            action_store.STORE_FILENAME))
+        self.assertFalse(store.save('Action1', make_seq(3)))
+        self.assertEqual(size, os.path.getsize(
+            os.path.join(self.data_dir, action_store.STORE_FILENAME)))
+        store.close()
+
+    def testReopen(self):
+        store = ActionStore(self.data_dir)
+        store.save('Action0', make_seq(2))
+        store.save('Action1', make_seq(3))
+        store.close()
+        store = ActionStore(self.data_dir)
+        self.assertTrue(store.has_action('Action1'))
+        step = store.load('Action0').seq[1]
+        self.assertEqual(step.armTarget.rArm.ee_pose.position.x, 1)
+        self.assertEqual(list(step.armTarget.rArm.joint_pose), [1.0] * 7)
+        store.close()
+
+    def testCompact(self):
+        path = os.path.join(self.data_dir, action_store.STORE_FILENAME)
+        store = ActionStore(self.data_dir)
+        for n_steps in range(1, 5):
+            store.save('Action0', make_seq(n_steps))
+        store.save('Action1', make_seq(1))
+        size = os.path.getsize(path)
+        store.compact()
+        self.assertLess(os.path.getsize(path), size)
+        self.assertEqual(len(store.load('Action0').seq), 4)
+        self.assertEqual(len(store.load('Action1').seq), 1)
+        store.save('Action1', make_seq(2))
+        store.close()
+        store = ActionStore(self.data_dir)
+        self.assertEqual(len(store.load('Action1').seq), 2)
+        store.close()
+
+    def testPartialRecord(self):
+        path = os.path.join(self.data_dir, action_store.STORE_FILENAME)
+        store = ActionStore(self.data_dir)
+        store.save('Action0', make_seq(2))
+        store.close()
+        size = os.path.getsize(path)
+        with open(path, 'ab') as store_file:
+            store_file.write('\x07\x00\x00\x00')
+        store = ActionStore(self.data_dir)
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(len(store.load('Action0').seq), 2)
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+"""Tests the functionality of the async_result module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import threading
+import unittest
+from pr2_pbd_interaction.async_result import AsyncResult, ResultTimeoutError
+
+
+def finish_later(async_result, result, delay=0.05):
+    """Sets the result of async_result on another thread."""
+    timer = threading.Timer(delay, async_result.set_result, [result])
+    timer.start()
+    return timer
+
+
+class TestAsyncResult(unittest.TestCase):
+    def testCompleted(self):
+        async_result = AsyncResult.completed(3)
+        self.assertTrue(async_result.done())
+        self.assertEqual(async_result.result(), 3)
+        # Only the first outcome counts.
+        async_result.set_result(4)
+        async_result.set_exception(ValueError())
+        self.assertEqual(async_result.result(), 3)
+
+    def testCallbacks(self):
+        async_result = AsyncResult()
+        results = []
+        async_result.add_done_callback(
+            lambda done: results.append(done.result()))
+        self.assertEqual(results, [])
+        finish_later(async_result, 'a').join()
+        self.assertEqual(results, ['a'])
+        # Callbacks added once done run right away.
+        async_result.add_done_callback(
+            lambda done: results.append(done.result() + 'b'))
+        self.assertEqual(results, ['a', 'ab'])
+
+    def testFailingCallback(self):
+        async_result = AsyncResult()
+        results = []
+
+        def fail(__):
+            raise ValueError('callback failed')
+        async_result.add_done_callback(fail)
+        async_result.add_done_callback(lambda __: results.append(True))
+        async_result.set_result(None)
+        self.assertEqual(results, [True])
+
+    def testThen(self):
+        async_result = AsyncResult()
+        chained = async_result.then(lambda x: x + 1).then(lambda x: x * 2)
+        self.assertFalse(chained.done())
+        finish_later(async_result, 1)
+        self.assertEqual(chained.result(5.0), 4)
+
+    def testThenFailure(self):
+        async_result = AsyncResult()
+        chained = async_result.then(lambda x: 1 / x).then(lambda x: x + 1)
+        async_result.set_result(0)
+        self.assertRaises(ZeroDivisionError, chained.result)
+        failed = AsyncResult()
+        failed.set_exception(ValueError('failed'))
+        self.assertRaises(ValueError, failed.then(lambda x: x).result)
+
+    def testTimeout(self):
+        async_result = AsyncResult()
+        self.assertFalse(async_result.wait(0.01))
+        self.assertRaises(ResultTimeoutError, async_result.result, 0.01)
+        finish_later(async_result, 'a')
+        self.assertEqual(async_result.result(5.0), 'a')
+        self.assertTrue(async_result.wait(0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+"""Micro-benchmark for world.convert_ref_frame.
+
+Compares the current conversion path against the previous one, which
+deep-copied the arm state and landmark on every call and rebuilt and
+inverted the landmark transform each time.
+
+Run with:
+    python test/convert_ref_frame_benchmark.py
+"""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import copy
+import timeit
+import numpy as np
+from pr2_pbd_interaction import world
+from pr2_pbd_interaction.msg import ArmState
+from pr2_pbd_interaction.msg import Landmark
+
+N_CALLS = 10000
+
+
+def legacy_convert_ref_frame(arm_state, ref_frame, ref_frame_obj=Landmark()):
+    """The deepcopy-based conversion, kept here as the baseline."""
+    output_state = copy.deepcopy(arm_state)
+    ref_frame_obj_copy = copy.deepcopy(ref_frame_obj)
+    if ref_frame == ArmState.ROBOT_BASE:
+        if arm_state.refFrame == ArmState.OBJECT:
+            ee_in_obj = world.get_matrix_from_pose(arm_state.ee_pose)
+            obj_to_base = world.get_matrix_from_pose(
+                arm_state.refFrameLandmark.pose)
+            output_state.ee_pose = world.get_pose_from_transform(
+                np.dot(obj_to_base, ee_in_obj))
+            output_state.refFrame = ArmState.ROBOT_BASE
+            output_state.refFrameLandmark = Landmark()
+    elif ref_frame == ArmState.OBJECT:
+        if arm_state.refFrame == ArmState.ROBOT_BASE:
+            arm_in_base = world.get_matrix_from_pose(arm_state.ee_pose)
+            base_to_obj = np.linalg.inv(
+                world.get_matrix_from_pose(ref_frame_obj.pose))
+            output_state.ee_pose = world.get_pose_from_transform(
+                np.dot(base_to_obj, arm_in_base))
+            output_state.refFrame = ArmState.OBJECT
+            output_state.refFrameLandmark = ref_frame_obj_copy
+    return output_state
+
+
+def make_inputs():
+    """Returns (base-relative ArmState, object-relative ArmState,
+    Landmark)."""
+    landmark = Landmark()
+    landmark.name = 'thing 0'
+    landmark.pose.position.x = 0.6
+    landmark.pose.position.z = 0.7
+    landmark.pose.orientation.z = 0.3826834
+    landmark.pose.orientation.w = 0.9238795
+    landmark.dimensions.x = 0.1
+    landmark.dimensions.y = 0.1
+    landmark.dimensions.z = 0.2
+
+    base_state = ArmState()
+    base_state.refFrame = ArmState.ROBOT_BASE
+    base_state.ee_pose.position.x = 0.5
+    base_state.ee_pose.position.y = -0.2
+    base_state.ee_pose.position.z = 0.9
+    base_state.ee_pose.orientation.w = 1
+    base_state.joint_pose = [0.1 * i for i in range(7)]
+
+    obj_state = legacy_convert_ref_frame(base_state, ArmState.OBJECT,
+                                         landmark)
+    return base_state, obj_state, landmark
+
+
+def report(label, func):
+    """Times func and prints the mean cost per call."""
+    seconds = min(timeit.repeat(func, number=N_CALLS, repeat=3))
+    print('{:<40} {:8.2f} us/call'.format(label,
+                                          seconds / N_CALLS * 1e6))
+
+
+if __name__ == '__main__':
+    base_state, obj_state, landmark = make_inputs()
+    cases = [
+        ('no-op (base -> base)',
+         lambda f: f(base_state, ArmState.ROBOT_BASE)),
+        ('no-op (object -> same object)',
+         lambda f: f(obj_state, ArmState.OBJECT, landmark)),
+        ('base -> object', lambda f: f(base_state, ArmState.OBJECT,
+                                       landmark)),
+        ('object -> base', lambda f: f(obj_state, ArmState.ROBOT_BASE)),
+    ]
+    for name, case in cases:
+        report('before: ' + name,
+               lambda: case(legacy_convert_ref_frame))
+        report('after:  ' + name,
+               lambda: case(world.convert_ref_frame))
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+"""Benchmark for the action codecs in db.
+
+Compares how long each codec takes to encode and decode actions of
+10, 100 and 1000 steps, and how big the stored documents are. 'json' is
+the rospy_message_converter path actions used to be stored with.
+
+Run with:
+    python test/db_codec_benchmark.py
+"""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import timeit
+from pr2_pbd_interaction.db import CODECS, decode_msg
+from pr2_pbd_interaction.msg import Action, ActionStep, ArmState, Landmark
+from pr2_arm_control.msg import GripperState
+
+N_STEPS = [10, 100, 1000]
+CODEC_NAMES = ['json', 'genpy', 'genpy_zlib']
+MSG_TYPE = 'pr2_pbd_interaction/Action'
+
+
+def make_arm_state(i):
+    """Returns an object-relative ArmState that varies with i."""
+    arm_state = ArmState()
+    arm_state.refFrame = ArmState.OBJECT
+    arm_state.ee_pose.position.x = 0.5 + 0.001 * i
+    arm_state.ee_pose.position.y = -0.2
+    arm_state.ee_pose.position.z = 0.9 - 0.001 * i
+    arm_state.ee_pose.orientation.w = 1
+    arm_state.joint_pose = [0.1 * j + 0.001 * i for j in range(7)]
+    arm_state.refFrameLandmark = Landmark(name='thing 0')
+    arm_state.refFrameLandmark.pose.position.x = 0.6
+    arm_state.refFrameLandmark.pose.orientation.w = 1
+    arm_state.refFrameLandmark.dimensions.x = 0.1
+    return arm_state
+
+
+def make_action(n_steps):
+    """Returns an Action of n_steps arm target steps."""
+    action = Action()
+    action.name = 'Action with {} steps'.format(n_steps)
+    for i in range(n_steps):
+        step = ActionStep()
+        step.type = ActionStep.ARM_TARGET
+        step.armTarget.rArm = make_arm_state(i)
+        step.armTarget.lArm = make_arm_state(-i)
+        step.armTarget.rArmVelocity = 0.2
+        step.armTarget.lArmVelocity = 0.2
+        step.gripperAction.rGripper.state = GripperState.OPEN
+        step.gripperAction.lGripper.state = GripperState.CLOSED
+        action.sequence.seq.append(step)
+    return action
+
+
+def time_call(func, n_steps):
+    """Returns the best time of func over a few runs, in ms."""
+    number = max(1, 1000 / n_steps)
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    return seconds / number * 1e3
+
+
+if __name__ == '__main__':
+    print('{:<12} {:>6} {:>12} {:>12} {:>12}'.format(
+        'codec', 'steps', 'encode (ms)', 'decode (ms)', 'size (B)'))
+    for n_steps in N_STEPS:
+        action = make_action(n_steps)
+        for name in CODEC_NAMES:
+            codec = CODECS[name]
+            doc = codec.encode(action)
+            encode_ms = time_call(lambda: codec.encode(action), n_steps)
+            decode_ms = time_call(lambda: decode_msg(MSG_TYPE, doc), n_steps)
+            print('{:<12} {:>6} {:>12.3f} {:>12.3f} {:>12}'.format(
+                name, n_steps, encode_ms, decode_ms, len(doc)))
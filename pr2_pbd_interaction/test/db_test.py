@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+"""Tests the functionality of the db module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import json
+import unittest
+from pr2_pbd_interaction.db import ActionCache, ActionDatabase
+from pr2_pbd_interaction.db import CODECS, decode_msg, get_msg_size
+from pr2_pbd_interaction.msg import Action, ActionStep
+from mongo_msg_db_msgs.msg import Message
+from mongo_msg_db_msgs.srv import (FindResponse, InsertResponse,
+                                   UpdateResponse)
+from rospy_message_converter import json_message_converter
+
+
+class FakeService(object):
+    """Stands in for a mongo_msg_db service proxy."""
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def __call__(self, req):
+        self.requests.append(req)
+        if callable(self.response):
+            return self.response(req)
+        return self.response
+
+
+def make_action(name):
+    action = Action()
+    action.name = name
+    return action
+
+
+def make_find_response(action):
+    message = Message(
+        msg_type='pr2_pbd_interaction/Action',
+        json=json_message_converter.convert_ros_message_to_json(action))
+    return FindResponse(matched_count=1, message=message)
+
+
+class TestActionDatabase(unittest.TestCase):
+    def setUp(self):
+        self.find = FakeService(FindResponse(matched_count=0))
+        self.insert = FakeService(InsertResponse(id='a'))
+        self.update = FakeService(UpdateResponse(matched_count=1))
+        self.db = ActionDatabase('db', 'actions', self.find, self.insert,
+                                 self.update, write_delay=60.0)
+
+    def testCoalesce(self):
+        for i in range(10):
+            self.db.update('a', make_action('a' + str(i)))
+        self.db.update('b', make_action('b'))
+        self.assertEqual(self.db.get_write_stats()['queue_depth'], 2)
+        # Nothing is written before the delay unless flushed.
+        self.assertEqual(len(self.update.requests), 0)
+        self.assertTrue(self.db.flush(5.0))
+        self.assertEqual(len(self.update.requests), 2)
+        # The batch is written concurrently, so in any order.
+        written = dict((req.message.id, req.message.json)
+                       for req in self.update.requests)
+        self.assertEqual(sorted(written), ['a', 'b'])
+        self.assertIn('a9', written['a'])
+        stats = self.db.get_write_stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['n_writes'], 2)
+        self.assertEqual(stats['n_coalesced'], 9)
+
+    def testFindPending(self):
+        self.db.update('a', make_action('a1'))
+        self.assertEqual(self.db.find('a').name, 'a1')
+        self.assertEqual(len(self.find.requests), 0)
+        # Once written, it is cached.
+        self.db.flush(5.0)
+        self.assertEqual(self.db.find('a').name, 'a1')
+        self.assertEqual(len(self.find.requests), 0)
+
+    def testWriteFailure(self):
+        def fail(req):
+            raise IOError('unavailable')
+        self.update.response = fail
+        self.db.update('a', make_action('a1'))
+        self.assertFalse(self.db.flush(5.0))
+        # The failed update is pending again, and is written later.
+        stats = self.db.get_write_stats()
+        self.assertEqual(stats['n_failures'], 1)
+        self.assertEqual(stats['n_writes'], 0)
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertEqual(self.db.find('a').name, 'a1')
+        self.update.response = UpdateResponse(matched_count=1)
+        self.assertTrue(self.db.flush(5.0))
+        self.assertEqual(self.db.get_write_stats()['n_writes'], 1)
+        self.assertIn('a1', self.update.requests[-1].message.json)
+
+    def testWriteDelay(self):
+        db = ActionDatabase('db', 'actions', self.find, self.insert,
+                            self.update, write_delay=0.01)
+        db.update('a', make_action('a1'))
+        self.assertTrue(db.flush(5.0))
+        self.assertEqual(len(self.update.requests), 1)
+
+    def testFindCache(self):
+        self.find.response = make_find_response(make_action('a1'))
+        self.assertEqual(self.db.find('a').name, 'a1')
+        self.assertEqual(self.db.find('a').name, 'a1')
+        self.assertEqual(len(self.find.requests), 1)
+        stats = self.db.get_cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['n_entries'], 1)
+        self.assertEqual(stats['n_bytes'], get_msg_size(make_action('a1')))
+        # Local updates replace the cached action.
+        self.db.update('a', make_action('a2'))
+        self.assertEqual(self.db.get_cache_stats()['n_entries'], 0)
+        self.db.flush(5.0)
+        self.assertEqual(self.db.find('a').name, 'a2')
+        self.assertEqual(len(self.find.requests), 1)
+
+    def testCacheEviction(self):
+        cache = ActionCache(max_bytes=100)
+        for name in ['a', 'b', 'c']:
+            cache.put(name, make_action(name), 40, cache.get_generation())
+        # 'a' was evicted; using 'b' makes 'c' the next to go.
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b').name, 'b')
+        cache.put('d', make_action('d'), 40, cache.get_generation())
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get_stats()['n_bytes'], 80)
+        # Values looked up before an invalidation aren't cached.
+        generation = cache.get_generation()
+        cache.invalidate('b')
+        cache.put('b', make_action('b'), 40, generation)
+        self.assertIsNone(cache.get('b'))
+
+    def testCacheBound(self):
+        # Found actions are charged their decoded size, not the size of
+        # their stored form (which depends on the codec).
+        actions = dict((name, make_action(name * 100)) for name in 'abc')
+        size = get_msg_size(actions['a'])
+        db = ActionDatabase('db', 'actions', self.find, self.insert,
+                            self.update, cache_bytes=int(2.5 * size))
+        self.find.response = lambda req: FindResponse(
+            matched_count=1,
+            message=Message(msg_type='pr2_pbd_interaction/Action',
+                            json=db._codec.encode(actions[req.id])))
+        for name in 'abc':
+            self.assertEqual(db.find(name).name, name * 100)
+        stats = db.get_cache_stats()
+        self.assertEqual(stats['n_entries'], 2)
+        self.assertEqual(stats['n_bytes'], 2 * size)
+        self.assertIsNone(db._cache.peek('a'))
+
+    def testDeltas(self):
+        self.db.insert_new('a')
+        steps = [ActionStep(type=ActionStep.ARM_TARGET) for i in range(3)]
+        for i in range(3):
+            self.assertTrue(self.db.append_step('a', steps[i], i))
+        self.assertTrue(self.db.remove_step('a', 0, 3))
+        self.assertTrue(self.db.rename('a', 'b'))
+        action = self.db.find('a')
+        self.assertEqual(action.name, 'b')
+        self.assertEqual(action.sequence.seq, steps[1:])
+        # Deltas apply to what was written, too.
+        self.db.flush(5.0)
+        self.assertEqual(len(self.update.requests), 1)
+        replacement = ActionStep(type=ActionStep.ARM_TRAJECTORY)
+        self.assertTrue(self.db.replace_step('a', 1, replacement, 2))
+        self.assertEqual(self.db.find('a').sequence.seq,
+                         [steps[1], replacement])
+        self.assertEqual(len(self.find.requests), 0)
+
+    def testDeltaConflicts(self):
+        step = ActionStep()
+        # Unknown actions and unexpected step counts are conflicts.
+        self.assertFalse(self.db.append_step('x', step, 0))
+        self.db.update('a', make_action('a'))
+        self.assertFalse(self.db.append_step('a', step, 1))
+        self.assertFalse(self.db.remove_step('a', 0, 0))
+        self.assertTrue(self.db.append_step('a', step, 0))
+
+    def testCodecs(self):
+        action = make_action('a')
+        action.sequence.seq = [ActionStep(type=ActionStep.ARM_TARGET),
+                               ActionStep(type=ActionStep.ARM_TRAJECTORY)]
+        for name, codec in CODECS.iteritems():
+            doc = codec.encode(action)
+            decoded = decode_msg('pr2_pbd_interaction/Action', doc)
+            self.assertEqual(decoded.name, 'a', name)
+            self.assertEqual([step.type for step in decoded.sequence.seq],
+                             [ActionStep.ARM_TARGET,
+                              ActionStep.ARM_TRAJECTORY], name)
+        # Actions stored with any codec can be found.
+        self.find.response = FindResponse(
+            matched_count=1,
+            message=Message(msg_type='pr2_pbd_interaction/Action',
+                            json=CODECS['genpy_zlib'].encode(action)))
+        self.assertEqual(len(self.db.find('a').sequence.seq), 2)
+
+    def testFindMany(self):
+        self.find.response = lambda req: make_find_response(
+            make_action('found ' + req.id))
+        self.db.update('a', make_action('pending a'))
+        self.assertEqual(self.db.find('b').name, 'found b')
+        names = [action.name for action in
+                 self.db.find_many(['c', 'a', 'b', 'd', 'c'])]
+        self.assertEqual(names, ['found c', 'pending a', 'found b',
+                                 'found d', 'found c'])
+        # Only the actions that aren't held here are looked up, once.
+        self.assertEqual(sorted(req.id for req in self.find.requests),
+                         ['b', 'c', 'd'])
+        self.find.response = FindResponse(matched_count=0)
+        self.assertEqual(self.db.find_many(['x', 'y']), [None, None])
+
+    def testInsertMany(self):
+        self.insert.response = lambda req: InsertResponse(
+            id=json.loads(req.json)['name'])
+        ids = self.db.insert_many([make_action(str(i)) for i in range(20)])
+        self.assertEqual(ids, [str(i) for i in range(20)])
+        # The inserted actions are cached.
+        self.assertEqual(self.db.find('7').name, '7')
+        self.assertEqual(len(self.find.requests), 0)
+
+    def testUpdateMany(self):
+        self.db.update_many([(str(i), make_action(str(i)))
+                             for i in range(20)] +
+                            [('0', make_action('last'))])
+        self.assertEqual(self.db.get_write_stats()['queue_depth'], 20)
+        self.assertTrue(self.db.flush(5.0))
+        self.assertEqual(sorted(req.message.id for req in
+                                self.update.requests),
+                         sorted(str(i) for i in range(20)))
+        self.assertEqual(self.db.find('0').name, 'last')
+        self.assertEqual(self.db.get_write_stats()['n_writes'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
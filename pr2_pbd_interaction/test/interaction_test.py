@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+"""Tests the functionality of the interaction module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import Queue
+import threading
+import unittest
+from pr2_pbd_interaction import interaction
+from pr2_pbd_interaction.async_result import AsyncResult
+from pr2_pbd_interaction.interaction import Interaction
+from pr2_pbd_interaction.robot_speech import RobotSpeech
+from pr2_social_gaze.msg import GazeGoal
+
+NOT_DETECTED = [RobotSpeech.OBJECT_NOT_DETECTED, GazeGoal.SHAKE]
+
+
+class FakeResponse(object):
+    """Stands in for Response, recording what the robot would say."""
+    responses = []
+
+    def __init__(self, function, param):
+        self.function = function
+        self.param = param
+
+    def respond(self):
+        FakeResponse.responses.append(self.function(self.param))
+
+
+class FakeWorld(object):
+    def __init__(self):
+        self.objects = AsyncResult()
+
+    def update_object_pose_async(self):
+        return self.objects
+
+    def update(self):
+        return False
+
+    def get_frame_list(self):
+        return []
+
+
+class FakeArms(object):
+    def __init__(self):
+        self.started = []
+
+    def is_executing(self):
+        return len(self.started) > 0
+
+    def start_execution(self, action, z_offset):
+        self.started.append(action)
+
+
+class FakeAction(object):
+    def __init__(self):
+        self.frame_lists = []
+
+    def is_object_required(self):
+        return True
+
+    def update_objects(self, frame_list):
+        self.frame_lists.append(frame_list)
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.action = FakeAction()
+        self.current_action_id = 3
+
+    def n_actions(self):
+        return 1
+
+    def n_frames(self):
+        return 2
+
+    def save_current_action(self):
+        pass
+
+    def get_current_action(self):
+        return self.action
+
+
+class FakeInteraction(Interaction):
+    """An Interaction with fake parts, without the ROS publishers,
+    subscribers and threads its constructor starts."""
+
+    def __init__(self):
+        self._world = FakeWorld()
+        self.arms = FakeArms()
+        self.session = FakeSession()
+        self._pending_execution = None
+        self._is_pending_execution_stopped = False
+        self._execution_lock = threading.Lock()
+        self._handed_back = Queue.Queue()
+
+
+def finish_on_thread(async_result, result):
+    """Sets the result of async_result on another thread, and waits."""
+    thread = threading.Thread(target=async_result.set_result,
+                              args=(result,))
+    thread.start()
+    thread.join()
+
+
+class TestInteraction(unittest.TestCase):
+    def setUp(self):
+        self.response = interaction.Response
+        interaction.Response = FakeResponse
+        FakeResponse.responses = []
+        self.interaction = FakeInteraction()
+
+    def tearDown(self):
+        interaction.Response = self.response
+
+    def testExecute(self):
+        self.assertEqual(self.interaction._execute_action(), [None, None])
+        self.assertTrue(self.interaction._is_busy())
+        # Execution starts from update(), not on the thread that found
+        # the objects.
+        finish_on_thread(self.interaction._world.objects, True)
+        self.assertEqual(self.interaction.arms.started, [])
+        self.interaction._finish_handed_back()
+        self.assertEqual(self.interaction.arms.started,
+                         [self.interaction.session.action])
+        self.assertEqual(FakeResponse.responses,
+                         [[RobotSpeech.START_EXECUTION + ' 3', None]])
+
+    def testFailedResponse(self):
+        failed = AsyncResult()
+        failed.set_exception(ValueError('failed'))
+        self.assertEqual(self.interaction._respond_later(failed),
+                         NOT_DETECTED)
+
+    def testExecuteFailure(self):
+        # The robot responds even if looking for objects fails.
+        self.assertEqual(self.interaction._execute_action(), [None, None])
+        self.interaction._world.objects.set_exception(IOError('failed'))
+        self.interaction._finish_handed_back()
+        self.assertEqual(FakeResponse.responses, [NOT_DETECTED])
+        self.assertEqual(self.interaction.arms.started, [])
+        self.assertFalse(self.interaction._is_busy())
+
+    def testStopWhilePending(self):
+        self.interaction._execute_action()
+        self.assertEqual(self.interaction._stop_execution()[0],
+                         RobotSpeech.STOPPING_EXECUTION)
+        self.interaction._world.objects.set_result(True)
+        self.interaction._finish_handed_back()
+        self.assertEqual(self.interaction.arms.started, [])
+        self.assertEqual(FakeResponse.responses, [[None, None]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#! /usr/bin/env python
+"""Tests the functionality of the persistence module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import shutil
+import tempfile
+import threading
+import unittest
+from pr2_pbd_interaction.persistence import (PersistenceWorker,
+                                             write_atomically)
+
+
+class TestPersistence(unittest.TestCase):
+    def testCoalesce(self):
+        worker = PersistenceWorker()
+        saved = []
+        blocker = threading.Event()
+        # Keep the worker busy while more saves are scheduled.
+        worker.mark_dirty('block', blocker.wait)
+        for i in range(10):
+            worker.mark_dirty('action', lambda i=i: saved.append(i))
+        self.assertFalse(worker.flush(0.05))
+        blocker.set()
+        self.assertTrue(worker.flush(5.0))
+        self.assertEqual(saved, [9])
+        self.assertTrue(worker.is_idle())
+
+    def testErrorsDontStopWorker(self):
+        worker = PersistenceWorker()
+        saved = []
+        worker.mark_dirty('bad', lambda: 1 / 0)
+        worker.mark_dirty('good', lambda: saved.append(True))
+        self.assertTrue(worker.flush(5.0))
+        self.assertEqual(saved, [True])
+
+    def testWriteAtomically(self):
+        data_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(data_dir, 'state.yaml')
+            write_atomically(path, 'a: 1\n')
+            write_atomically(path, 'a: 2\n')
+            with open(path) as state_file:
+                self.assertEqual(state_file.read(), 'a: 2\n')
+            self.assertEqual(os.listdir(data_dir), ['state.yaml'])
+        finally:
+            shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
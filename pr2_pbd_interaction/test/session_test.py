@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+"""Tests the functionality of the session module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import unittest
+from pr2_pbd_interaction.db import ActionDatabase
+from pr2_pbd_interaction.msg import Action, ActionStep
+from pr2_pbd_interaction.session import Session
+from mongo_msg_db_msgs.srv import InsertResponse, UpdateResponse
+
+
+class FakeService(object):
+    """Stands in for a mongo_msg_db service proxy."""
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def __call__(self, req):
+        self.requests.append(req)
+        return self.response
+
+
+class FakeProgrammedAction(object):
+    """Stands in for a ProgrammedAction, whose steps can also be changed
+    by their markers (edit_step(...))."""
+
+    def __init__(self):
+        self.steps = []
+        self.version = 0
+
+    def get_version(self):
+        return self.version
+
+    def n_frames(self):
+        return len(self.steps)
+
+    def add_action_step(self, step, object_list):
+        self.steps.append(step)
+        self.version += 1
+
+    def delete_last_step(self):
+        del self.steps[-1]
+        self.version += 1
+
+    def get_last_step(self):
+        return self.steps[-1]
+
+    def edit_step(self, index, step):
+        self.steps[index] = step
+        self.version += 1
+
+    def to_msg(self):
+        action = Action()
+        action.sequence.seq = list(self.steps)
+        return action
+
+
+class FakeSession(Session):
+    """A Session with one action, without the ROS publishers, services
+    and files its constructor sets up."""
+
+    def __init__(self, db):
+        self._db = db
+        self._object_list = []
+        self._db_versions = {}
+        action_id = db.insert_new('a')
+        self.actions = {action_id: FakeProgrammedAction()}
+        self.current_action_id = action_id
+        self._db_versions[action_id] = 0
+
+    def _update_experiment_state(self):
+        pass
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.insert = FakeService(InsertResponse(id='a'))
+        self.update = FakeService(UpdateResponse(matched_count=1))
+        self.db = ActionDatabase('db', 'actions', None, self.insert,
+                                 self.update, write_delay=60.0)
+        self.session = FakeSession(self.db)
+        self.action = self.session.get_current_action()
+
+    def assertWritten(self, steps):
+        """Checks that the database writes the action with steps."""
+        self.assertTrue(self.db.flush(5.0))
+        self.assertEqual(len(self.update.requests), 1)
+        # What was written is cached.
+        self.assertEqual(self.db.find('a').sequence.seq, steps)
+
+    def testAppend(self):
+        steps = [ActionStep(type=ActionStep.ARM_TARGET) for i in range(2)]
+        for step in steps:
+            self.session.add_step_to_action(step, [])
+        self.assertWritten(steps)
+
+    def testEditThenAppend(self):
+        self.session.add_step_to_action(ActionStep(), [])
+        # A marker changes the first step, then a step is added.
+        edited = ActionStep(type=ActionStep.ARM_TRAJECTORY)
+        self.action.edit_step(0, edited)
+        added = ActionStep(type=ActionStep.ARM_TARGET)
+        self.session.add_step_to_action(added, [])
+        self.assertWritten([edited, added])
+
+    def testEditThenDelete(self):
+        for i in range(2):
+            self.session.add_step_to_action(ActionStep(), [])
+        edited = ActionStep(type=ActionStep.ARM_TRAJECTORY)
+        self.action.edit_step(0, edited)
+        self.session.delete_last_step()
+        self.assertWritten([edited])
+
+
+if __name__ == '__main__':
+    unittest.main()
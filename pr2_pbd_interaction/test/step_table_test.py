@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+"""Tests the functionality of the step_table module."""
+
+import os.path, sys
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+
+import unittest
+import rospy
+from pr2_pbd_interaction.step_table import StepTable
+from pr2_arm_control.msg import Side, GripperState
+from pr2_pbd_interaction.msg import ActionStep, ActionStepSequence, ArmState
+from pr2_pbd_interaction.msg import Landmark
+
+
+def make_step(r_ref_frame, landmark_name, x, r_gripper_state):
+    step = ActionStep()
+    step.type = ActionStep.ARM_TARGET
+    r_arm = step.armTarget.rArm
+    r_arm.refFrame = r_ref_frame
+    r_arm.ee_pose.position.x = x
+    r_arm.ee_pose.orientation.w = 1
+    r_arm.joint_pose = [x] * 7
+    r_arm.refFrameLandmark = Landmark(name=landmark_name)
+    step.gripperAction.rGripper.state = r_gripper_state
+    step.gripperAction.lGripper.state = GripperState.OPEN
+    return step
+
+
+def make_trajectory_step(n_points, x):
+    step = ActionStep()
+    step.type = ActionStep.ARM_TRAJECTORY
+    trajectory = step.armTrajectory
+    for j in range(n_points):
+        r_arm = ArmState()
+        r_arm.refFrame = ArmState.OBJECT
+        r_arm.ee_pose.position.x = x + j
+        r_arm.joint_pose = [x + j] * 7
+        r_arm.refFrameLandmark = Landmark(name='Obj #0')
+        trajectory.rArm.append(r_arm)
+        trajectory.lArm.append(ArmState())
+        trajectory.timing.append(rospy.Duration(0.5 * j))
+    trajectory.rRefFrame = ArmState.OBJECT
+    trajectory.rRefFrameLandmark = Landmark(name='Obj #0')
+    step.gripperAction.rGripper.state = GripperState.CLOSED
+    return step
+
+
+class TestStepTable(unittest.TestCase):
+    def setUp(self):
+        self.seq = ActionStepSequence()
+        self.seq.seq = [
+            make_step(ArmState.ROBOT_BASE, '', 0.1, GripperState.OPEN),
+            make_step(ArmState.OBJECT, 'Obj #0', 0.2, GripperState.CLOSED),
+            make_step(ArmState.OBJECT, 'Obj #0', 0.3, GripperState.CLOSED)
+        ]
+
+    def testQueries(self):
+        steps = StepTable.from_msg(self.seq)
+        self.assertEqual(len(steps), 3)
+        self.assertTrue(steps.is_object_required())
+        self.assertEqual(steps.get_gripper_states(Side.RIGHT),
+                         [GripperState.OPEN, GripperState.CLOSED,
+                          GripperState.CLOSED])
+        self.assertEqual(steps.get_ref_frame_names(Side.RIGHT),
+                         ['', 'Obj #0', 'Obj #0'])
+        # Both arms' base frame landmark and the object, once each.
+        self.assertEqual(len(steps.landmarks), 2)
+        self.assertFalse(StepTable().is_object_required())
+
+    def testToMsg(self):
+        seq = StepTable.from_msg(self.seq).to_msg()
+        self.assertEqual(len(seq.seq), 3)
+        r_arm = seq.seq[1].armTarget.rArm
+        self.assertEqual(r_arm.refFrame, ArmState.OBJECT)
+        self.assertAlmostEqual(r_arm.ee_pose.position.x, 0.2)
+        self.assertEqual(list(r_arm.joint_pose), [0.2] * 7)
+        self.assertEqual(r_arm.refFrameLandmark.name, 'Obj #0')
+        self.assertEqual(list(seq.seq[1].armTarget.lArm.joint_pose), [])
+        self.assertEqual(seq.seq[1].gripperAction.rGripper.state,
+                         GripperState.CLOSED)
+
+    def testVersions(self):
+        steps = StepTable.from_msg(self.seq)
+        replaced = steps.replace_step(
+            0, make_step(ArmState.OBJECT, 'Obj #1', 0.4, GripperState.OPEN))
+        appended = replaced.append_step(self.seq.seq[0])
+        deleted = appended.delete_step(1)
+        # Earlier versions are unchanged.
+        self.assertEqual(steps.get_ref_frame_names(Side.RIGHT),
+                         ['', 'Obj #0', 'Obj #0'])
+        self.assertEqual(replaced.get_ref_frame_names(Side.RIGHT),
+                         ['Obj #1', 'Obj #0', 'Obj #0'])
+        self.assertEqual(deleted.get_ref_frame_names(Side.RIGHT),
+                         ['Obj #1', 'Obj #0', ''])
+        self.assertAlmostEqual(
+            deleted.get_step(0).armTarget.rArm.ee_pose.position.x, 0.4)
+        self.assertIs(deleted.landmarks, steps.landmarks)
+        self.assertFalse(steps.ee_poses.flags.writeable)
+
+    def testTrajectories(self):
+        seq = ActionStepSequence()
+        seq.seq = [make_step(ArmState.ROBOT_BASE, '', 0.1, GripperState.OPEN),
+                   make_trajectory_step(3, 1.0),
+                   make_trajectory_step(2, 5.0)]
+        steps = StepTable.from_msg(seq)
+        self.assertTrue(steps.is_object_required())
+        self.assertEqual(len(steps.point_timing), 5)
+        trajectory = steps.get_step(1).armTrajectory
+        self.assertEqual(len(trajectory.rArm), 3)
+        self.assertAlmostEqual(trajectory.rArm[2].ee_pose.position.x, 3.0)
+        self.assertEqual(list(trajectory.rArm[2].joint_pose), [3.0] * 7)
+        self.assertEqual(trajectory.rArm[2].refFrameLandmark.name, 'Obj #0')
+        self.assertEqual(trajectory.timing[2], rospy.Duration(1.0))
+        self.assertEqual(trajectory.rRefFrame, ArmState.OBJECT)
+        self.assertEqual(trajectory.rRefFrameLandmark.name, 'Obj #0')
+        self.assertEqual(steps.get_step(1).gripperAction.rGripper.state,
+                         GripperState.CLOSED)
+        # Steps are made anew, so changing them doesn't change the table.
+        trajectory.rArm[0].ee_pose.position.x = 10.0
+        self.assertAlmostEqual(
+            steps.get_step(1).armTrajectory.rArm[0].ee_pose.position.x, 1.0)
+        # Only the points of the remaining trajectories are kept.
+        deleted = steps.delete_step(1)
+        self.assertEqual(len(deleted.point_timing), 2)
+        self.assertAlmostEqual(
+            deleted.get_step(1).armTrajectory.rArm[1].ee_pose.position.x, 6.0)
+        replaced = deleted.replace_step(0, make_trajectory_step(1, 9.0))
+        self.assertEqual([len(step.armTrajectory.timing)
+                          for step in replaced.to_msg().seq], [1, 2])
+        self.assertEqual(len(steps.get_step(1).armTrajectory.rArm), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,7 +13,7 @@ import unittest
 from pr2_pbd_interaction import world
 from pr2_pbd_interaction.msg import ArmState
 from pr2_pbd_interaction.msg import Landmark
-from geometry_msgs.msg import Pose
+from geometry_msgs.msg import Point, Pose, Quaternion, Vector3
 
 
 class TestTransforms(unittest.TestCase):
@@ -133,6 +133,208 @@ class TestTransforms(unittest.TestCase):
 
         arm_state.refFrameLandmark.name = 'modified'
 
+    def testNoOpConversionReturnsInput(self):
+        arm_state = ArmState()
+        arm_state.ee_pose.position.x = 0.2
+        arm_state.ee_pose.orientation.w = 1
+        arm_state.refFrame = ArmState.ROBOT_BASE
+        arm_state.joint_pose = [0.0] * 7
+
+        same = world.convert_ref_frame(arm_state, ArmState.ROBOT_BASE)
+        self.assertIs(same, arm_state)
+
+        landmark = Landmark()
+        landmark.name = 'landmark1'
+        landmark.pose.position.x = 0.15
+        landmark.pose.orientation.w = 1
+        rel_arm_state = world.convert_ref_frame(arm_state, ArmState.OBJECT,
+                                                landmark)
+        self.assertIsNot(rel_arm_state, arm_state)
+        self.assertIs(rel_arm_state.joint_pose, arm_state.joint_pose)
+        self.assertIs(world.convert_ref_frame(rel_arm_state, ArmState.OBJECT,
+                                              landmark), rel_arm_state)
+
+    def testConvertRefFramesMatchesSingle(self):
+        landmark1 = Landmark()
+        landmark1.name = 'landmark1'
+        landmark1.pose.position.x = 0.15
+        landmark1.pose.orientation.z = 0.7071068
+        landmark1.pose.orientation.w = 0.7071068
+        landmark2 = Landmark()
+        landmark2.name = 'landmark2'
+        landmark2.pose.position.y = -0.1
+        landmark2.pose.orientation.w = 1
+
+        arm_states = []
+        for i in range(5):
+            arm_state = ArmState()
+            arm_state.ee_pose.position.x = 0.1 * i
+            arm_state.ee_pose.position.z = 0.05
+            arm_state.ee_pose.orientation.w = 1
+            if i % 2 == 0:
+                arm_state.refFrame = ArmState.ROBOT_BASE
+            else:
+                arm_state.refFrame = ArmState.OBJECT
+                arm_state.refFrameLandmark = landmark1
+            arm_states.append(arm_state)
+
+        batch = world.convert_ref_frames(arm_states, ArmState.OBJECT,
+                                         landmark2)
+
+        self.assertEqual(len(batch), len(arm_states))
+        for arm_state, converted in zip(arm_states, batch):
+            single = world.convert_ref_frame(arm_state, ArmState.OBJECT,
+                                             landmark2)
+            self.assertEqual(converted.refFrame, ArmState.OBJECT)
+            self.assertEqual(converted.refFrameLandmark.name, 'landmark2')
+            self.assertAlmostEqual(converted.ee_pose.position.x,
+                                   single.ee_pose.position.x)
+            self.assertAlmostEqual(converted.ee_pose.position.y,
+                                   single.ee_pose.position.y)
+            self.assertAlmostEqual(converted.ee_pose.orientation.z,
+                                   single.ee_pose.orientation.z)
+
+    def testConvertPoseArrayRoundTrip(self):
+        poses = np.array([[0.2, 0, 0, 0, 0, 0, 1],
+                          [0.3, 0.1, 0.2, 0, 0, 0.7071068, 0.7071068]])
+        landmark_pose = np.array([0.15, 0, 0, 0, 0, 1, 0])
+
+        rel_poses = world.convert_pose_array(poses, None, landmark_pose)
+        abs_poses = world.convert_pose_array(rel_poses, landmark_pose)
+
+        self.assertEqual(rel_poses.shape, (2, 7))
+        self.assertAlmostEqual(rel_poses[0, 0], -0.05)
+        self.assertTrue(np.allclose(abs_poses[:, :3], poses[:, :3]))
+
+    def testRigidInverse(self):
+        transform = world.get_matrix_from_pose(
+            world.get_pose_from_array([0.1, -0.2, 0.3, 0.1, 0.2, 0.3, 0.9]))
+
+        inverse = world.get_rigid_inverse(transform)
+
+        self.assertTrue(np.allclose(inverse, np.linalg.inv(transform)))
+
+    def testLandmarkTransformCache(self):
+        cache = world.LandmarkTransformCache()
+        landmark = Landmark()
+        landmark.name = 'landmark1'
+        landmark.pose.position.x = 0.15
+        landmark.pose.orientation.w = 1
+
+        forward, inverse = cache.get(landmark)
+        forward_again, __ = cache.get(landmark)
+        self.assertIs(forward, forward_again)
+        self.assertEqual(cache.hits, 1)
+        self.assertAlmostEqual(inverse[0, 3], -0.15)
+
+        # A landmark with the same name but a different pose is a miss.
+        moved = Landmark()
+        moved.name = 'landmark1'
+        moved.pose.position.x = 0.3
+        moved.pose.orientation.w = 1
+        forward_moved, __ = cache.get(moved)
+        self.assertAlmostEqual(forward_moved[0, 3], 0.3)
+
+        cache.invalidate()
+        cache.get(moved)
+        self.assertEqual(cache.misses, 3)
+
+    def testAssociateLandmarks(self):
+        def make_landmark(name, x, y, z):
+            landmark = Landmark()
+            landmark.name = name
+            landmark.dimensions.x = x
+            landmark.dimensions.y = y
+            landmark.dimensions.z = z
+            return landmark
+
+        cup = make_landmark('thing 0', 0.1, 0.1, 0.2)
+        box = make_landmark('thing 1', 0.3, 0.2, 0.1)
+        new_box = make_landmark('thing 0', 0.31, 0.2, 0.1)
+        new_cup = make_landmark('thing 1', 0.1, 0.11, 0.2)
+        new_cup2 = make_landmark('thing 2', 0.1, 0.1, 0.25)
+
+        # Steps referencing the same landmark share one correspondence,
+        # and each new landmark is used at most once.
+        mapping = world.associate_landmarks(
+            [cup, box, cup, make_landmark('thing 9', 2.0, 2.0, 2.0)],
+            [new_box, new_cup, new_cup2])
+
+        self.assertEqual(len(mapping), 3)
+        self.assertIs(mapping['thing 0'], new_cup)
+        self.assertIs(mapping['thing 1'], new_box)
+        self.assertIsNone(mapping['thing 9'])
+
+    def testGetBoundingBox(self):
+        # Corners of a 0.2 x 0.1 x 0.3 box, rotated 30 degrees about z.
+        yaw = np.pi / 6
+        corners = []
+        for x in [-0.1, 0.1]:
+            for y in [-0.05, 0.05]:
+                for z in [0.0, 0.3]:
+                    corners.append(Point(
+                        0.5 + x * np.cos(yaw) - y * np.sin(yaw),
+                        x * np.sin(yaw) + y * np.cos(yaw), z))
+        points = world.get_points_array(corners)
+        self.assertEqual(points.shape, (8, 3))
+
+        pose, dims = world.get_bounding_box(points)
+        self.assertAlmostEqual(pose.position.x, 0.5)
+        self.assertAlmostEqual(pose.orientation.w, 1)
+        self.assertGreater(dims.y, 0.1)
+
+        pose, dims = world.get_bounding_box(points, world.BBOX_ORIENTED)
+        self.assertAlmostEqual(pose.position.x, 0.5)
+        self.assertAlmostEqual(pose.position.z, 0.15)
+        self.assertAlmostEqual(pose.orientation.z, np.sin(yaw / 2))
+        self.assertAlmostEqual(dims.x, 0.2)
+        self.assertAlmostEqual(dims.y, 0.1)
+        self.assertAlmostEqual(dims.z, 0.3)
+
+    def testMatchBoxes(self):
+        def make_box(x, y, size):
+            return (Pose(Point(x, y, 0.8), Quaternion(0, 0, 0, 1)),
+                    Vector3(size, size, size))
+
+        landmarks = []
+        for x, y, size in [(0.5, 0, 0.1), (0.7, 0.2, 0.1), (0.6, -0.3, 0.2)]:
+            pose, dims = make_box(x, y, size)
+            landmarks.append(Landmark(Landmark.TABLE_TOP, 'thing', pose,
+                                      dims))
+        # The first two objects moved slightly and the third is gone (the
+        # new box is far away and a different size).
+        boxes = [make_box(0.71, 0.2, 0.1), make_box(0.5, 0.01, 0.1),
+                 make_box(0.9, 0.4, 0.1)]
+
+        matches = world._match_boxes(landmarks, boxes)
+
+        self.assertEqual(sorted(matches), [(0, 1), (1, 0)])
+        self.assertEqual(world._match_boxes([], boxes), [])
+
+    def testSideFaces(self):
+        landmark = Landmark()
+        landmark.name = 'thing 3'
+        landmark.pose.position.x = 0.6
+        landmark.pose.position.z = 0.8
+        landmark.pose.orientation.z = np.sin(np.pi / 4)
+        landmark.pose.orientation.w = np.cos(np.pi / 4)
+        landmark.dimensions.x = 0.2
+        landmark.dimensions.y = 0.1
+        landmark.dimensions.z = 0.3
+
+        sides = world.SideFaces([landmark], [3])
+
+        self.assertEqual(len(sides), 6)
+        self.assertTrue(sides.has_landmark('Obj #3 X-Maximum Ref'))
+        self.assertIsNone(sides.get_landmark('Obj #0 X-Maximum Ref'))
+        # The object is turned a quarter turn, so its x axis is y.
+        x_max = sides.get_landmark('Obj #3 X-Maximum Ref')
+        self.assertAlmostEqual(x_max.pose.position.x, 0.6)
+        self.assertAlmostEqual(x_max.pose.position.y, 0.1)
+        self.assertAlmostEqual(x_max.dimensions.x, world.SIDE_THICKNESS)
+        self.assertAlmostEqual(x_max.dimensions.z, 0.3)
+        self.assertIs(sides.get_landmarks()[1], x_max)
+        self.assertEqual(sides.get_markers(0)[4].ns, 'Obj #3 Z-Minimum')
 
 
 if __name__ == '__main__':